@@ -0,0 +1,278 @@
+# ========================
+# analyzer_pool.py
+# ========================
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class PoolSaturated(Exception):
+    """解析器プールが飽和していて、時間内に枠を確保できなかった"""
+
+
+# =========================
+# セッション単位のエントリ
+# =========================
+class _Entry:
+    def __init__(self, analyzer=None):
+        self.analyzer = analyzer       # 作成中は None（作り終わると ready が立つ）
+        self.ready = threading.Event()
+        if analyzer is not None:
+            self.ready.set()
+        self.baseline = None           # 作成後に引き継ぐ baseline
+        self.lock = threading.Lock()   # 同一セッションの解析は直列化（VIDEO モードのタイムスタンプ順を守る）
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+# =========================
+# 解析器プール
+# =========================
+class AnalyzerPool:
+    """
+    セッション（ユーザー）ごとに PosePostureAnalyzer を割り当てるプール。
+
+    - 同じキーには常に同じ解析器を返す（EMA / 人ロック / baseline が混ざらない）
+    - 常駐する解析器（= landmarker グラフ）の数は max_sessions まで。超えたら
+      使われていない最も古いセッションから LRU で破棄する
+    - 同時に推論できる数は max_inflight まで。待ちが max_queue を超えるか
+      queue_timeout 秒待っても枠が空かなければ PoolSaturated を投げる
+    - 推論の枠はセッションのロックを取ってから確保する。同じユーザーの並行したフレームは
+      枠を持たずにロックを待つので、他のユーザーの枠を埋めない（待ちきれなければそのユーザーだけ 429）
+    - 破棄したセッションの baseline は max_baselines 件まで残す（古いものから捨てる）
+    - 解析器の生成・破棄（数百 ms かかる）はプールのロックの外で行う。生成中のセッションは
+      枠だけ先に確保しておき、同じキーの他のリクエストは生成が終わるのを待つ
+    """
+
+    def __init__(self, factory, max_sessions=8, max_inflight=4,
+                 max_queue=16, queue_timeout=2.0, idle_ttl=600.0, max_baselines=1024):
+        self._factory = factory
+        self.max_sessions = max_sessions
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.idle_ttl = idle_ttl
+        self.max_baselines = max_baselines
+
+        self._entries = OrderedDict()   # key -> _Entry（末尾が最近使ったもの）
+        self._spares = []               # prewarm で先に作った、まだ誰にも渡していない解析器
+        self._to_close = []             # 破棄した解析器（ロックを放してから close する）
+        self._baselines = OrderedDict() # 破棄したセッションの baseline 退避先（末尾が新しい）
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._inflight = 0
+        self._waiting = 0
+
+    # ---- 状態 ----
+    @property
+    def queue_depth(self):
+        return self._waiting
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "inflight": self._inflight,
+                "waiting": self._waiting,
+                "max_sessions": self.max_sessions,
+                "max_inflight": self.max_inflight,
+            }
+
+    def count_by(self, fn):
+        """常駐している解析器を fn(analyzer) の値ごとに数える"""
+        with self._lock:
+            analyzers = [e.analyzer for e in self._entries.values() if e.analyzer is not None]
+        counts = {}
+        for a in analyzers:
+            key = fn(a)
+            if key is not None:
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def baseline(self, key):
+        """key のセッションのキャリブレーション結果（破棄済みなら退避先から）。無ければ None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.analyzer is not None:
+                return entry.analyzer.baseline
+            if entry is not None and entry.baseline is not None:
+                return entry.baseline
+            return self._baselines.get(key)
+
+    # ---- 起動時の準備 ----
+    def prewarm(self, n=1, warm_fn=None):
+        """
+        解析器を n 個先に作っておき、最初のセッションから順に渡す。
+        warm_fn(analyzer) でダミー推論等をしておくと、初回リクエストが初期化を待たない
+        """
+        for _ in range(n):
+            analyzer = self._factory()
+            if warm_fn is not None:
+                warm_fn(analyzer)
+            with self._lock:
+                self._spares.append(analyzer)
+
+    # ---- 取得 ----
+    @contextmanager
+    def session(self, key):
+        """key に紐づく解析器を排他的に借りる"""
+        deadline = time.monotonic() + self.queue_timeout
+        entry, create = self._reserve(key, deadline)
+        try:
+            if create:
+                # 生成も推論の枠の内で行う（同時に作る数も max_inflight までに抑える）
+                self._acquire_slot(deadline)
+                try:
+                    self._build(key, entry)
+                finally:
+                    self._release_slot()
+            else:
+                entry.ready.wait()
+            if entry.analyzer is None:
+                raise PoolSaturated("analyzer unavailable")   # 生成に失敗した
+            if not entry.lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                raise PoolSaturated("timeout")
+            try:
+                self._acquire_slot(deadline)
+                try:
+                    yield entry.analyzer
+                finally:
+                    self._release_slot()
+            finally:
+                entry.lock.release()
+        finally:
+            self._release(entry)
+
+    def _reserve(self, key, deadline):
+        """セッションの席を確保する。戻り値: (エントリ, このスレッドが解析器を作るか)"""
+        try:
+            with self._cond:
+                self._waiting += 1
+                try:
+                    while True:
+                        entry = self._entries.get(key)
+                        if entry is not None or self._make_room_locked():
+                            break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise PoolSaturated("timeout")
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+                create = False
+                if entry is None:
+                    # 席だけ先に取る（max_sessions に数える）。生成はロックの外で
+                    if self._spares:
+                        entry = _Entry(self._spares.pop())
+                    else:
+                        entry = _Entry()
+                        create = True
+                    entry.baseline = self._baselines.pop(key, None)
+                    if not create and entry.baseline is not None:
+                        entry.analyzer.baseline = entry.baseline
+                    self._entries[key] = entry
+
+                self._entries.move_to_end(key)
+                entry.in_use += 1
+                entry.last_used = time.monotonic()
+                return entry, create
+        finally:
+            self._close_evicted()
+
+    def _acquire_slot(self, deadline):
+        """推論の枠を1つ確保する"""
+        with self._cond:
+            if self._inflight >= self.max_inflight and self._waiting >= self.max_queue:
+                raise PoolSaturated("queue full")
+            self._waiting += 1
+            try:
+                while self._inflight >= self.max_inflight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolSaturated("timeout")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._inflight += 1
+
+    def _release_slot(self):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def _build(self, key, entry):
+        """確保済みの席に解析器を作る（max_inflight の枠の内なので同時生成数も抑えられる）"""
+        try:
+            analyzer = self._factory()
+        except BaseException:
+            with self._cond:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                if entry.baseline is not None:
+                    self._keep_baseline_locked(key, entry.baseline)
+                self._cond.notify_all()
+            entry.ready.set()
+            raise
+        if entry.baseline is not None:
+            analyzer.baseline = entry.baseline
+        entry.analyzer = analyzer
+        entry.ready.set()
+
+    def _release(self, entry):
+        with self._cond:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            self._cond.notify_all()
+
+    # ---- 破棄 ----
+    def _make_room_locked(self):
+        """新しいセッション用の空きを作れれば True"""
+        self._evict_idle_locked()
+        if len(self._entries) < self.max_sessions:
+            return True
+        for key, entry in self._entries.items():
+            if entry.in_use == 0:
+                self._evict_locked(key)
+                return True
+        return False
+
+    def _evict_idle_locked(self):
+        now = time.monotonic()
+        expired = [
+            k for k, e in self._entries.items()
+            if e.in_use == 0 and now - e.last_used > self.idle_ttl
+        ]
+        for k in expired:
+            self._evict_locked(k)
+
+    def _evict_locked(self, key):
+        entry = self._entries.pop(key)
+        if entry.analyzer is None:
+            return
+        if entry.analyzer.baseline is not None:
+            self._keep_baseline_locked(key, entry.analyzer.baseline)
+        self._to_close.append(entry.analyzer)
+
+    def _keep_baseline_locked(self, key, baseline):
+        self._baselines[key] = baseline
+        self._baselines.move_to_end(key)
+        while len(self._baselines) > self.max_baselines:
+            self._baselines.popitem(last=False)
+
+    def _close_evicted(self):
+        """破棄した解析器をロックの外で close する"""
+        with self._lock:
+            analyzers, self._to_close = self._to_close, []
+        for analyzer in analyzers:
+            analyzer.close()
+
+    def close(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict_locked(key)
+            self._to_close.extend(self._spares)
+            self._spares = []
+        self._close_evicted()
@@ -1,36 +1,125 @@
 # ========================
 # app.py
 # ========================
-
-from flask import Flask, request, render_template, jsonify
+#
+# 開発用: python app/app.py（リローダー付きの開発サーバー）
+# 本番用: python app/serve.py（モデルを読み込んでから fork する。ワーカー数の制限も serve.py 参照）
+#         他の WSGI サーバーでは create_app() で作り、ワーカーごとに start_worker(app) を呼ぶ
+#
+# import しただけでは何も起動しない（DB 作成・スレッド起動・モデル読み込みは下の関数で行う）
+
+from flask import (Blueprint, Flask, Response, current_app, request, render_template, jsonify,
+                   make_response)
 import os
-import cv2
+import json
+import tempfile
+import threading
+import time
+import uuid
 import numpy as np
 
-from posture_check import PosePostureAnalyzer, PostureConfig
+from posture_check import PosePostureAnalyzer, PostureConfig, POSE_CONNECTIONS
+from analyzer_pool import AnalyzerPool, PoolSaturated
+from inference_service import InferenceService, InferenceUnavailable, physical_cores
+from multi_person import MultiPersonAnalyzer
 from flask_login import login_required, current_user
 
 from config import Config
 from routes.auth import auth
-from extensions import db, login_manager
+from extensions import db, login_manager, log_writer, sock, storage
 
 from models.problem import Problem
 from models.user import User
+from models.seat import SeatZone
+from log_pages import get_log_page, invalidate_pages
 from models.posture import PostureLog
+import rollups
+import export
+from retention import RetentionWorker
+from response_format import (negotiate, encode_analyze, encode_analyze_body, landmarks_to_dicts,
+                             ARRAY_FIELDS)
+from frame_preprocess import UploadTooLarge, decode_frame, decode_thumbnail, thread_buffers
+from ingest_format import METRIC_NAMES, IngestError, parse_ingest
+from batch_analyze import probe_video, run_batch
+import metrics
+from metrics import (span, record_stages, FRAMES, GaugeCollector, INGEST_SAMPLES, EXPORT_ROWS,
+                     INFERENCE_SECONDS, MODEL_TIER_FRAMES, MODEL_TIER_SWITCHES)
 
 from datetime import datetime, timedelta
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(BASE_DIR, "static", "models")
+MODEL_PATH = os.path.join(MODEL_DIR, "pose_landmarker_full.task")
+
+bp = Blueprint("main", __name__)
+
+# 以下は create_app で作る（プロセスに1つ）
+MODEL_TIERS = {}
+analyzer_pool = None
+camera_pool = None
+ingest_pool = None
+batch_slots = None
+inference_service = None   # INFERENCE_WORKERS が 0 なら使わない（start_worker で起動）
+retention_worker = RetentionWorker()
+
 
 # =========================
 # Flask 初期化
 # =========================
-app = Flask(__name__)
-app.config.from_object(Config)
+def create_app(config=Config):
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    storage.init_app(app)
+    login_manager.init_app(app)
+    log_writer.init_app(app)
+    sock.init_app(app)
+    metrics.init_app(app)
+
+    # Blueprint 登録
+    app.register_blueprint(auth)
+    app.register_blueprint(bp)
+
+    # DB 初期化（静的なテーブル(User, Problem等)はここで作る）
+    with app.app_context():
+        db.create_all()
+
+    # 分・時・日の集計は姿勢ログと同じトランザクションで更新する
+    log_writer.add_listener(PostureLog.__table__, rollups.apply_rollups)
+    # 過去の時刻の行が入ったら /logs のページ索引をその位置から作り直す
+    log_writer.add_listener(PostureLog.__table__, invalidate_pages)
+    # 古いログのアーカイブ・削除（RETENTION_* の設定に従って定期実行）
+    retention_worker.init_app(app)
+
+    init_pools(app)
+    return app
+
+
+def start_worker(app, retention=True, warmup=True):
+    """
+    ワーカープロセスごとの起動処理。スレッドは fork を越えられないので fork した後に呼ぶ。
+      - 姿勢ログの書き込みスレッド（終了時に残りを書き出す）
+      - 古いログの整理（複数ワーカーなら1つだけで retention=True にする）
+      - 推論プロセス（INFERENCE_WORKERS）
+      - ダミー推論による暖機（終わってからリクエストを受ける）
+    """
+    # fork した場合、親が作った DB 接続は使わずに作り直す（親の接続は閉じない）
+    storage.dispose()
+    log_writer.start()
+    if retention:
+        retention_worker.start()
+    start_inference(app)
+    if warmup:
+        warm_up(app)
+
+
+def stop_worker():
+    """start_worker で起動したものを止める（atexit を通らずに終わる場合用）"""
+    if inference_service is not None:
+        inference_service.close()
+    log_writer.stop()
 
-db.init_app(app)
-login_manager.init_app(app)
 
 # =========================
 # Login Manager
@@ -39,33 +128,211 @@ login_manager.init_app(app)
 def load_user(user_id):
     return User.query.get(int(user_id))
 
-# =========================
-# Blueprint 登録
-# =========================
-app.register_blueprint(auth)
 
 # =========================
-# DB 初期化
-# （静的なテーブル(User, Problem等)はここで作る）
+# 姿勢解析器プール（ユーザーごとに解析器を割り当てる）
 # =========================
-with app.app_context():
-    db.create_all()
+def find_model_tiers(config):
+    """負荷で切り替えるモデル（置いてあるものだけ。full しか無ければ切り替えない）"""
+    tiers = {}
+    for tier in config["MODEL_TIERS"]:
+        path = os.path.join(MODEL_DIR, f"pose_landmarker_{tier}.task")
+        if os.path.exists(path):
+            tiers[tier] = path
+    if len(tiers) < 2:
+        tiers = {"full": MODEL_PATH}
+    return tiers
+
+
+def init_pools(app):
+    global MODEL_TIERS, analyzer_pool, camera_pool, ingest_pool, batch_slots
+    config = app.config
+    MODEL_TIERS = find_model_tiers(config)
+
+    analyzer_pool = AnalyzerPool(
+        lambda: PosePostureAnalyzer(MODEL_TIERS, PostureConfig(
+            start_tier=config["MODEL_START_TIER"],
+            tier_slo_ms=config["MODEL_TIER_SLO_MS"],
+            tier_queue_high=config["MODEL_TIER_QUEUE_HIGH"],
+            tracking=config["ANALYZER_TRACKING"],
+            keyframe_interval=config["ANALYZER_KEYFRAME_INTERVAL"],
+            static_skip=config["STATIC_SKIP"],
+            static_max_reuse_s=config["STATIC_MAX_REUSE_S"],
+            poll_min_ms=config["POLL_MIN_MS"],
+            poll_max_ms=config["POLL_MAX_MS"],
+        ), load_fn=lambda: analyzer_pool.queue_depth, detector_factory=remote_detector_factory()),
+        max_sessions=config["ANALYZER_POOL_MAX_SESSIONS"],
+        max_inflight=config["ANALYZER_POOL_MAX_INFLIGHT"],
+        max_queue=config["ANALYZER_POOL_MAX_QUEUE"],
+        queue_timeout=config["ANALYZER_POOL_QUEUE_TIMEOUT"],
+        idle_ttl=config["ANALYZER_POOL_IDLE_TTL"],
+        max_baselines=config["ANALYZER_POOL_MAX_BASELINES"],
+    )
+
+    # 共有カメラ（複数人モード）はカメラごとに1つの解析器
+    camera_pool = AnalyzerPool(
+        lambda: MultiPersonAnalyzer(
+            MODEL_TIERS,
+            PostureConfig(start_tier=config["MODEL_START_TIER"],
+                          tier_slo_ms=config["MODEL_TIER_SLO_MS"],
+                          tier_queue_high=config["MODEL_TIER_QUEUE_HIGH"]),
+            max_poses=config["CAMERA_MAX_POSES"],
+            load_fn=lambda: camera_pool.queue_depth,
+            detector_factory=remote_detector_factory(),
+        ),
+        max_sessions=config["CAMERA_POOL_MAX_SESSIONS"],
+        max_inflight=config["ANALYZER_POOL_MAX_INFLIGHT"],
+        max_queue=config["ANALYZER_POOL_MAX_QUEUE"],
+        queue_timeout=config["ANALYZER_POOL_QUEUE_TIMEOUT"],
+        idle_ttl=config["ANALYZER_POOL_IDLE_TTL"],
+        max_baselines=config["ANALYZER_POOL_MAX_BASELINES"],
+    )
+
+    # 端末側で推論したクライアント（/ingest）用。推論器は持たず、EMA / 人ロック / baseline だけ
+    ingest_pool = AnalyzerPool(
+        lambda: PosePostureAnalyzer(None, PostureConfig()),
+        max_sessions=config["INGEST_POOL_MAX_SESSIONS"],
+        max_inflight=config["INGEST_POOL_MAX_INFLIGHT"],
+        max_queue=config["ANALYZER_POOL_MAX_QUEUE"],
+        queue_timeout=config["ANALYZER_POOL_QUEUE_TIMEOUT"],
+        idle_ttl=config["ANALYZER_POOL_IDLE_TTL"],
+        max_baselines=config["ANALYZER_POOL_MAX_BASELINES"],
+    )
+
+    batch_slots = threading.BoundedSemaphore(config["BATCH_MAX_CONCURRENT_JOBS"])
+
+
+def start_inference(app):
+    """
+    INFERENCE_WORKERS が 0 でなければ推論プロセスを起動する。
+    以降に作る解析器は推論プロセスで推論する（フレームは共有メモリで渡す）
+    """
+    global inference_service
+    n = app.config["INFERENCE_WORKERS"]
+    if n == 0 or inference_service is not None:
+        return
+    side = max(app.config["INFERENCE_MAX_SIDE"], app.config["CAMERA_INFERENCE_MAX_SIDE"])
+    inference_service = InferenceService(
+        workers=n if n > 0 else physical_cores(),
+        slots=app.config["INFERENCE_RING_SLOTS"],
+        slot_bytes=side * side * 3,
+        timeout=app.config["INFERENCE_TIMEOUT_S"],
+        health_interval=app.config["INFERENCE_HEALTH_INTERVAL_S"],
+        health_timeout=app.config["INFERENCE_HEALTH_TIMEOUT_S"],
+    )
+    inference_service.start()
+
+
+def remote_detector_factory():
+    """解析器を作る時点で推論プロセスが動いていれば、その推論器を使う"""
+    return inference_service.detector if inference_service is not None else None
+
+
+def warm_up(app):
+    """
+    1人用の解析器を WARMUP_SESSIONS 個作り、黒画像で1回推論しておく（モデルが無ければ何もしない）。
+    推論器の初期化（グラフ構築・XNNPACK の準備）を最初のリクエストに払わせない
+    """
+    n = app.config["WARMUP_SESSIONS"]
+    if n <= 0 or not all(os.path.exists(p) for p in MODEL_TIERS.values()):
+        return
+    side = app.config["INFERENCE_MAX_SIDE"]
+    blank = np.zeros((side * 3 // 4, side, 3), np.uint8)
+    with app.app_context():
+        analyzer_pool.prewarm(n, lambda analyzer: analyzer.warm_up(blank))
+
+
+def record_analysis(analyzer):
+    """解析1回分の段階別の時間・結果・使ったモデルを /metrics に記録する"""
+    timings = analyzer.last_timings
+    record_stages(timings)
+    FRAMES.inc(analyzer.last_status)
+    if analyzer.model_tier is not None and "inference" in timings:
+        # 切り替えた直後でも、このフレームは切り替え前のモデルで推論している
+        tier = analyzer.last_switch[0] if analyzer.last_switch else analyzer.model_tier
+        MODEL_TIER_FRAMES.inc(tier)
+        INFERENCE_SECONDS.observe(timings["inference"], tier)
+    if analyzer.last_switch:
+        MODEL_TIER_SWITCHES.inc(*analyzer.last_switch)
+
+
+def pool_busy_response(body, pool=None):
+    """プール飽和時の 429 応答"""
+    pool = pool or analyzer_pool
+    res = jsonify(body)
+    res.status_code = 429
+    res.headers["Retry-After"] = "1"
+    res.headers["X-Queue-Depth"] = str(pool.queue_depth)
+    return res
+
+
+# ---- /metrics に出す外部状態 ----
+GaugeCollector("posture_db_rows_written_total", "DB に書き込んだログ行数",
+               lambda: log_writer.written, kind="counter")
+GaugeCollector("posture_db_rows_dropped_total", "キュー満杯で捨てたログ行数",
+               lambda: log_writer.dropped, kind="counter")
+GaugeCollector("posture_log_queue_depth", "書き込み待ちのログ行数",
+               lambda: log_writer.stats()["queue_depth"])
+GaugeCollector("posture_pool_sessions", "常駐している解析器の数",
+               lambda: analyzer_pool.stats()["sessions"])
+GaugeCollector("posture_pool_inflight", "推論中のリクエスト数",
+               lambda: analyzer_pool.stats()["inflight"])
+GaugeCollector("posture_pool_waiting", "解析器の空き待ちのリクエスト数",
+               lambda: analyzer_pool.queue_depth)
+GaugeCollector("posture_inference_worker_restarts_total", "落ちた / 応答しない推論プロセスを作り直した回数",
+               lambda: inference_service.restarts if inference_service else 0, kind="counter")
+GaugeCollector("posture_inference_timeouts_total", "推論プロセスの結果を待ちきれなかった回数",
+               lambda: inference_service.timeouts if inference_service else 0, kind="counter")
+GaugeCollector("posture_pool_sessions_by_tier", "使っているモデルごとの解析器の数",
+               lambda: analyzer_pool.count_by(lambda a: a.model_tier), label="tier")
+
 
 # =========================
-# 姿勢解析器 初期化（アプリ起動時に1回）
+# 稼働状況
 # =========================
-MODEL_PATH = os.path.join(
-    BASE_DIR, "static", "models", "pose_landmarker_full.task"
-)
-analyzer = PosePostureAnalyzer(MODEL_PATH, PostureConfig())
+@bp.get("/metrics")
+def metrics_endpoint():
+    """Prometheus 形式のテキスト"""
+    return metrics.render_all(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@bp.get("/stats")
+@login_required
+def stats():
+    return jsonify({
+        "analyzer_pool": analyzer_pool.stats(),
+        "camera_pool": camera_pool.stats(),
+        "ingest_pool": ingest_pool.stats(),
+        "inference": inference_service.stats() if inference_service else None,
+        "log_writer": log_writer.stats(),
+        "storage": storage.stats(),
+        "stream": dict(stream_stats),
+        "retention": {"last_run": retention_worker.last_run,
+                      "last_summary": retention_worker.last_summary},
+    })
+
 
+@bp.app_errorhandler(UploadTooLarge)
+def upload_too_large(e):
+    """MAX_FRAME_BYTES を超える画像・本文"""
+    return jsonify({"error": "upload too large", "max_bytes": current_app.config["MAX_FRAME_BYTES"]}), 413
 
-@app.route("/")
+
+@bp.app_errorhandler(InferenceUnavailable)
+def inference_unavailable(e):
+    """推論プロセスが間に合わない / 作り直し中"""
+    res = jsonify({"posture": "unknown", "error": "inference unavailable"})
+    res.status_code = 503
+    res.headers["Retry-After"] = "1"
+    return res
+
+
+@bp.route("/")
 def index():
     problems = Problem.query.all()
     return render_template("index.html", problems=problems)
 
-@app.route("/debug")
+@bp.route("/debug")
 def debug():
     return render_template("debug.html")
 
@@ -73,128 +340,673 @@ def debug():
 # =========================
 # 画像解析
 # =========================
-@app.post("/analyze")
+def read_upload(field):
+    """
+    アップロードされた画像をこのスレッドのバッファに読み込む（bytes を作らない）。
+    本文がそのまま画像（Content-Type: image/*）でも、multipart の field でも受け付ける。
+    戻り値: uint8 配列（次のリクエストで上書きされる）または None
+    """
+    buffers = thread_buffers()
+    max_bytes = current_app.config["MAX_FRAME_BYTES"]
+    if request.mimetype.startswith("image/"):
+        return buffers.read_stream(request.stream, request.content_length or 0, max_bytes)
+    file = request.files.get(field)
+    if file is None:
+        return None
+    return buffers.read_stream(file.stream, file.content_length or 0, max_bytes)
+
+
+def read_thumbnail(buf):
+    """静止判定用のサムネイル。画像として読めなければ None（セッションを借りる前に弾く）"""
+    with span("thumbnail"):
+        return decode_thumbnail(buf)
+
+
+def analyze_frame_bytes(analyzer, buf, thumb):
+    """
+    画面が前回解析した時から変わっていなければ前回の結果を使い回す（推論・保存なし）。
+    変わっていれば推論解像度まで縮小デコードして解析・保存する。
+    thumb は read_thumbnail の結果（None でないこと）。
+    戻り値: (解析結果 または None, 画像として読めたか)
+    """
+    hit, out = analyzer.reuse_if_static(thumb)
+    if hit:
+        return out, True
+
+    # フル解像度では展開しない
+    with span("decode"):
+        frame = decode_frame(buf, current_app.config["INFERENCE_MAX_SIDE"], thread_buffers())
+    if frame is None:
+        return None, False
+    out = analyzer.analyze_and_save(frame)
+    analyzer.remember_scene(thumb, out)
+    return out, True
+
+
+def with_poll_hint(body, next_poll_ms):
+    """応答に次のフレームまでの推奨間隔を載せる"""
+    if next_poll_ms is None:
+        return body
+    return dict(body, next_poll_ms=next_poll_ms)
+
+
+@bp.post("/analyze")
 @login_required
 def analyze():
-    file = request.files.get("image", None)
-    if file is None:
+    buf = read_upload("image")
+    thumb = read_thumbnail(buf) if buf is not None else None
+    if thumb is None:
+        # 読めない画像で解析器の枠を使わない
+        FRAMES.inc("invalid")
         return jsonify({"posture": "unknown"}), 400
 
-    file_bytes = np.frombuffer(file.read(), np.uint8)
-    frame = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-    if frame is None:
+    try:
+        with analyzer_pool.session(current_user.id) as analyzer:
+            out, valid = analyze_frame_bytes(analyzer, buf, thumb)
+            if valid:
+                record_analysis(analyzer)
+            next_poll_ms = analyzer.next_poll_ms()
+    except PoolSaturated:
+        return pool_busy_response({"posture": "unknown", "error": "busy"})
+
+    if not valid:
+        FRAMES.inc("invalid")
         return jsonify({"posture": "unknown"}), 400
 
-    # ★ 動的テーブルがまだないユーザーの場合に備えて作成
-    # （毎回呼ぶと重いので本番は「初回だけ」にするのが理想）
-    LogModel = PostureLog(current_user.username)
-    db.create_all()
-
-    out = analyzer.analyze_and_save(frame)
-
     if out is None:
-        return jsonify({"posture": "unknown", "landmarks": []})
+        return jsonify(with_poll_hint({"posture": "unknown", "landmarks": []}, next_poll_ms))
+
+    # 形式（json / packed / msgpack）と返すランドマーク（2d / 3d）はクライアントが選ぶ
+    with span("encode"):
+        fmt, fields = negotiate(request)
+        return encode_analyze(with_poll_hint(out, next_poll_ms), fmt, fields)
 
-    landmarks_2d = out["landmarks"] if out["landmarks"] is not None else []
 
+# =========================
+# クライアントの送信サイズ
+# =========================
+@bp.get("/capture_config")
+def capture_config():
+    """ブラウザはこの長辺まで縮小してから JPEG を送る"""
     return jsonify({
-        "posture": out["judge"],               # good / bad
-        "posture_type": out["posture_type"],   # slouch 等
-        "metrics": out["metrics"],
-        "landmarks": landmarks_2d,
-        "world_landmarks": out["world_landmarks"],
-        "connections": out["connections"]
+        "max_side": current_app.config["INFERENCE_MAX_SIDE"],
+        "jpeg_quality": current_app.config["CLIENT_JPEG_QUALITY"],
     })
 
 
+# =========================
+# 骨格の接続情報（静的・キャッシュ可）
+# =========================
+@bp.get("/pose/connections")
+def pose_connections():
+    res = make_response(jsonify(POSE_CONNECTIONS))
+    res.cache_control.public = True
+    res.cache_control.max_age = 86400
+    res.add_etag()
+    return res.make_conditional(request)
+
+
+# =========================
+# 端末側で推論した結果の受け付け
+# =========================
+@bp.post("/ingest")
+@login_required
+def ingest():
+    """
+    端末側で推論したランドマーク / 角度を受け付けて判定・保存する（画像は受け取らない）。
+    形式は ingest_format.py。応答は最後に採用した1件の判定と、件数の内訳
+    """
+    buf = thread_buffers().read_stream(request.stream, request.content_length or 0,
+                                       current_app.config["MAX_FRAME_BYTES"])
+    if buf is None:
+        return jsonify({"error": "empty body"}), 400
+    try:
+        sample = parse_ingest(request.mimetype, buf, current_app.config["INGEST_MAX_SAMPLES"])
+    except IngestError as e:
+        return jsonify({"error": str(e)}), 400
+
+    created_at = None
+    if sample["t"] is not None:
+        now_ms = time.time() * 1000
+        if (sample["t"] < now_ms - current_app.config["INGEST_MAX_AGE_S"] * 1000).any():
+            return jsonify({"error": "t is too old"}), 400
+        # 端末の時計が進んでいる分は今に丸める
+        created_at = [datetime.utcfromtimestamp(ms / 1000) for ms in np.minimum(sample["t"], now_ms).tolist()]
+
+    try:
+        with ingest_pool.session(current_user.id) as analyzer:
+            res = analyzer.ingest(sample["world"], sample["metrics"], created_at)
+            record_stages(analyzer.last_timings)
+            accepted = np.flatnonzero(res["status"] == "ok")
+            calibrated = sample["calibrate"] and len(accepted) > 0
+            if calibrated:
+                analyzer.calibrate(dict(zip(METRIC_NAMES, res["metrics"][accepted[-1]].tolist())))
+    except PoolSaturated:
+        return pool_busy_response({"error": "busy"}, ingest_pool)
+
+    results, counts = np.unique(res["status"], return_counts=True)
+    for result, n in zip(results.tolist(), counts.tolist()):
+        INGEST_SAMPLES.inc(result, amount=n)
+
+    body = {
+        "accepted": len(accepted),
+        "rejected": {r: n for r, n in zip(results.tolist(), counts.tolist()) if r != "ok"},
+        "posture": "unknown",
+    }
+    if len(accepted):
+        i = accepted[-1]
+        body.update(posture=str(res["judge"][i]), posture_type=str(res["posture_type"][i]),
+                    metrics=dict(zip(METRIC_NAMES, res["metrics"][i].tolist())))
+    if sample["calibrate"]:
+        body["calibrated"] = calibrated
+    return jsonify(body)
+
+
 # =========================
 # キャリブレーション
 # =========================
-@app.route("/calibrate", methods=["POST"])
+@bp.route("/calibrate", methods=["POST"])
 @login_required
 def calibrate():
-    file = request.files.get("image")
-    if not file:
+    buf = read_upload("image")
+    if buf is None:
         return jsonify({"error": "no image"}), 400
 
-    img = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
-    out = analyzer.analyze(img)
+    with span("decode"):
+        img = decode_frame(buf, current_app.config["INFERENCE_MAX_SIDE"], thread_buffers())
+    if img is None:
+        return jsonify({"error": "invalid image"}), 400
+
+    try:
+        with analyzer_pool.session(current_user.id) as analyzer:
+            out = analyzer.analyze(img)
+            record_stages(analyzer.last_timings)
+            if out is not None:
+                analyzer.calibrate(out["metrics"])
+    except PoolSaturated:
+        return pool_busy_response({"error": "busy"})
 
     if out is None:
         return jsonify({"error": "no pose detected"}), 400
 
-    analyzer.calibrate(out["metrics"])
-
     return jsonify({
         "status": "calibrated",
         "baseline": {k: round(v, 3) for k, v in out["metrics"].items()}
     })
 
 
+# =========================
+# WebSocket ストリーミング解析
+# =========================
+stream_stats = {"connections": 0, "frames": 0, "dropped": 0}
+
+
+def parse_ws_control(msg):
+    """制御メッセージを dict にする。形が正しくなければ None"""
+    try:
+        ctrl = json.loads(msg)
+    except ValueError:
+        return None
+    if not isinstance(ctrl, dict):
+        return None
+    if "fields" in ctrl and not isinstance(ctrl["fields"], str):
+        return None
+    return ctrl
+
+
+@sock.route("/ws/analyze", bp=bp)
+def ws_analyze(ws):
+    """
+    接続時に1回だけ認証し、以降はバイナリメッセージ（JPEG）を受けて結果を返す。
+    推論が追いつかない時は溜まった古いフレームを捨て、最新の1枚だけを解析する。
+
+    テキストメッセージは制御用
+      {"type": "calibrate"}                              次のフレームでキャリブレーション
+      {"type": "config", "fields": "2d", "format": "packed"}  応答形式の変更
+    """
+    if not current_user.is_authenticated:
+        ws.close(reason=1008, message="login required")
+        return
+
+    user_id = current_user.id
+    max_side = current_app.config["INFERENCE_MAX_SIDE"]
+    fmt, fields = negotiate(request)
+    calibrate_next = False
+    stream_stats["connections"] += 1
+
+    try:
+        while True:
+            msg = ws.receive()
+
+            # 受信済みのメッセージを読み切り、フレームは最新だけ残す
+            frame_bytes = None
+            while msg is not None:
+                if isinstance(msg, str):
+                    ctrl = parse_ws_control(msg)
+                    if ctrl is None:
+                        # 壊れた制御メッセージで接続は切らない
+                        ws.send(json.dumps({"error": "invalid control message"}))
+                    elif ctrl.get("type") == "calibrate":
+                        calibrate_next = True
+                    elif ctrl.get("type") == "config":
+                        fmt = ctrl.get("format", fmt)
+                        if fmt not in ("json", "packed"):
+                            fmt = "json"
+                        if "fields" in ctrl:
+                            fields = {f.strip() for f in ctrl["fields"].split(",")} & set(ARRAY_FIELDS)
+                else:
+                    if frame_bytes is not None:
+                        stream_stats["dropped"] += 1
+                    frame_bytes = msg
+                msg = ws.receive(timeout=0)
+
+            if frame_bytes is None:
+                continue
+
+            # 読めない画像で解析器の枠を使わない
+            if calibrate_next:
+                with span("decode"):
+                    frame = decode_frame(frame_bytes, max_side, thread_buffers())
+                valid = frame is not None
+            else:
+                thumb = read_thumbnail(frame_bytes)
+                valid = thumb is not None
+            if not valid:
+                ws.send(json.dumps({"posture": "unknown", "error": "invalid image"}))
+                continue
+
+            try:
+                with analyzer_pool.session(user_id) as analyzer:
+                    if calibrate_next:
+                        out = analyzer.analyze(frame)
+                        if out is not None:
+                            analyzer.calibrate(out["metrics"])
+                    else:
+                        out, valid = analyze_frame_bytes(analyzer, frame_bytes, thumb)
+                        if valid:
+                            record_analysis(analyzer)
+                    next_poll_ms = analyzer.next_poll_ms()
+            except (PoolSaturated, InferenceUnavailable):
+                ws.send(json.dumps({"posture": "unknown", "error": "busy"}))
+                continue
+            if not valid:
+                ws.send(json.dumps({"posture": "unknown", "error": "invalid image"}))
+                continue
+            stream_stats["frames"] += 1
+
+            if calibrate_next:
+                calibrate_next = False
+                if out is None:
+                    ws.send(json.dumps({"error": "no pose detected"}))
+                else:
+                    ws.send(json.dumps({
+                        "status": "calibrated",
+                        "baseline": {k: round(v, 3) for k, v in out["metrics"].items()}
+                    }))
+                continue
+
+            if out is None:
+                ws.send(json.dumps(with_poll_hint({"posture": "unknown"}, next_poll_ms)))
+                continue
+
+            data, _ = encode_analyze_body(with_poll_hint(out, next_poll_ms), fmt, fields)
+            ws.send(data)
+    finally:
+        stream_stats["connections"] -= 1
+
+
+# =========================
+# 録画ファイルの一括解析
+# =========================
+batch_jobs = {}   # job_id -> 状態
+
+
+def prune_batch_jobs(ttl_s):
+    """終わってから ttl_s 秒経ったジョブを忘れる"""
+    now = time.monotonic()
+    for job_id, job in list(batch_jobs.items()):
+        if now - job.get("finished_at", now) > ttl_s:
+            batch_jobs.pop(job_id, None)
+
+
+def _run_batch_job(app, job_id, path, user_id, started_at, baseline):
+    job = batch_jobs[job_id]
+
+    def progress(done, total, frames, elapsed):
+        job.update(status="running", chunks_done=done, chunks_total=total,
+                   frames=frames, elapsed_s=round(elapsed, 1))
+
+    try:
+        with batch_slots, app.app_context():
+            job["status"] = "running"
+            job["result"] = run_batch(
+                path, user_id, started_at,
+                workers=app.config["BATCH_WORKERS"],
+                sample_fps=app.config["BATCH_SAMPLE_FPS"],
+                max_side=app.config["INFERENCE_MAX_SIDE"],
+                model_path=MODEL_PATH,
+                baseline=baseline,
+                progress=progress,
+            )
+            job["status"] = "done"
+    except Exception as e:
+        job.update(status="error", error=str(e))
+    finally:
+        job["finished_at"] = time.monotonic()
+        os.unlink(path)
+
+
+@bp.post("/batch")
+@login_required
+def batch_upload():
+    """
+    録画ファイルを受け取り、バックグラウンドで解析する。進み具合は /batch/<job_id>
+      started_at : 録画開始時刻（ISO 形式, UTC。+09:00 などが付いていれば UTC に直す）。省略すると「受け付けた時刻 - 動画の長さ」
+    判定には /calibrate 等で記録した baseline を使う。
+    """
+    file = request.files.get("video")
+    if file is None:
+        return jsonify({"error": "no video"}), 400
+
+    started_at = request.form.get("started_at")
+    if started_at:
+        try:
+            started_at = rollups.parse_utc(started_at)
+        except ValueError:
+            return jsonify({"error": "invalid started_at"}), 400
+
+    received_at = datetime.utcnow()
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(file.filename or "")[1] or ".mp4")
+    with os.fdopen(fd, "wb") as f:
+        file.save(f)
+
+    try:
+        fps, total = probe_video(path)
+    except ValueError:
+        os.unlink(path)
+        return jsonify({"error": "cannot open video"}), 400
+    if not started_at:
+        # 撮り終えてすぐ送られた録画とみなす（batch_analyze.py の既定と同じ考え方）
+        started_at = received_at - timedelta(seconds=total / fps)
+
+    baseline = analyzer_pool.baseline(current_user.id) or ingest_pool.baseline(current_user.id)
+
+    prune_batch_jobs(current_app.config["BATCH_JOB_TTL_S"])
+    job_id = uuid.uuid4().hex
+    batch_jobs[job_id] = {"status": "queued", "user_id": current_user.id}
+    threading.Thread(
+        target=_run_batch_job,
+        args=(current_app._get_current_object(), job_id, path, current_user.id, started_at, baseline),
+        daemon=True,
+    ).start()
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+
+@bp.get("/batch/<job_id>")
+@login_required
+def batch_status(job_id):
+    prune_batch_jobs(current_app.config["BATCH_JOB_TTL_S"])
+    job = batch_jobs.get(job_id)
+    if job is None or job["user_id"] != current_user.id:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({k: v for k, v in job.items() if k not in ("user_id", "finished_at")})
+
+
 # =========================
 # ログ表示
 # =========================
-@app.route('/logs')
+@bp.route('/logs')
 @login_required
 def show_logs():
     page = int(request.args.get('page', 1))
 
-    # ユーザーごとの動的モデルを取得して query する
-    LogModel = PostureLog(current_user.username)
-    db.create_all()  # 念のため（初回ユーザー）
+    # ページ分け（5分区切り・2.5秒間引き）は索引を使って対象ページだけ読む
+    page_logs, has_next = get_log_page(current_user.id, page)
+
+    with span("logs_render"):
+        return render_template('logs.html', logs=page_logs, page=page, has_next=has_next)
+
+
+# =========================
+# 共有カメラ（複数人モード）
+# =========================
+def admin_required():
+    """共有カメラの設定・送信は管理者アカウントだけ"""
+    if not current_user.is_admin:
+        return jsonify({"error": "admin only"}), 403
+    return None
+
+
+def person_body(out, fields):
+    body = {
+        "track_id": out["track_id"],
+        "user_id": out["user_id"],
+        "zone": out["zone"],
+        "posture": out["judge"],
+        "posture_type": out["posture_type"],
+        "metrics": out["metrics"],
+    }
+    if "2d" in fields and out.get("landmarks") is not None:
+        body["landmarks"] = landmarks_to_dicts(out["landmarks"])
+    return body
+
+
+@bp.post("/cameras/<camera_id>/analyze")
+@login_required
+def camera_analyze(camera_id):
+    """
+    共有カメラの1フレームを解析し、席に座っている全員の姿勢を記録する。
+    ?fields=2d で人ごとの 2D ランドマークも返す（既定は返さない）
+    """
+    denied = admin_required()
+    if denied:
+        return denied
+    buf = read_upload("image")
+    if buf is None:
+        return jsonify({"error": "no image"}), 400
+
+    with span("decode"):
+        frame = decode_frame(buf, current_app.config["CAMERA_INFERENCE_MAX_SIDE"], thread_buffers())
+    if frame is None:
+        FRAMES.inc("invalid")
+        return jsonify({"error": "invalid image"}), 400
+
+    zones = SeatZone.query.filter_by(camera_id=camera_id).all()
+    try:
+        with camera_pool.session(camera_id) as analyzer:
+            analyzer.set_zones(zones)
+            people = analyzer.analyze_and_save(frame)
+            record_analysis(analyzer)
+    except PoolSaturated:
+        return pool_busy_response({"error": "busy"}, camera_pool)
+
+    fields = {f.strip() for f in request.args.get("fields", "").split(",")}
+    return jsonify({"people": [person_body(out, fields) for out in people]})
+
+
+@bp.post("/cameras/<camera_id>/calibrate")
+@login_required
+def camera_calibrate(camera_id):
+    """フォームの username の席にいる人の今の姿勢を、その人の正しい姿勢として記録する"""
+    denied = admin_required()
+    if denied:
+        return denied
+    buf = read_upload("image")
+    user = User.query.filter_by(username=request.form.get("username", "")).first()
+    if buf is None or user is None:
+        return jsonify({"error": "image and a valid username are required"}), 400
+
+    with span("decode"):
+        frame = decode_frame(buf, current_app.config["CAMERA_INFERENCE_MAX_SIDE"], thread_buffers())
+    if frame is None:
+        return jsonify({"error": "invalid image"}), 400
+
+    zones = SeatZone.query.filter_by(camera_id=camera_id).all()
+    try:
+        with camera_pool.session(camera_id) as analyzer:
+            analyzer.set_zones(zones)
+            people = analyzer.analyze(frame)
+            record_stages(analyzer.last_timings)
+            out = next((p for p in people if p["user_id"] == user.id), None)
+            if out is not None:
+                analyzer.calibrate_user(user.id, out["metrics"])
+    except PoolSaturated:
+        return pool_busy_response({"error": "busy"}, camera_pool)
+
+    if out is None:
+        return jsonify({"error": "user not detected in their seat"}), 400
+    return jsonify({
+        "status": "calibrated",
+        "user_id": user.id,
+        "baseline": {k: round(v, 3) for k, v in out["metrics"].items()},
+    })
+
+
+@bp.get("/cameras/<camera_id>/zones")
+@login_required
+def camera_zones(camera_id):
+    denied = admin_required()
+    if denied:
+        return denied
+    zones = SeatZone.query.filter_by(camera_id=camera_id).order_by(SeatZone.id).all()
+    return jsonify([z.to_dict() for z in zones])
+
+
+@bp.put("/cameras/<camera_id>/zones")
+@login_required
+def put_camera_zones(camera_id):
+    """
+    席の一覧を置き換える。
+    [{"name": "desk-1", "username": "alice", "rect": [x0, y0, x1, y1]}, ...]（座標は 0..1）
+    """
+    denied = admin_required()
+    if denied:
+        return denied
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return jsonify({"error": "expected a JSON list"}), 400
+
+    zones = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("username", ""), str) \
+                or not isinstance(item.get("name"), (str, type(None))):
+            return jsonify({"error": "invalid zone", "zone": item}), 400
+        user = User.query.filter_by(username=item.get("username", "")).first()
+        rect = item.get("rect")
+        if user is None or not isinstance(rect, list) or len(rect) != 4:
+            return jsonify({"error": "invalid zone", "zone": item}), 400
+        try:
+            x0, y0, x1, y1 = (float(v) for v in rect)
+        except (TypeError, ValueError):
+            return jsonify({"error": "rect must be numbers", "zone": item}), 400
+        if not (0.0 <= x0 < x1 <= 1.0 and 0.0 <= y0 < y1 <= 1.0):
+            return jsonify({"error": "rect must be within 0..1", "zone": item}), 400
+        zones.append(SeatZone(camera_id=camera_id, name=item.get("name"), user_id=user.id,
+                              x0=x0, y0=y0, x1=x1, y1=y1))
+
+    SeatZone.query.filter_by(camera_id=camera_id).delete()
+    db.session.add_all(zones)
+    db.session.commit()
+    return jsonify([z.to_dict() for z in zones])
+
+
+# =========================
+# 集計 API（分・時・日のロールアップ）
+# =========================
+@bp.get("/api/rollups")
+@login_required
+def api_rollups():
+    """
+    ?start=&end=          ISO 形式（UTC。+09:00 などが付いていれば UTC に直す）。既定は直近7日
+    ?resolution=          auto（既定）/ minute / hour / day / none（合計だけ）
+    """
+    try:
+        end = rollups.parse_utc(request.args["end"]) if "end" in request.args \
+            else datetime.utcnow()
+        start = rollups.parse_utc(request.args["start"]) if "start" in request.args \
+            else end - timedelta(days=7)
+    except ValueError:
+        return jsonify({"error": "invalid datetime"}), 400
+    if start >= end:
+        return jsonify({"error": "start must be before end"}), 400
+
+    resolution = request.args.get("resolution", "auto")
+    if resolution == "auto":
+        resolution = rollups.pick_resolution(start, end)
+    elif resolution not in rollups.TIERS + ("none",):
+        return jsonify({"error": "invalid resolution"}), 400
+
+    with span("rollups_query"):
+        body = {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "summary": rollups.summarize(current_user.id, start, end),
+        }
+        if resolution != "none":
+            body["resolution"] = resolution
+            body["series"] = rollups.series(current_user.id, start, end, resolution)
+    return jsonify(body)
+
+
+# =========================
+# 全履歴のエクスポート
+# =========================
+@bp.get("/export")
+@login_required
+def export_logs():
+    """
+    姿勢ログを chunk ごとに流して返す（全件をメモリに載せない。形式は export.py）
+    retention.py でアーカイブへ移した行も同じ並び順で含む
+    ?format=       csv（既定）/ ndjson / npz
+    ?start=&end=   ISO 形式（UTC。+09:00 などが付いていれば UTC に直す）。省略すると全期間
+    ?after=        続きから（最後に受け取った行の user_id,created_at,id）
+    ?user=         他のユーザー名 / all（管理者だけ。既定は自分）
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in export.FORMATS:
+        return jsonify({"error": "invalid format"}), 400
+    try:
+        start = rollups.parse_utc(request.args["start"]) if "start" in request.args else None
+        end = rollups.parse_utc(request.args["end"]) if "end" in request.args else None
+    except ValueError:
+        return jsonify({"error": "invalid datetime"}), 400
+    try:
+        after = export.parse_token(request.args["after"]) if "after" in request.args else None
+    except ValueError:
+        return jsonify({"error": "invalid after"}), 400
+
+    user_id, name = current_user.id, current_user.username
+    target = request.args.get("user")
+    if target and target != current_user.username:
+        denied = admin_required()
+        if denied:
+            return denied
+        if target == "all":
+            user_id, name = None, "all"
+        else:
+            user = User.query.filter_by(username=target).first()
+            if user is None:
+                return jsonify({"error": "user not found"}), 404
+            user_id, name = user.id, user.username
+
+    chunks = export.iter_history(storage.read_engine, current_app.config["RETENTION_ARCHIVE_DIR"],
+                                 user_id, start, end, after, current_app.config["EXPORT_CHUNK_SIZE"])
+
+    def counted():
+        for rows in chunks:
+            EXPORT_ROWS.inc(fmt, amount=len(rows))
+            yield rows
+
+    mimetype, ext = export.FORMATS[fmt]
+    res = Response(export.ENCODERS[fmt](counted()), content_type=mimetype)
+    res.headers["Content-Disposition"] = f'attachment; filename="posture_{name}.{ext}"'
+    res.headers["X-Accel-Buffering"] = "no"   # 前段のプロキシで溜めずに流す
+    return res
 
-    query = (
-        LogModel.query
-        .filter_by(user_id=current_user.id)
-        .order_by(LogModel.created_at.asc())  
-    )
-    logs = query.all()
-
-    pages = []
-    current_page = []
-    last_time = None
-    last_page_time = None
-
-    for log in logs:
-        if last_time is None:
-            current_page.append(log)
-            last_time = log.created_at
-            last_page_time = log.created_at
-            continue
-
-        time_diff = (log.created_at - last_time).total_seconds()
-        page_diff = (log.created_at - last_page_time).total_seconds()
-
-        # 5分以上空いたらページを分ける
-        if page_diff >= 5 * 60:
-            pages.append(current_page)
-            current_page = [log]
-            last_page_time = log.created_at
-            last_time = log.created_at
-            continue
-
-        # 2.5秒以上間隔があれば追加
-        if time_diff >= 2.5:
-            current_page.append(log)
-            last_time = log.created_at
-
-    if current_page:
-        pages.append(current_page)
-
-    # ▼ ここから追記：最新が先頭になるように並べ替え
-    # ページ全体を「最新ページが先頭」になるように反転し、
-    # 各ページ内も「新しいログが先頭」になるように反転する
-    pages_desc = [list(reversed(p)) for p in reversed(pages)]
-
-    # ページ番号に応じて出力（1ページ目 = 最新ページ）
-    if 1 <= page <= len(pages_desc):
-        page_logs = pages_desc[page - 1]
-        has_next = page < len(pages_desc)
-    else:
-        page_logs = []
-        has_next = False
-
-    return render_template('logs.html', logs=page_logs, page=page, has_next=has_next)
 
 if __name__ == "__main__":
+    # リローダーは子プロセスでアプリを読み直すので、スレッド起動・暖機は子の方だけで行う
+    app = create_app()
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_worker(app)
     app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,227 @@
+# ========================
+# batch_analyze.py
+# ========================
+#
+# 録画ファイルのオフライン解析
+#   動画を一定フレーム数のチャンクに分け、プロセスプールで並列に
+#   デコード → 推論 → 角度計算 し、元の順番に並べ直してまとめて INSERT する。
+#
+#   python app/batch_analyze.py session.mp4 --user alice
+#   python app/batch_analyze.py session.mp4 --user alice --workers 8 --sample-fps 5
+#
+# 各チャンクは新しい解析器で処理する。チャンク境界で EMA が途切れないよう、
+# 開始位置より overlap フレーム手前から解析して、その分の結果は捨てる（助走）。
+# baseline（キャリブレーション結果）を渡すと各チャンクの解析器に設定する。
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL = os.path.join(BASE_DIR, "static", "models", "pose_landmarker_full.task")
+
+INSERT_BATCH = 5000
+
+
+# =========================
+# 動画の情報・チャンク分割
+# =========================
+def probe_video(path):
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise ValueError(f"cannot open video: {path}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return fps, total
+
+
+def plan_chunks(total_frames, chunk_size):
+    return [(start, min(start + chunk_size, total_frames))
+            for start in range(0, total_frames, chunk_size)]
+
+
+# =========================
+# ワーカー（別プロセス）
+# =========================
+def analyze_chunk(task):
+    """
+    1チャンク分を解析する。
+    戻り値: (chunk_index, [(フレーム時刻ms, judge, posture_type, torso, neck, tilt), ...], 読んだフレーム数)
+    """
+    import cv2
+    from posture_check import PosePostureAnalyzer, PostureConfig
+
+    index, path, start, end, overlap, step, max_side, model_path, baseline = task
+    analyzer = PosePostureAnalyzer(model_path, PostureConfig())
+    analyzer.baseline = baseline
+
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    first = max(0, start - overlap)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+    rows = []
+    read = 0
+    try:
+        for idx in range(first, end):
+            # 間引くフレームはデコードしない
+            if idx % step:
+                if not cap.grab():
+                    break
+                continue
+            ok, frame = cap.read()
+            if not ok:
+                break
+            read += 1
+
+            h, w = frame.shape[:2]
+            if max_side and max(h, w) > max_side:
+                scale = max_side / max(h, w)
+                frame = cv2.resize(frame, (int(w * scale), int(h * scale)),
+                                   interpolation=cv2.INTER_AREA)
+
+            t_ms = idx * 1000.0 / fps
+            out = analyzer.analyze(frame, timestamp_ms=t_ms)
+            if out is None or idx < start:
+                continue   # 人がいない / 助走区間
+            out = analyzer.classify_result(out)
+            m = out["metrics"]
+            rows.append((t_ms, out["judge"], out["posture_type"],
+                         m["torso_angle"], m["neck_angle"], m["shoulder_tilt"]))
+    finally:
+        cap.release()
+        analyzer.close()
+    return index, rows, read
+
+
+# =========================
+# 実行（親プロセス）
+# =========================
+def run_batch(path, user_id, started_at, workers=None, chunk_size=900, overlap=30,
+              sample_fps=0.0, max_side=640, model_path=DEFAULT_MODEL, baseline=None, progress=None):
+    """
+    動画を解析して posture_log に書き込む。アプリコンテキスト内で呼ぶこと。
+    progress(done_chunks, total_chunks, frames_read, elapsed_s) が呼ばれる。
+    """
+    from extensions import db
+    from models.posture import PostureLog
+    from rollups import apply_rollups
+    from log_pages import invalidate_pages
+
+    fps, total = probe_video(path)
+    step = max(1, round(fps / sample_fps)) if sample_fps else 1
+    chunks = plan_chunks(total, chunk_size)
+    tasks = [(i, path, s, e, overlap, step, max_side, model_path, baseline)
+             for i, (s, e) in enumerate(chunks)]
+
+    table = PostureLog.__table__
+    pending = []
+    written = 0
+    frames_read = 0
+    t0 = time.perf_counter()
+
+    def flush():
+        nonlocal written, pending
+        if pending:
+            db.session.execute(table.insert(), pending)
+            apply_rollups(db.session, pending)
+            invalidate_pages(db.session, pending)   # 動画の時刻は過去なので索引を作り直させる
+            db.session.commit()
+            written += len(pending)
+            pending = []
+
+    # スレッドを持つ Web サーバーからも安全に使えるよう spawn で起動する
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(processes=workers or os.cpu_count()) as pool:
+        # imap は投入順に結果を返すので、そのまま時刻順に並ぶ
+        for done, (index, rows, read) in enumerate(pool.imap(analyze_chunk, tasks), 1):
+            frames_read += read
+            for t_ms, judge, posture_type, torso, neck, tilt in rows:
+                pending.append({
+                    "user_id": user_id,
+                    "posture": judge,
+                    "posture_type": posture_type,
+                    "torso_angle": torso,
+                    "neck_angle": neck,
+                    "shoulder_tilt": tilt,
+                    "created_at": started_at + timedelta(milliseconds=t_ms),
+                })
+            if len(pending) >= INSERT_BATCH:
+                flush()
+            if progress is not None:
+                progress(done, len(tasks), frames_read, time.perf_counter() - t0)
+    flush()
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "frames_total": total,
+        "frames_analyzed": frames_read,
+        "rows_written": written,
+        "chunks": len(tasks),
+        "elapsed_s": round(elapsed, 2),
+        "fps": round(frames_read / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def print_progress(done, total, frames, elapsed):
+    rate = frames / elapsed if elapsed > 0 else 0.0
+    eta = (total - done) * (elapsed / done) if done else 0.0
+    print(f"\r{done}/{total} chunks  {frames} frames  {rate:.1f} fps  ETA {eta:.0f}s",
+          end="", file=sys.stderr, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="録画ファイルの姿勢をまとめて解析する")
+    parser.add_argument("video")
+    parser.add_argument("--user", required=True, help="ログを記録するユーザー名")
+    parser.add_argument("--start", help="録画開始時刻 (ISO 形式, UTC)。既定はファイルの更新時刻 - 長さ")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=900, help="1チャンクのフレーム数")
+    parser.add_argument("--overlap", type=int, default=30, help="EMA 助走用に前へ伸ばすフレーム数")
+    parser.add_argument("--sample-fps", type=float, default=0.0, help="解析するフレームレート（0 = 全フレーム）")
+    parser.add_argument("--max-side", type=int, default=640)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    args = parser.parse_args()
+
+    from flask import Flask
+    from config import Config
+    from extensions import db, storage
+    from models.user import User
+    from rollups import parse_utc
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    storage.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username=args.user).first()
+        if user is None:
+            parser.error(f"unknown user: {args.user}")
+
+        if args.start:
+            started_at = parse_utc(args.start)
+        else:
+            fps, total = probe_video(args.video)
+            started_at = (datetime.utcfromtimestamp(os.path.getmtime(args.video))
+                          - timedelta(seconds=total / fps))
+
+        summary = run_batch(
+            args.video, user.id, started_at,
+            workers=args.workers, chunk_size=args.chunk_size, overlap=args.overlap,
+            sample_fps=args.sample_fps, max_side=args.max_side, model_path=args.model,
+            progress=print_progress,
+        )
+        print(file=sys.stderr)
+        for k, v in summary.items():
+            print(f"{k}: {v}")
+
+
+if __name__ == "__main__":
+    main()
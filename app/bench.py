@@ -0,0 +1,827 @@
+# ========================
+# bench.py
+# ========================
+#
+# 解析パイプラインのオフラインベンチマーク（CPU のみで動く）
+#
+#   python app/bench.py --frames path/to/jpegs/        # JPEG 連番のディレクトリ
+#   python app/bench.py --frames session.mp4           # 動画ファイル
+#   python app/bench.py --synthetic 20000              # MediaPipe を使わない合成ランドマーク
+#   python app/bench.py --synthetic 1000000 --batch    # analyze_batch で一括再処理した時の速度
+#   python app/bench.py --frames session.mp4 --ingest  # 受信〜RGB 変換だけ（確保量とピーク RSS）
+#   python app/bench.py --frames session.mp4 --ingest --no-reuse   # 比較用: バッファを使い回さない
+#   python app/bench.py --startup                      # serve.py の起動〜最初の応答とワーカーのメモリ
+#   python app/bench.py --startup --no-preload
+#   python app/bench.py --inference --inference-workers 4 --clients 8   # 推論プロセスのスループット
+#   python app/bench.py --inference --inference-workers 0 --clients 8   # 比較用: リクエストのスレッドで推論
+#   python app/bench.py --storage --readers 4                # 書き込みと /logs の読み取りを同時に流す
+#   python app/bench.py --storage --readers 4 --storage-baseline   # 比較用: SQLite の既定の設定・読み書き同じ接続
+#
+#   --out result.json        結果を JSON で保存（コミット間の比較用）
+#   --compare base.json      以前の結果と p50 / p95 を比較して表示
+#   --db none|sync|async     保存段階の扱い（既定: async = 本番と同じバックグラウンド書き込み）
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL = os.path.join(BASE_DIR, "static", "models", "pose_landmarker_full.task")
+
+STAGES = ("decode", "color", "inference", "track", "metrics", "landmarks", "save",
+          "json_encode", "packed_encode")
+
+
+# =========================
+# 入力
+# =========================
+def load_jpegs(path, limit):
+    """ディレクトリの画像 or 動画を JPEG バイト列のリストにする（計測前に全部読む）"""
+    import cv2
+
+    frames = []
+    if os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path)
+                       if n.lower().endswith((".jpg", ".jpeg", ".png")))
+        for n in names[:limit or None]:
+            with open(os.path.join(path, n), "rb") as f:
+                data = f.read()
+            if not n.lower().endswith((".jpg", ".jpeg")):
+                img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+                data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes()
+            frames.append(data)
+        return frames
+
+    cap = cv2.VideoCapture(path)
+    while not limit or len(frames) < limit:
+        ok, img = cap.read()
+        if not ok:
+            break
+        # ブラウザからのアップロードと同じく JPEG にしておく
+        frames.append(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+    cap.release()
+    return frames
+
+
+class _LM:
+    __slots__ = ("x", "y", "z", "visibility", "presence")
+
+    def __init__(self, x, y, z, visibility=0.99, presence=0.99):
+        self.x, self.y, self.z = x, y, z
+        self.visibility, self.presence = visibility, presence
+
+
+def synthetic_landmarks(n, seed=0):
+    """座っている人らしいランドマークに小さな揺れを加えた列を作る"""
+    rng = np.random.default_rng(seed)
+    world = np.zeros((33, 3))
+    world[:, 1] = -0.3
+    world[0] = (0.0, -0.68, -0.08)                      # 鼻
+    world[11], world[12] = (0.18, -0.5, -0.02), (-0.18, -0.5, -0.02)  # 肩
+    world[23], world[24] = (0.1, 0.0, 0.0), (-0.1, 0.0, 0.0)          # 腰
+    image = np.column_stack([0.5 + world[:, 0], 0.6 + world[:, 1] * 0.8, world[:, 2]])
+
+    drift = np.cumsum(rng.normal(0, 0.002, (n, 1, 3)), axis=0)
+    for t in range(n):
+        w = world + drift[t] + rng.normal(0, 0.003, (33, 3))
+        im = image + drift[t] + rng.normal(0, 0.003, (33, 3))
+        yield [_LM(*p) for p in w.tolist()], [_LM(*p) for p in im.tolist()]
+
+
+# =========================
+# 保存先（ベンチ専用の DB）
+# =========================
+def make_app(db_url, overrides=None):
+    from flask import Flask
+    from config import Config
+    from extensions import db, log_writer, login_manager, storage
+    from models.user import User
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    app.config.update(overrides or {})
+    storage.init_app(app)
+    login_manager.init_app(app)
+    log_writer.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username="bench").first()
+        if user is None:
+            user = User(username="bench", password="-")
+            db.session.add(user)
+            db.session.commit()
+        user_id = user.id
+    return app, user_id
+
+
+class _NullRecorder:
+    def save(self, metrics, judge, posture_type, user_id=None, created_at=None):
+        pass
+
+
+# =========================
+# 計測
+# =========================
+def percentiles(values):
+    if not values:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+    a = np.asarray(values) * 1000.0
+    p50, p95, p99 = np.percentile(a, [50, 95, 99])
+    return {"mean": round(float(a.mean()), 4), "p50": round(float(p50), 4),
+            "p95": round(float(p95), 4), "p99": round(float(p99), 4)}
+
+
+def run(args):
+    from posture_check import PosePostureAnalyzer, PostureConfig
+    from frame_preprocess import decode_frame
+    from response_format import encode_analyze_body
+    from extensions import db, log_writer
+    from flask_login import login_user
+    from models.user import User
+
+    tmp = None
+    db_url = args.db_url
+    if db_url is None:
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        tmp.close()
+        db_url = "sqlite:///" + tmp.name
+    app, user_id = make_app(db_url)
+
+    synthetic = args.synthetic is not None
+    cfg = PostureConfig(tracking=args.tracking, keyframe_interval=args.keyframe_interval)
+    analyzer = PosePostureAnalyzer(None if synthetic else args.model, cfg)
+    if args.db == "none":
+        analyzer.recorder = _NullRecorder()
+    if args.db == "async":
+        log_writer.start()
+
+    if synthetic:
+        source = synthetic_landmarks(args.synthetic, args.seed)
+    else:
+        source = load_jpegs(args.frames, args.limit)
+        print(f"{len(source)} frames loaded", file=sys.stderr)
+
+    stage_times = {k: [] for k in STAGES}
+    total = []
+    no_pose = 0
+    keyframes = 0
+    fields = {"2d", "3d"}
+
+    with app.test_request_context():
+        login_user(db.session.get(User, user_id))
+
+        t_start = time.perf_counter()
+        for item in source:
+            t0 = time.perf_counter()
+            if synthetic:
+                lm_world, lm_image = item
+                analyzer.last_timings = {}
+                out = analyzer.analyze_landmarks(lm_world, lm_image)
+            else:
+                frame = decode_frame(item, args.max_side)
+                t_dec = time.perf_counter()
+                stage_times["decode"].append(t_dec - t0)
+                out = analyzer.analyze(frame)
+                keyframes += analyzer.last_keyframe
+
+            if out is None:
+                no_pose += 1
+                total.append(time.perf_counter() - t0)
+                continue
+
+            out = analyzer.save_result(out)
+
+            t1 = time.perf_counter()
+            encode_analyze_body(out, "json", fields)
+            t2 = time.perf_counter()
+            encode_analyze_body(out, "packed", fields)
+            t3 = time.perf_counter()
+
+            # 応答は json / packed のどちらか一方なので、合計には json だけを含める
+            total.append(t2 - t0)
+            for k, v in analyzer.last_timings.items():
+                stage_times[k].append(v)
+            stage_times["json_encode"].append(t2 - t1)
+            stage_times["packed_encode"].append(t3 - t2)
+        elapsed = time.perf_counter() - t_start
+
+    if args.db == "async":
+        t0 = time.perf_counter()
+        log_writer.stop()
+        drain_ms = (time.perf_counter() - t0) * 1000
+    else:
+        drain_ms = 0.0
+    analyzer.close()
+    if tmp is not None:
+        os.unlink(tmp.name)
+
+    frames = len(total)
+    return {
+        "meta": {
+            "mode": "synthetic" if synthetic else "frames",
+            "source": None if synthetic else args.frames,
+            "db": args.db,
+            "max_side": args.max_side,
+            "tracking": args.tracking,
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "summary": {
+            "frames": frames,
+            "no_pose": no_pose,
+            "keyframes": keyframes if not synthetic else None,
+            "elapsed_s": round(elapsed, 4),
+            "fps": round(frames / elapsed, 2) if elapsed > 0 else 0.0,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "writer_drain_ms": round(drain_ms, 2),
+        },
+        "latency_ms": percentiles(total),
+        "stages_ms": {k: percentiles(v) for k, v in stage_times.items() if v},
+    }
+
+
+def run_batch_replay(args):
+    """合成ランドマーク列を (T, 33, 3) に詰めて analyze_batch の速度を測る"""
+    from posture_check import PosePostureAnalyzer, PostureConfig
+
+    analyzer = PosePostureAnalyzer(None, PostureConfig())
+    seq = np.array([[(p.x, p.y, p.z) for p in w]
+                    for w, _ in synthetic_landmarks(min(args.synthetic, 20000), args.seed)])
+    reps = -(-args.synthetic // len(seq))
+    seq = np.tile(seq, (reps, 1, 1))[:args.synthetic]
+
+    t0 = time.perf_counter()
+    res = analyzer.analyze_batch(seq)
+    analyzer.classify_batch(res["metrics"])
+    elapsed = time.perf_counter() - t0
+
+    return {
+        "meta": {"mode": "batch", "commit": git_commit(), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "summary": {
+            "frames": len(seq),
+            "no_pose": int((res["status"] != "ok").sum()),
+            "elapsed_s": round(elapsed, 4),
+            "fps": round(len(seq) / elapsed, 1),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        "latency_ms": percentiles([elapsed / len(seq)]),
+        "stages_ms": {},
+    }
+
+
+def run_ingest(args):
+    """
+    アップロードの読み込み → サムネイル → 縮小デコード → RGB 変換だけを測る（モデル不要）。
+    1巡目で時間を、2巡目で tracemalloc による1フレームあたりの一時確保量を測る。
+    ピーク RSS はプロセス全体なので、--no-reuse との比較は別々に実行すること。
+    """
+    import io
+    import cv2
+    from frame_preprocess import FrameBuffers, decode_frame, decode_thumbnail
+
+    source = load_jpegs(args.frames, args.limit)
+    print(f"{len(source)} frames loaded", file=sys.stderr)
+    buffers = None if args.no_reuse else FrameBuffers()
+
+    def ingest(jpg, times=None):
+        t0 = time.perf_counter()
+        stream = io.BytesIO(jpg)   # アップロードの本文の代わり
+        if buffers is None:
+            buf = stream.read()
+        else:
+            buf = buffers.read_stream(stream, len(jpg))
+        t1 = time.perf_counter()
+        decode_thumbnail(buf)
+        t2 = time.perf_counter()
+        frame = decode_frame(buf, args.max_side, buffers)
+        t3 = time.perf_counter()
+        if buffers is None:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        else:
+            buffers.to_rgb(frame)
+        t4 = time.perf_counter()
+        if times is not None:
+            for k, v in (("read", t1 - t0), ("thumbnail", t2 - t1), ("decode", t3 - t2),
+                         ("color", t4 - t3), ("total", t4 - t0)):
+                times[k].append(v)
+
+    times = {k: [] for k in ("read", "thumbnail", "decode", "color", "total")}
+    t_start = time.perf_counter()
+    for jpg in source:
+        ingest(jpg, times)
+    elapsed = time.perf_counter() - t_start
+
+    alloc = []
+    tracemalloc.start()
+    for jpg in source:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        ingest(jpg)
+        alloc.append((tracemalloc.get_traced_memory()[1] - base) / 1024)
+    tracemalloc.stop()
+
+    total = times.pop("total")
+    return {
+        "meta": {"mode": "ingest", "source": args.frames, "reuse": buffers is not None,
+                 "max_side": args.max_side, "commit": git_commit(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "summary": {
+            "frames": len(total),
+            "no_pose": 0,
+            "elapsed_s": round(elapsed, 4),
+            "fps": round(len(total) / elapsed, 2) if elapsed > 0 else 0.0,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "alloc_kb_per_frame": round(float(np.mean(alloc)), 1) if alloc else 0.0,
+            "alloc_mb_per_s": round(float(np.sum(alloc)) / 1024 / elapsed, 1) if elapsed > 0 else 0.0,
+            "buffer_grows": buffers.grows if buffers is not None else None,
+        },
+        "latency_ms": percentiles(total),
+        "stages_ms": {k: percentiles(v) for k, v in times.items()},
+    }
+
+
+class SyntheticPose:
+    """
+    推論の代わりに GIL を持ったまま ms ミリ秒 CPU を使い、固定のランドマークを返す
+    （--inference 用。推論プロセスで作れるよう inference_service の create_fn と同じ形）
+    """
+
+    ms = float(os.environ.get("BENCH_SYNTHETIC_MS", "30"))
+
+    def __init__(self, model_path, num_poses):
+        world, image = next(synthetic_landmarks(1))
+        self._res = type("Result", (), {"pose_world_landmarks": [world], "pose_landmarks": [image]})
+
+    def detect(self, rgb, timestamp_ms):
+        # 経過時間ではなくこのスレッドの CPU 時間で測る（GIL 待ちの間は進まない）
+        end = time.thread_time() + self.ms / 1000
+        int(rgb[::16, ::16].sum())   # 画素を読む
+        while time.thread_time() < end:
+            pass
+        return self._res
+
+    def detect_for_video(self, mp_img, timestamp_ms):
+        return self.detect(mp_img.numpy_view(), timestamp_ms)
+
+    def close(self):
+        pass
+
+
+def run_inference(args):
+    """
+    --clients 本のスレッドがそれぞれ1人分の解析器で解析し続け、スループットを測る。
+    同時に web 側の軽い処理（1ms ごとの短い処理）の遅れを測り、推論が GIL を取り合う影響を見る。
+    推論は SyntheticPose（モデル不要）。--inference-workers 0 ならリクエストのスレッドで推論する
+    """
+    import threading
+    from posture_check import PosePostureAnalyzer, PostureConfig
+    from inference_service import InferenceService
+
+    os.environ["BENCH_SYNTHETIC_MS"] = str(args.synthetic_ms)
+    SyntheticPose.ms = args.synthetic_ms
+    service = None
+    if args.inference_workers:
+        service = InferenceService(workers=args.inference_workers, slots=args.clients * 2,
+                                   slot_bytes=args.max_side * args.max_side * 3,
+                                   create_fn="bench:SyntheticPose")
+        service.start()
+        factory = service.detector
+    else:
+        factory = SyntheticPose
+
+    rng = np.random.default_rng(args.seed)
+    frame = rng.integers(0, 255, (args.max_side * 3 // 4, args.max_side, 3), dtype=np.uint8)
+    cfg = PostureConfig(roi_crop=False)
+    analyzers = [PosePostureAnalyzer(args.model, cfg, detector_factory=factory)
+                 for _ in range(args.clients)]
+    for a in analyzers:
+        a.analyze(frame)   # 推論器の作成を計測に入れない
+
+    stop = threading.Event()
+    lat = [[] for _ in analyzers]
+    probe = []
+
+    def client(i):
+        analyzer = analyzers[i]
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            analyzer.analyze(frame)
+            lat[i].append(time.perf_counter() - t0)
+
+    def web_probe():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            time.sleep(0.001)
+            probe.append(time.perf_counter() - t0 - 0.001)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    threads.append(threading.Thread(target=web_probe))
+    t_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+
+    for a in analyzers:
+        a.close()
+    if service is not None:
+        service.close()
+
+    total = [v for per in lat for v in per]
+    return {
+        "meta": {"mode": "inference", "inference_workers": args.inference_workers,
+                 "clients": args.clients, "synthetic_ms": args.synthetic_ms,
+                 "max_side": args.max_side, "commit": git_commit(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "summary": {
+            "frames": len(total),
+            "no_pose": 0,
+            "elapsed_s": round(elapsed, 4),
+            "fps": round(len(total) / elapsed, 2) if elapsed > 0 else 0.0,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "web_delay_ms": percentiles(probe),
+        },
+        "latency_ms": percentiles(total),
+        "stages_ms": {},
+    }
+
+
+# SQLite の既定の動作（storage.py の設定を入れる前と同じ）
+STORAGE_BASELINE = {
+    "SQLITE_JOURNAL_MODE": "delete",
+    "SQLITE_SYNCHRONOUS": "full",
+    "SQLITE_CACHE_SIZE_KB": 2000,
+    "SQLITE_MMAP_SIZE_MB": 0,
+    "DB_READ_SEPARATE": False,
+}
+
+
+def run_storage(args):
+    """
+    姿勢ログの書き込みと /logs の読み取りを同時に流す。
+      - 1本のスレッドが --write-rate 行/秒（0 = 詰まるまで）で log_writer に積む（本番と同じ一括 INSERT + 集計）
+      - --readers 本のスレッドが get_log_page（/logs と同じ処理）を繰り返す
+    書き込めた行数/秒と、読み取りの遅延・ロック待ちのエラーを測る
+    """
+    import threading
+    from datetime import datetime, timedelta
+
+    from sqlalchemy.exc import OperationalError
+
+    import rollups
+    from extensions import db, log_writer
+    from log_pages import get_log_page, invalidate_pages
+    from models.posture import PostureLog
+    from models.user import User
+
+    tmp = None
+    db_url = args.db_url
+    if db_url is None:
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        tmp.close()
+        db_url = "sqlite:///" + tmp.name
+    overrides = dict(STORAGE_BASELINE) if args.storage_baseline else {}
+    overrides["LOG_WRITER_FULL_POLICY"] = "block"
+    app, _ = make_app(db_url, overrides)
+    log_writer.add_listener(PostureLog.__table__, rollups.apply_rollups)
+    log_writer.add_listener(PostureLog.__table__, invalidate_pages)
+
+    # 読み取る履歴（ユーザーごとに 0.25 秒間隔で、今に向かって）
+    rng = np.random.default_rng(args.seed)
+    table = PostureLog.__table__
+    with app.app_context():
+        users = [User(username=f"bench{i}", password="-") for i in range(args.users)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [u.id for u in users]
+        per_user = args.history_rows // args.users
+        now = datetime.utcnow()
+        for uid in user_ids:
+            for i in range(0, per_user, 10000):
+                n = min(10000, per_user - i)
+                a = rng.normal(0, 10, (n, 3)).tolist()
+                rows = [{"user_id": uid, "posture": "good", "posture_type": "normal",
+                         "torso_angle": x, "neck_angle": y, "shoulder_tilt": z,
+                         "created_at": now - timedelta(seconds=(per_user - i - k) * 0.25)}
+                        for k, (x, y, z) in enumerate(a)]
+                db.session.execute(table.insert(), rows)
+                rollups.apply_rollups(db.session, rows)
+            db.session.commit()
+    log_writer.start()
+
+    stop = threading.Event()
+    read_lat = []
+    read_errors = [0]
+
+    def writer():
+        i = 0
+        t0 = time.perf_counter()
+        while not stop.is_set():
+            if args.write_rate and i >= (time.perf_counter() - t0) * args.write_rate:
+                time.sleep(0.001)
+                continue
+            log_writer.submit(table, {
+                "user_id": user_ids[i % len(user_ids)], "posture": "bad", "posture_type": "slouch",
+                "torso_angle": 12.0, "neck_angle": 20.0, "shoulder_tilt": 1.0,
+                "created_at": datetime.utcnow(),
+            })
+            i += 1
+
+    def reader(seed):
+        r = np.random.default_rng(seed)
+        while not stop.is_set():
+            uid = user_ids[int(r.integers(len(user_ids)))]
+            page = int(r.integers(1, 6))
+            t0 = time.perf_counter()
+            try:
+                with app.app_context():
+                    get_log_page(uid, page)
+            except OperationalError:
+                read_errors[0] += 1
+                continue
+            read_lat.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=reader, args=(args.seed + i,)) for i in range(args.readers)]
+    written0 = log_writer.written
+    t_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    written = log_writer.written - written0
+    elapsed = time.perf_counter() - t_start
+    stop.set()
+    for t in threads:
+        t.join()
+    writer_stats = log_writer.stats()
+    log_writer.stop()
+
+    with app.app_context():
+        with db.engine.connect() as conn:
+            journal = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+        db.engine.dispose()
+    if tmp is not None:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(tmp.name + suffix):
+                os.unlink(tmp.name + suffix)
+
+    return {
+        "meta": {"mode": "storage", "baseline": args.storage_baseline, "journal_mode": journal,
+                 "readers": args.readers, "write_rate": args.write_rate,
+                 "history_rows": args.history_rows, "users": args.users,
+                 "commit": git_commit(), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "summary": {
+            "frames": len(read_lat),
+            "no_pose": 0,
+            "elapsed_s": round(elapsed, 4),
+            "fps": round(len(read_lat) / elapsed, 2) if elapsed > 0 else 0.0,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "rows_written_per_s": round(written / elapsed, 1),
+            "write_errors": writer_stats["errors"],
+            "flush_ms": {"avg": writer_stats["avg_flush_ms"], "max": writer_stats["max_flush_ms"]},
+            "read_errors": read_errors[0],
+        },
+        "latency_ms": percentiles(read_lat),
+        "stages_ms": {},
+    }
+
+
+def _smaps_rollup(pid):
+    """/proc/<pid>/smaps_rollup の Rss / Pss / Private（= このプロセスだけが使う分）を MB で"""
+    vals = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                vals[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss_mb": round(vals.get("Rss", 0.0), 1),
+        "pss_mb": round(vals.get("Pss", 0.0), 1),
+        "private_mb": round(vals.get("Private_Clean", 0.0) + vals.get("Private_Dirty", 0.0), 1),
+    }
+
+
+def run_startup(args):
+    """
+    serve.py を起動し、最初の応答が返るまでの時間と、ワーカーごとのメモリを測る。
+    全ワーカーが起動した後（と --requests 回リクエストした後）の値を読む
+    """
+    import socket
+    import urllib.request
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    tmp.close()
+    cmd = [sys.executable, os.path.join(BASE_DIR, "serve.py"), "--host", "127.0.0.1",
+           "--port", str(port), "--workers", str(args.workers), "--db-url", "sqlite:///" + tmp.name]
+    if args.no_preload:
+        cmd.append("--no-preload")
+
+    url = f"http://127.0.0.1:{port}/capture_config"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first = None
+        while first is None and time.perf_counter() - t0 < 120:
+            try:
+                urllib.request.urlopen(url, timeout=1).read()
+                first = time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.01)
+        if first is None:
+            raise RuntimeError("server did not respond within 120s")
+
+        children = []
+        while len(children) < args.workers and time.perf_counter() - t0 < 120:
+            with open(f"/proc/{proc.pid}/task/{proc.pid}/children") as f:
+                children = [int(p) for p in f.read().split()]
+            time.sleep(0.05)
+        lat = []
+        for _ in range(args.requests):
+            t1 = time.perf_counter()
+            urllib.request.urlopen(url, timeout=5).read()
+            lat.append(time.perf_counter() - t1)
+        time.sleep(0.5)
+        master = _smaps_rollup(proc.pid)
+        workers = [_smaps_rollup(pid) for pid in children]
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        os.unlink(tmp.name)
+
+    def mean(key):
+        return round(float(np.mean([w[key] for w in workers])), 1) if workers else 0.0
+
+    return {
+        "meta": {"mode": "startup", "workers": args.workers, "preload": not args.no_preload,
+                 "commit": git_commit(), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "summary": {
+            "frames": len(lat),
+            "no_pose": 0,
+            "fps": 0.0,
+            "peak_rss_mb": master["rss_mb"],
+            "first_response_s": round(first, 3),
+            "master": master,
+            "worker_rss_mb": mean("rss_mb"),
+            "worker_pss_mb": mean("pss_mb"),
+            "worker_private_mb": mean("private_mb"),
+            "total_pss_mb": round(master["pss_mb"] + sum(w["pss_mb"] for w in workers), 1),
+        },
+        "latency_ms": percentiles(lat or [0.0]),
+        "stages_ms": {},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# =========================
+# 表示・比較
+# =========================
+def print_report(result, base=None):
+    s = result["summary"]
+    print(f"frames={s['frames']} no_pose={s['no_pose']} fps={s['fps']} "
+          f"peak_rss={s['peak_rss_mb']}MB")
+    if "web_delay_ms" in s:
+        d = s["web_delay_ms"]
+        print(f"web-side delay: p50={d['p50']:.3f}ms p95={d['p95']:.3f}ms p99={d['p99']:.3f}ms")
+    if "rows_written_per_s" in s:
+        line = (f"writes={s['rows_written_per_s']}rows/s flush avg={s['flush_ms']['avg']}ms "
+                f"max={s['flush_ms']['max']}ms write_errors={s['write_errors']} "
+                f"reads={s['fps']}/s read_errors={s['read_errors']}")
+        if base is not None and "rows_written_per_s" in base["summary"]:
+            line += f"  Δwrites={_pct(s['rows_written_per_s'], base['summary']['rows_written_per_s'])}"
+        print(line)
+    if "first_response_s" in s:
+        print(f"first_response={s['first_response_s']}s  per worker: rss={s['worker_rss_mb']}MB "
+              f"pss={s['worker_pss_mb']}MB private={s['worker_private_mb']}MB  "
+              f"total_pss={s['total_pss_mb']}MB")
+    if "alloc_kb_per_frame" in s:
+        line = f"alloc={s['alloc_kb_per_frame']}KB/frame ({s['alloc_mb_per_s']}MB/s)"
+        if base is not None and "alloc_kb_per_frame" in base["summary"]:
+            b = base["summary"]
+            line += (f"  Δalloc={_pct(s['alloc_kb_per_frame'], b['alloc_kb_per_frame'])}"
+                     f"  Δpeak_rss={_pct(s['peak_rss_mb'], b['peak_rss_mb'])}")
+        print(line)
+
+    rows = [("total", result["latency_ms"])] + list(result["stages_ms"].items())
+    base_rows = {}
+    if base is not None:
+        base_rows = dict([("total", base["latency_ms"])] + list(base["stages_ms"].items()))
+
+    print(f"{'stage':<14}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}" +
+          (f"{'Δp50':>10}{'Δp95':>10}" if base is not None else ""))
+    for name, st in rows:
+        line = f"{name:<14}{st['mean']:>10.3f}{st['p50']:>10.3f}{st['p95']:>10.3f}{st['p99']:>10.3f}"
+        if name in base_rows:
+            b = base_rows[name]
+            line += f"{_pct(st['p50'], b['p50']):>10}{_pct(st['p95'], b['p95']):>10}"
+        print(line)
+
+
+def _pct(new, old):
+    if not old:
+        return "-"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="姿勢解析パイプラインのベンチマーク")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--startup", action="store_true", help="serve.py の起動時間とワーカーのメモリ")
+    src.add_argument("--inference", action="store_true", help="推論プロセスのスループットと web 側の遅れ")
+    src.add_argument("--storage", action="store_true", help="書き込み中の /logs の読み取り遅延と書き込み速度")
+    src.add_argument("--frames", help="JPEG のディレクトリまたは動画ファイル")
+    src.add_argument("--synthetic", type=int, metavar="N", help="合成ランドマークで N フレーム")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--limit", type=int, default=0, help="読み込むフレーム数の上限")
+    parser.add_argument("--max-side", type=int, default=640)
+    parser.add_argument("--db", choices=("none", "sync", "async"), default="async")
+    parser.add_argument("--db-url", default=None, help="既定は一時 SQLite ファイル")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracking", action="store_true", help="キーフレーム推論 + 追跡で解析する")
+    parser.add_argument("--keyframe-interval", type=int, default=8)
+    parser.add_argument("--batch", action="store_true", help="--synthetic と併用: analyze_batch で一括処理")
+    parser.add_argument("--ingest", action="store_true", help="--frames と併用: 受信〜RGB 変換だけを測る")
+    parser.add_argument("--no-reuse", action="store_true", help="--ingest と併用: バッファを使い回さない")
+    parser.add_argument("--workers", type=int, default=1, help="--startup のワーカー数（serve.py の上限まで）")
+    parser.add_argument("--no-preload", action="store_true", help="--startup と併用: fork 前に読み込まない")
+    parser.add_argument("--requests", type=int, default=20, help="--startup で起動後に送るリクエスト数")
+    parser.add_argument("--inference-workers", type=int, default=0,
+                        help="--inference の推論プロセス数（0 = スレッドで推論）")
+    parser.add_argument("--clients", type=int, default=8, help="--inference で同時に解析するスレッド数")
+    parser.add_argument("--synthetic-ms", type=float, default=30.0, help="--inference の1回の推論時間")
+    parser.add_argument("--duration", type=float, default=5.0, help="--inference / --storage の計測秒数")
+    parser.add_argument("--readers", type=int, default=4, help="--storage の読み取りスレッド数")
+    parser.add_argument("--write-rate", type=float, default=0.0, help="--storage の書き込み行/秒（0 = 上限まで）")
+    parser.add_argument("--history-rows", type=int, default=200000, help="--storage で先に入れておく行数")
+    parser.add_argument("--users", type=int, default=8, help="--storage のユーザー数")
+    parser.add_argument("--storage-baseline", action="store_true",
+                        help="--storage と併用: SQLite の既定（ロールバックジャーナル・読み書き同じ接続）")
+    parser.add_argument("--out", help="結果を JSON で保存")
+    parser.add_argument("--compare", help="比較対象の JSON")
+    args = parser.parse_args()
+
+    if args.batch and args.synthetic is None:
+        parser.error("--batch は --synthetic と一緒に指定してください")
+    if args.ingest and args.frames is None:
+        parser.error("--ingest は --frames と一緒に指定してください")
+    if args.startup:
+        result = run_startup(args)
+    elif args.inference:
+        result = run_inference(args)
+    elif args.storage:
+        result = run_storage(args)
+    elif args.batch:
+        result = run_batch_replay(args)
+    elif args.ingest:
+        result = run_ingest(args)
+    else:
+        result = run(args)
+
+    base = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            base = json.load(f)
+    print_report(result, base)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
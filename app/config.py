@@ -10,7 +10,106 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # =========================
 class Config:
     SECRET_KEY = "dev-key"
-    SQLALCHEMY_DATABASE_URI = (
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL") or (
         "sqlite:///" + os.path.join(BASE_DIR, "database.db")
     )
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # ---- DB の接続（storage.py） ----
+    DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")   # 読み取り専用の接続先（None = 同じ DB）
+    DB_READ_SEPARATE = True              # 読み取りを別の接続プールで行う（False で書き込みと共用）
+    DB_POOL_SIZE = 5                     # 書き込み用の接続数
+    DB_READ_POOL_SIZE = 10               # 読み取り用の接続数
+    DB_MAX_OVERFLOW = 10                 # 足りない時に一時的に増やせる数
+    DB_POOL_RECYCLE_S = 1800             # サーバー DB: これより古い接続は作り直す
+    SQLITE_JOURNAL_MODE = "wal"          # "delete" で SQLite の既定（ロールバックジャーナル）
+    SQLITE_SYNCHRONOUS = "normal"        # "full" で SQLite の既定（コミットごとに fsync）
+    SQLITE_CACHE_SIZE_KB = 16384         # 接続ごとのページキャッシュ
+    SQLITE_MMAP_SIZE_MB = 64             # メモリマップで読む上限（0 = 使わない）
+    SQLITE_BUSY_TIMEOUT_MS = 5000        # 書き込みのロック待ちの上限
+
+    # ---- 姿勢解析器プール ----
+    ANALYZER_POOL_MAX_SESSIONS = 8                        # 常駐させる landmarker の上限
+    ANALYZER_POOL_MAX_INFLIGHT = os.cpu_count() or 2      # 同時推論数
+    ANALYZER_POOL_MAX_QUEUE = 16                          # 待ち行列の上限（超えたら 429）
+    ANALYZER_POOL_QUEUE_TIMEOUT = 2.0                     # 枠待ちの最大秒数
+    ANALYZER_POOL_IDLE_TTL = 600.0                        # これ以上使われないセッションは破棄
+    ANALYZER_POOL_MAX_BASELINES = 4096                    # 破棄したセッションの baseline を残す数
+
+    # ---- 姿勢ログの非同期書き込み ----
+    LOG_WRITER_BATCH_SIZE = 200          # この行数たまったら書き込む
+    LOG_WRITER_FLUSH_MS = 500            # 最大でこの間隔ごとに書き込む
+    LOG_WRITER_QUEUE_SIZE = 10000        # キューの上限
+    LOG_WRITER_FULL_POLICY = "drop"      # 満杯時: "drop" / "block"
+    LOG_WRITER_BLOCK_TIMEOUT = 1.0       # "block" 時の最大待ち秒数
+
+    # ---- フレーム前処理 ----
+    INFERENCE_MAX_SIDE = 640             # 推論に使う画像の長辺の上限（px）
+    MAX_FRAME_BYTES = 8 * 2**20          # 1枚の画像・/ingest の本文の上限（超えたら 413）
+    SOCK_SERVER_OPTIONS = {"max_message_size": MAX_FRAME_BYTES}   # /ws/analyze の1メッセージの上限
+    CLIENT_JPEG_QUALITY = 0.8            # ブラウザ側の JPEG 品質
+
+    # ---- 共有カメラ（複数人モード） ----
+    CAMERA_POOL_MAX_SESSIONS = 4         # 常駐させるカメラの解析器の上限
+    CAMERA_MAX_POSES = 6                 # 1台のカメラで同時に見る最大人数
+    CAMERA_INFERENCE_MAX_SIDE = 1280     # 席が小さく映るので1人用より大きめ
+
+    # ---- 端末側推論の結果の受け付け（/ingest） ----
+    INGEST_POOL_MAX_SESSIONS = 1024      # 推論器を持たないので軽い（EMA / 人ロックの状態だけ）
+    INGEST_POOL_MAX_INFLIGHT = 8
+    INGEST_MAX_SAMPLES = 600             # 1リクエストでまとめて送れる件数
+    INGEST_MAX_AGE_S = 3600              # これより古い計測時刻は受け付けない
+
+    # ---- キーフレーム推論 + 追跡 ----
+    # 追跡したフレームは z がキーフレームのままなので、角度・判定はキーフレームの値を返し保存しない。
+    # 推論の回数は減るが記録の間隔も keyframe_interval 倍に粗くなるので、既定は無効
+    ANALYZER_TRACKING = False            # キーフレームの間はオプティカルフローで追う
+    ANALYZER_KEYFRAME_INTERVAL = 8       # 追跡で済ませる最大フレーム数
+
+    # ---- 静止シーンの使い回し・ポーリング間隔 ----
+    STATIC_SKIP = True                   # 画面が変わらなければ前回の結果を返す（推論・保存なし）
+    STATIC_MAX_REUSE_S = 30.0            # 静止していてもこの秒数ごとには解析・保存する
+    POLL_MIN_MS = 200                    # クライアントに提案する間隔の範囲
+    POLL_MAX_MS = 5000
+
+    # ---- 推論プロセス（inference_service.py） ----
+    # 0 = リクエストのスレッドで推論する / N = N 個の推論専用プロセス / -1 = 物理コア数
+    # serve.py で web のワーカーを複数にすると、ワーカーごとにこの数のプロセスを持つ
+    INFERENCE_WORKERS = 0
+    INFERENCE_RING_SLOTS = 16            # 共有メモリに同時に置けるフレーム数
+    INFERENCE_TIMEOUT_S = 2.0            # 1フレームの結果を待つ最大秒数（超えたら 503）
+    INFERENCE_HEALTH_INTERVAL_S = 5.0    # 推論プロセスへの ping の間隔
+    INFERENCE_HEALTH_TIMEOUT_S = 10.0    # 仕事があるのにこれだけ応答が無ければ作り直す
+
+    # ---- 起動 ----
+    WARMUP_SESSIONS = 1                  # 起動時に作ってダミー推論しておく1人用の解析器の数
+
+    # ---- 負荷に応じたモデルの切り替え ----
+    # static/models/pose_landmarker_<名前>.task が2つ以上ある時だけ切り替える
+    MODEL_TIERS = ("lite", "full", "heavy")
+    MODEL_START_TIER = "full"
+    MODEL_TIER_SLO_MS = 80.0             # 推論時間の目標（移動平均がこれを超えたら軽くする）
+    MODEL_TIER_QUEUE_HIGH = 4            # 解析器の空き待ちがこれ以上なら軽くする
+
+    # ---- 計測 ----
+    METRICS_TRACE_SAMPLE = 0.0           # 段階別の内訳をログに出すリクエストの割合（0〜1）
+
+    # ---- 古いログの整理（retention.py） ----
+    # 生ログを消すので既定では動かさない。環境変数 RETENTION_ENABLED=1（または設定で True）で有効にする。
+    # 有効にする前に python app/retention.py --dry-run で消える件数を確かめること
+    RETENTION_ENABLED = os.environ.get("RETENTION_ENABLED") == "1"   # バックグラウンドで定期実行する
+    RETENTION_RAW_DAYS = 90              # 生ログを残す日数（以降はアーカイブ + 集計のみ）
+    RETENTION_MINUTE_ROLLUP_DAYS = 400   # 分集計を残す日数（時・日の集計は残す）
+    RETENTION_INTERVAL_S = 6 * 3600      # 実行間隔
+    RETENTION_CHUNK_SIZE = 2000          # 1トランザクションで消す行数
+    RETENTION_PART_ROWS = 100_000        # アーカイブ1ファイルの行数（メモリに持つのはこの分だけ）
+    RETENTION_ARCHIVE_DIR = os.path.join(BASE_DIR, "archive")
+
+    # ---- エクスポート（export.py / GET /export） ----
+    EXPORT_CHUNK_SIZE = 10000            # 1回のクエリで読む行数（メモリはこの分だけ）
+
+    # ---- 録画ファイルの一括解析 ----
+    BATCH_WORKERS = None                 # プロセス数（None = CPU コア数）
+    BATCH_SAMPLE_FPS = 5.0               # 解析するフレームレート（0 = 全フレーム）
+    BATCH_MAX_CONCURRENT_JOBS = 1        # 同時に走らせるジョブ数
+    BATCH_JOB_TTL_S = 3600               # 終わったジョブの状態を /batch/<job_id> で見られる時間
@@ -0,0 +1,433 @@
+# ========================
+# export.py
+# ========================
+#
+# 姿勢ログの一括エクスポート（全履歴をメモリに載せずに流す）
+#
+#   python app/export.py --user alice > alice.csv
+#   python app/export.py --user alice --format ndjson -o alice.ndjson --start 2026-01-01
+#   python app/export.py --all --format npz -o all.npz
+#   python app/export.py --user alice -o alice.csv --resume     # 途中で切れたファイルに続きを追記
+#
+#   アプリからは GET /export（同じ形式・同じ条件）
+#
+#   形式
+#     csv    : 見出し行 + 1行1件（角度は小数6桁）
+#     ndjson : 1行1件の JSON（角度は小数6桁）
+#     npz    : chunk_size 行ごとの列を <チャンク番号>/<列名>.npy として持つ zip（列ごとに deflate）。
+#              posture / posture_type は番号 + <列名>_vocab。read_npz() で1つにまとめて読める
+#   並び順は (user_id, created_at, id)。どの形式の行にもこの3つが入っているので、
+#   途中で切れても最後の行から resume_token() を作って続き（after）を頼める。
+#
+#   retention.py で posture_log から消してアーカイブへ移した行も、同じ並び順に混ぜて返す
+#   （iter_history。アーカイブはユーザー × 月ごとに1か月分ずつ読む。archive_dir を渡さなければ
+#   posture_log にある行だけ）。
+#
+#   読み取りは chunk_size 行ごとに、索引 (user_id, created_at) の続きから読む別々のクエリにする。
+#   1本のカーソルを開いたままにすると、遅いクライアントを待つ間ずっと SQLite の読み取りロックが
+#   残り、姿勢ログの書き込みを待たせてしまうため。
+#   行ごとの Python の処理が律速なので、created_at は DB の文字列のまま受け取り（SQLite）、
+#   テキスト形式はチャンク単位の % 書式でまとめて作る。
+
+import argparse
+import csv
+import heapq
+import io
+import json
+import math
+import os
+import re
+import sys
+import zipfile
+from datetime import datetime
+from itertools import chain
+
+import numpy as np
+import sqlalchemy as sa
+
+import retention
+from models.posture import PostureLog
+from rollups import parse_utc
+
+COLUMNS = ("user_id", "created_at", "id", "posture", "posture_type",
+           "torso_angle", "neck_angle", "shoulder_tilt")
+TEXT_COLUMNS = ("posture", "posture_type")
+FLOAT_COLUMNS = ("torso_angle", "neck_angle", "shoulder_tilt")
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "npz": ("application/zip", "npz"),
+}
+
+
+# =========================
+# 続きから読むための位置
+# =========================
+def resume_token(user_id, created_at, row_id):
+    """最後に受け取った行の (user_id, created_at, id) を after に渡せる文字列にする"""
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat(sep=" ")
+    return f"{user_id},{created_at},{row_id}"
+
+
+def parse_token(token):
+    """resume_token の逆。形式が違えば ValueError"""
+    user_id, created_at, row_id = token.split(",")
+    return int(user_id), datetime.fromisoformat(created_at), int(row_id)
+
+
+# =========================
+# 読み取り
+# =========================
+def iter_chunks(engine, user_id=None, start=None, end=None, after=None, chunk_size=10000):
+    """
+    条件に合う行を chunk_size 行ずつのリスト（COLUMNS の順のタプル）で返す。
+    created_at は "YYYY-MM-DD HH:MM:SS.ffffff" の文字列。
+    after=(user_id, created_at, id) ならその次の行から
+    """
+    log = PostureLog.__table__
+    key = (log.c.user_id, log.c.created_at, log.c.id)
+    # SQLite は日時を文字列で持っているので、行ごとに datetime にしない
+    cols = [sa.type_coerce(log.c[c], sa.String).label(c) if c == "created_at" else log.c[c]
+            for c in COLUMNS]
+    base = sa.select(*cols).order_by(*key).limit(chunk_size)
+    if user_id is not None:
+        base = base.where(log.c.user_id == user_id)
+    if start is not None:
+        base = base.where(log.c.created_at >= start)
+    if end is not None:
+        base = base.where(log.c.created_at < end)
+
+    while True:
+        q = base if after is None else base.where(sa.tuple_(*key) > sa.tuple_(*after))
+        # チャンクごとに接続を返す（読み取りのトランザクションを流している間じゅう持たない）
+        with engine.connect() as conn:
+            rows = conn.execute(q).all()
+        if not rows:
+            return
+        if not isinstance(rows[0][1], str):
+            # 日時型を持つ DB では datetime で返ってくる
+            rows = [(r[0], _ts(r[1]), *r[2:]) for r in rows]
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        u, c, i = rows[-1][:3]
+        after = (u, datetime.fromisoformat(c), i)
+
+
+def _ts(v):
+    return None if v is None else v.isoformat(sep=" ", timespec="microseconds")
+
+
+def _archived_users(archive_dir):
+    if not os.path.isdir(archive_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(archive_dir) if name.isdigit())
+
+
+def iter_archive_chunks(archive_dir, user_id=None, start=None, end=None, after=None,
+                        chunk_size=10000):
+    """
+    retention.py のアーカイブから、条件に合う行を iter_chunks と同じ形・同じ並び順で返す。
+    メモリに載せるのは1ユーザーの1か月分だけ
+    """
+    users = [user_id] if user_id is not None else _archived_users(archive_dir)
+    for uid in users:
+        if after is not None and uid < after[0]:
+            continue
+        since = after[1:] if after is not None and uid == after[0] else None
+        for month in retention.archived_months(archive_dir, uid):
+            nxt = retention.next_month(month)
+            if ((start is not None and nxt <= start) or (end is not None and month >= end)
+                    or (since is not None and nxt <= since[0])):
+                continue
+            cols = retention.read_month(archive_dir, uid, month)
+            t = cols["created_at"]
+            keep = np.ones(len(t), bool)
+            if start is not None:
+                keep &= t >= np.datetime64(start, "us")
+            if end is not None:
+                keep &= t < np.datetime64(end, "us")
+            if since is not None:
+                c = np.datetime64(since[0], "us")
+                keep &= (t > c) | ((t == c) & (cols["id"] > since[1]))
+            if not keep.any():
+                continue
+            created_at = np.char.replace(np.datetime_as_string(t[keep], unit="us"), "T", " ")
+            # アーカイブの NaN は元の NULL
+            floats = [np.where(np.isnan(cols[c][keep]), None, cols[c][keep]).tolist()
+                      for c in FLOAT_COLUMNS]
+            rows = list(zip([uid] * len(created_at), created_at.tolist(), cols["id"][keep].tolist(),
+                            cols["posture"][keep].tolist(), cols["posture_type"][keep].tolist(),
+                            *floats))
+            for i in range(0, len(rows), chunk_size):
+                yield rows[i:i + chunk_size]
+
+
+def iter_history(engine, archive_dir=None, user_id=None, start=None, end=None, after=None,
+                 chunk_size=10000):
+    """
+    iter_chunks に archive_dir のアーカイブの行を (user_id, created_at, id) の順で混ぜる。
+    アーカイブの書き出し後・削除前に止まって両方にある行は1回だけ返す
+    """
+    live = iter_chunks(engine, user_id, start, end, after, chunk_size)
+    archived = (iter_archive_chunks(archive_dir, user_id, start, end, after, chunk_size)
+                if archive_dir else iter(()))
+    first = next(archived, None)
+    if first is None:
+        yield from live
+        return
+
+    rows = heapq.merge(chain(first, chain.from_iterable(archived)),
+                       chain.from_iterable(live), key=lambda r: r[:3])
+    chunk = []
+    prev = None
+    for row in rows:
+        key = row[:3]
+        if key == prev:
+            continue
+        prev = key
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# =========================
+# 形式ごとの書き出し（チャンクごとに bytes を返す）
+# =========================
+_PLAIN = re.compile(r'[^,"\r\n]*')   # CSV で引用符が要らない文字列
+_CSV_ROW = "%d,%s,%d,%s,%s,%.6f,%.6f,%.6f\n"
+
+
+def _f6(v):
+    return "" if v is None else f"{v:.6f}"
+
+
+def _csv_text(rows, buf, writer):
+    """1チャンク分の CSV。文字列に , や " が無く、角度に NULL が無ければ % 書式でまとめて作る"""
+    texts = {r[3] for r in rows} | {r[4] for r in rows}
+    if all(t is not None and _PLAIN.fullmatch(t) for t in texts):
+        try:
+            return "".join([_CSV_ROW % r for r in rows])
+        except TypeError:
+            pass   # 角度が NULL の行がある
+    writer.writerows([(*r[:5], _f6(r[5]), _f6(r[6]), _f6(r[7])) for r in rows])
+    text = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return text
+
+
+def encode_csv(chunks, header=True):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    if header:
+        yield (",".join(COLUMNS) + "\n").encode()
+    for rows in chunks:
+        yield _csv_text(rows, buf, writer).encode()
+
+
+def _num(v):
+    return "null" if v is None or not math.isfinite(v) else f"{v:.6f}"
+
+
+def encode_ndjson(chunks):
+    # posture / posture_type の組は種類が少ないので、その部分の JSON を使い回す
+    labels = {}
+
+    def label(p, t):
+        out = labels.get((p, t))
+        if out is None:
+            out = labels[(p, t)] = (f'"posture":{json.dumps(p, ensure_ascii=False)},'
+                                    f'"posture_type":{json.dumps(t, ensure_ascii=False)}')
+        return out
+
+    fast = ('{"user_id":%d,"created_at":"%s","id":%d,%s,'
+            '"torso_angle":%.6f,"neck_angle":%.6f,"shoulder_tilt":%.6f}\n')
+    slow = ('{"user_id":%d,"created_at":%s,"id":%d,%s,'
+            '"torso_angle":%s,"neck_angle":%s,"shoulder_tilt":%s}\n')
+    for rows in chunks:
+        text = None
+        try:
+            text = "".join([fast % (u, c, i, label(p, t), a, n, tl)
+                            for u, c, i, p, t, a, n, tl in rows])
+        except TypeError:
+            pass   # 角度や日時が NULL の行がある
+        # % 書式は inf / nan をそのまま書く（JSON にならない）
+        if text is None or "inf" in text or "nan" in text:
+            text = "".join([slow % (u, json.dumps(c), i, label(p, t), _num(a), _num(n), _num(tl))
+                            for u, c, i, p, t, a, n, tl in rows])
+        yield text.encode()
+
+
+def _chunk_columns(rows):
+    cols = dict(zip(COLUMNS, zip(*rows)))
+    out = {
+        "user_id": np.array(cols["user_id"], np.int64),
+        "created_at": np.array(cols["created_at"], "datetime64[us]"),
+        "id": np.array(cols["id"], np.int64),
+    }
+    for c in FLOAT_COLUMNS:
+        out[c] = np.array(cols[c], np.float64)   # None は NaN になる
+    for c in TEXT_COLUMNS:
+        vocab, codes = np.unique(np.array([v or "" for v in cols[c]], dtype=str), return_inverse=True)
+        out[c] = codes.astype(np.uint8 if len(vocab) < 256 else np.int32)
+        out[c + "_vocab"] = vocab
+    return out
+
+
+class _Sink:
+    """zipfile が書いたバイト列を溜め、チャンクを書き終えるたびに取り出す（seek できない出力）"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+def encode_npz(chunks, compresslevel=1):
+    """compresslevel: deflate の強さ（1 でも列ごとなので十分縮む。上げると遅くなる）"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        for n, rows in enumerate(chunks):
+            for name, arr in _chunk_columns(rows).items():
+                with zf.open(f"{n:06d}/{name}.npy", "w") as f:
+                    np.lib.format.write_array(f, arr, allow_pickle=False)
+            yield sink.take()
+    yield sink.take()   # 末尾の中央ディレクトリ
+
+
+ENCODERS = {"csv": encode_csv, "ndjson": encode_ndjson, "npz": encode_npz}
+
+
+def read_npz(file):
+    """encode_npz の出力を {列名: 配列} にまとめて読む（文字列の列は復元済み）"""
+    parts = {}
+    with np.load(file) as z:
+        for key in sorted(z.files):
+            chunk, name = key.split("/")
+            parts.setdefault(chunk, {})[name] = z[key]
+    out = {c: [] for c in COLUMNS}
+    for cols in parts.values():
+        for c in TEXT_COLUMNS:
+            cols[c] = cols.pop(c + "_vocab")[cols[c]]
+        for c in COLUMNS:
+            out[c].append(cols[c])
+    return {c: np.concatenate(v) if v else np.array([]) for c, v in out.items()}
+
+
+# =========================
+# CLI
+# =========================
+def _last_line(path):
+    """
+    最後まで書けている行のうち最後のもの（末尾から少しずつ読む）。
+    途中で切れた書きかけの行はファイルから切り捨てる
+    """
+    with open(path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        tail = b""
+        while pos > 0 and tail.count(b"\n") < 2:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+        cut = tail.rfind(b"\n") + 1
+        if pos + cut < end:
+            f.truncate(pos + cut)
+    lines = tail[:cut].rstrip(b"\n").split(b"\n")
+    return lines[-1].decode() if lines and lines[-1] else None
+
+
+def token_from_output(path, fmt):
+    """途中まで書いた csv / ndjson の最後の行から、続きの位置を作る（無ければ None）"""
+    line = _last_line(path)
+    if line is None:
+        return None
+    if fmt == "ndjson":
+        row = json.loads(line)
+        return resume_token(row["user_id"], row["created_at"], row["id"])
+    values = next(csv.reader([line]))
+    if values == list(COLUMNS):
+        return None   # 見出し行だけ
+    return resume_token(*values[:3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="姿勢ログを csv / ndjson / npz に書き出す")
+    who = parser.add_mutually_exclusive_group(required=True)
+    who.add_argument("--user", help="ユーザー名")
+    who.add_argument("--all", action="store_true", help="全ユーザー")
+    parser.add_argument("--format", choices=sorted(ENCODERS), default="csv")
+    parser.add_argument("--start", type=parse_utc, help="この時刻以降（UTC）")
+    parser.add_argument("--end", type=parse_utc, help="この時刻より前（UTC）")
+    parser.add_argument("--after", help="この位置の次から（resume_token）")
+    parser.add_argument("--resume", action="store_true", help="-o のファイルの最後の行の続きから追記する")
+    parser.add_argument("-o", "--output", help="出力先（既定は標準出力）")
+    parser.add_argument("--chunk-size", type=int, default=None, help="1回に読む行数（既定は設定値）")
+    args = parser.parse_args()
+
+    if args.resume and (args.output is None or args.format == "npz"):
+        parser.error("--resume は -o の csv / ndjson にだけ使えます")
+
+    from flask import Flask
+    from config import Config
+    from extensions import storage
+    from models.user import User
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    storage.init_app(app)
+
+    with app.app_context():
+        user_id = None
+        if args.user:
+            user = User.query.filter_by(username=args.user).first()
+            if user is None:
+                parser.error(f"ユーザーがいません: {args.user}")
+            user_id = user.id
+        engine = storage.read_engine
+
+    after = args.after
+    append = args.resume and os.path.exists(args.output)
+    if append:
+        after = token_from_output(args.output, args.format) or after
+    try:
+        after = parse_token(after) if after else None
+    except ValueError:
+        parser.error(f"位置の形式が違います: {after}")
+
+    chunks = iter_history(engine, app.config["RETENTION_ARCHIVE_DIR"], user_id,
+                          args.start, args.end, after,
+                          args.chunk_size or app.config["EXPORT_CHUNK_SIZE"])
+    if args.format == "csv":
+        stream = encode_csv(chunks, header=not append or os.path.getsize(args.output) == 0)
+    else:
+        stream = ENCODERS[args.format](chunks)
+
+    out = open(args.output, "ab" if append else "wb") if args.output else sys.stdout.buffer
+    try:
+        for data in stream:
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,19 @@
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from flask_sock import Sock
+
+from log_writer import PostureLogWriter
+from storage import Storage
 
 # ========================
 # Flask拡張機能の初期化
 # ========================
 db = SQLAlchemy()
+storage = Storage(db)   # 接続の設定と読み取り用の接続（db.init_app の代わりに storage.init_app）
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"
+log_writer = PostureLogWriter(db)
+sock = Sock()
 
 
@@ -0,0 +1,264 @@
+# ========================
+# frame_preprocess.py
+# ========================
+#
+# 推論前のフレーム前処理
+#   - JPEG を縮小デコード（IMREAD_REDUCED_COLOR_*）して推論解像度まで落とす
+#   - 静止判定用のサムネイルを作る
+#   - 前フレームの人物位置から ROI を決めて切り出す（少し動いただけなら同じ範囲のまま）
+#   - アップロード・縮小後の画像・RGB 変換先のバッファをスレッドごとに使い回す
+#     （HIGH_WATER_BYTES を超えて広げた領域は、次に小さい要求が来た時に手放す）
+
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# SOF マーカー（DHT / JPG / DAC は除く）
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# これより大きい領域はスレッドに持ち続けない（たまに来る大きな画像でメモリが増えたままにしない）
+HIGH_WATER_BYTES = 4 * 2**20
+
+
+class UploadTooLarge(ValueError):
+    """アップロードが上限を超えた"""
+
+
+def jpeg_size(buf):
+    """JPEG ヘッダだけを読んで (幅, 高さ) を返す。JPEG でなければ None"""
+    data = memoryview(buf)[:65536]   # コピーせずに読む（bytes / uint8 配列のどちらでも）
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    n = len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:          # 埋め草
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        seg_len = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in _SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            h, w = struct.unpack(">HH", data[i + 5:i + 9])
+            return w, h
+        i += 2 + seg_len
+    return None
+
+
+def _as_uint8(buf):
+    return buf if isinstance(buf, np.ndarray) else np.frombuffer(buf, np.uint8)
+
+
+def decode_frame(buf, max_side=None, buffers=None):
+    """
+    画像バイト列を BGR 画像にデコードする。
+    max_side を指定すると長辺がそれ以下になるよう縮小する。
+    JPEG なら 1/2, 1/4, 1/8 の縮小デコードを使うので、フル解像度の展開をしない。
+    buffers（FrameBuffers）を渡すと縮小結果をそのバッファに書く（次の呼び出しで上書きされる）
+    """
+    arr = _as_uint8(buf)
+    if arr.size == 0:
+        return None   # 空の本文（imdecode は例外を投げる）
+    flag = cv2.IMREAD_COLOR
+
+    if max_side:
+        size = jpeg_size(buf)
+        if size is not None:
+            long_side = max(size)
+            for factor, reduced in REDUCED_FLAGS:
+                if long_side // factor >= max_side:
+                    flag = reduced
+                    break
+
+    frame = cv2.imdecode(arr, flag)
+    if frame is None or not max_side:
+        return frame
+
+    h, w = frame.shape[:2]
+    long_side = max(h, w)
+    if long_side > max_side:
+        scale = max_side / long_side
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        dst = buffers.array("frame", (size[1], size[0], 3)) if buffers is not None else None
+        frame = cv2.resize(frame, size, dst=dst, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def decode_thumbnail(buf, size=(64, 48)):
+    """
+    静止判定用の小さなグレー画像を作る。
+    JPEG は 1/8 縮小デコード（ほぼ DC 成分だけ）なのでフルデコードよりずっと軽い。
+    """
+    arr = _as_uint8(buf)
+    if arr.size == 0:
+        return None
+    thumb = cv2.imdecode(arr, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if thumb is None:
+        return None
+    return cv2.resize(thumb, size, interpolation=cv2.INTER_AREA)
+
+
+# =========================
+# 使い回すバッファ
+# =========================
+class FrameBuffers:
+    """
+    名前ごとに1本の uint8 領域を持ち、要求された形のビューを切り出して返す。
+    足りない時だけ 1.5 倍に広げるので、同じ解像度が続く間は新しく確保しない。
+    high_water を超えた領域は、それ以下で足りる要求が来たら作り直して小さくする。
+    返したビューは、同じ名前で次に要求されるまでしか使えない。
+    """
+
+    def __init__(self, high_water=HIGH_WATER_BYTES):
+        self._arrays = {}
+        self.high_water = high_water
+        self.grows = 0      # 確保し直した回数
+        self.shrinks = 0    # 大きすぎる領域を手放した回数
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._arrays.values())
+
+    def _reserve(self, name, n, keep=0):
+        data = self._arrays.get(name)
+        if data is not None and not keep and data.size > self.high_water and n <= self.high_water:
+            data = None   # 大きな領域は手放し、要求に合う大きさで取り直す
+            self.shrinks += 1
+        if data is None or data.size < n:
+            bigger = np.empty(max(n, int(data.size * 1.5) if data is not None else n), np.uint8)
+            if keep:
+                bigger[:keep] = data[:keep]
+            data = self._arrays[name] = bigger
+            self.grows += 1
+        return data
+
+    def array(self, name, shape):
+        """連続したメモリの uint8 配列（中身は不定）"""
+        n = int(np.prod(shape))
+        return self._reserve(name, n)[:n].reshape(shape)
+
+    def read_stream(self, stream, size_hint=0, max_bytes=None):
+        """
+        stream を最後まで upload 領域に読み込む（bytes を作らず readinto で直接書く）。
+        max_bytes を超える分が来たら UploadTooLarge（上限 + 1 バイトより先は読まない）。
+        戻り値: 読んだ分の uint8 配列（空なら None）
+        """
+        if max_bytes is not None and size_hint > max_bytes:
+            raise UploadTooLarge(f"upload exceeds {max_bytes} bytes")
+        limit = max_bytes + 1 if max_bytes is not None else None
+
+        n = 0
+        data = self._reserve("upload", max(size_hint, 64 * 1024))
+        readinto = getattr(stream, "readinto", None)
+        while True:
+            if n == data.size:
+                data = self._reserve("upload", n * 2 if limit is None else min(n * 2, limit), keep=n)
+            end = data.size if limit is None else min(data.size, limit)
+            if readinto is not None:
+                got = readinto(data[n:end])
+            else:
+                chunk = stream.read(end - n)
+                got = len(chunk)
+                data[n:n + got] = np.frombuffer(chunk, np.uint8)
+            if not got:
+                break
+            n += got
+            if limit is not None and n >= limit:
+                raise UploadTooLarge(f"upload exceeds {max_bytes} bytes")
+        return data[:n] if n else None
+
+    def to_rgb(self, frame_bgr):
+        """BGR → RGB を rgb 領域に変換する"""
+        return cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB, dst=self.array("rgb", frame_bgr.shape))
+
+
+_local = threading.local()
+
+
+def thread_buffers():
+    """このスレッド（ワーカー）の FrameBuffers"""
+    buffers = getattr(_local, "buffers", None)
+    if buffers is None:
+        buffers = _local.buffers = FrameBuffers()
+    return buffers
+
+
+# =========================
+# ROI（人物まわりの切り出し）
+# =========================
+def roi_from_landmarks(lm_image, margin=0.25, min_size=0.35):
+    """
+    2D ランドマーク（フレーム全体に対する 0..1 座標, (N, 5) 配列）から
+    次フレームで切り出す範囲 (x0, y0, x1, y1) を決める。
+    """
+    visible = lm_image[lm_image[:, 3] > 0.3] if lm_image.shape[1] > 3 else lm_image
+    if len(visible) < 4:
+        return None
+
+    x0, y0 = visible[:, 0].min(), visible[:, 1].min()
+    x1, y1 = visible[:, 0].max(), visible[:, 1].max()
+    cx, cy = (x0 + x1) * 0.5, (y0 + y1) * 0.5
+    half_w = max((x1 - x0) * (0.5 + margin), min_size * 0.5)
+    half_h = max((y1 - y0) * (0.5 + margin), min_size * 0.5)
+
+    x0, x1 = max(0.0, cx - half_w), min(1.0, cx + half_w)
+    y0, y1 = max(0.0, cy - half_h), min(1.0, cy + half_h)
+    if x1 - x0 > 0.9 and y1 - y0 > 0.9:
+        return None  # ほぼ全体なら切り出さない
+    return float(x0), float(y0), float(x1), float(y1)
+
+
+def update_roi(roi, lm_image, margin=0.25, move_thr=0.15):
+    """
+    次フレームの ROI。新しく決めた範囲の各辺が、今の ROI の幅・高さの move_thr 倍より
+    動いていなければ今の ROI をそのまま使う。
+    VIDEO モードの推論は前フレームのランドマークから追うので、切り出しの位置・大きさが
+    毎フレーム変わると追跡が崩れる（入力画像の大きさも変わらないようにする）
+    """
+    new = roi_from_landmarks(lm_image, margin)
+    if roi is None or new is None:
+        return new
+    w, h = roi[2] - roi[0], roi[3] - roi[1]
+    if (abs(new[0] - roi[0]) <= move_thr * w and abs(new[2] - roi[2]) <= move_thr * w
+            and abs(new[1] - roi[1]) <= move_thr * h and abs(new[3] - roi[3]) <= move_thr * h):
+        return roi
+    return new
+
+
+def crop_to_roi(frame, roi):
+    """
+    ROI で切り出す（コピーしないビュー）。
+    戻り値: (切り出し画像, (x0, y0, 幅比, 高さ比))  ← ランドマークを全体座標に戻す用
+    """
+    if roi is None:
+        return frame, (0.0, 0.0, 1.0, 1.0)
+    h, w = frame.shape[:2]
+    x0, y0, x1, y1 = roi
+    px0, py0 = int(x0 * w), int(y0 * h)
+    px1, py1 = max(px0 + 1, int(x1 * w)), max(py0 + 1, int(y1 * h))
+    crop = frame[py0:py1, px0:px1]
+    return crop, (px0 / w, py0 / h, (px1 - px0) / w, (py1 - py0) / h)
+
+
+def uncrop_landmarks(lm_image, offset):
+    """切り出し画像基準の 0..1 座標をフレーム全体基準に戻す（in-place）"""
+    ox, oy, sx, sy = offset
+    if (ox, oy, sx, sy) != (0.0, 0.0, 1.0, 1.0):
+        lm_image[:, 0] = ox + lm_image[:, 0] * sx
+        lm_image[:, 1] = oy + lm_image[:, 1] * sy
+    return lm_image
@@ -0,0 +1,439 @@
+# ========================
+# inference_service.py
+# ========================
+#
+# 推論専用プロセス
+#   リクエストのスレッドで MediaPipe を動かすと、リクエスト処理と GIL・スレッドの枠を
+#   取り合う。推論だけを N 個の専用プロセスに分け、web 側はフレームを渡して結果を待つ。
+#
+#   - フレームは共有メモリのリング（slots 個 × slot_bytes）に RGB で書き、スロット番号と
+#     形だけをパイプで送る（画素は pickle しない）。BGR → RGB の変換がそのまま書き込みになる
+#   - 返すのはランドマークの配列 (人数, 33, 5) [x, y, z, visibility, presence] だけ
+#   - 推論器（VIDEO モード）は推論プロセス側に置く。1つの推論器への要求は常に同じプロセスに
+#     行くので、タイムスタンプの順番が守られる
+#   - 監視スレッドが定期的に ping し、落ちた / 応答しないプロセスを作り直す。
+#     そのプロセスにあった推論器は、次の要求が来た時に作り直される
+#   - 結果は timeout 秒まで待つ。間に合わない・プロセスが落ちた・リングに空きが無い時は
+#     InferenceUnavailable
+#
+#   プロセスは spawn で作る（スレッドを持つ web プロセスを fork しない。Windows でも同じ）
+
+import atexit
+import importlib
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("posture.inference")
+
+DEFAULT_CREATE_FN = "inference_service:Landmarker"
+
+
+class InferenceUnavailable(Exception):
+    """推論プロセスが時間内に結果を返さなかった / 落ちた / リングに空きが無い"""
+
+
+def physical_cores():
+    """物理コア数（/proc/cpuinfo が読めなければ論理コア数）"""
+    cores = set()
+    try:
+        with open("/proc/cpuinfo") as f:
+            package = None
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    package = value.strip()
+                elif key == "core id":
+                    cores.add((package, value.strip()))
+    except OSError:
+        pass
+    return len(cores) or os.cpu_count() or 1
+
+
+# =========================
+# 推論プロセス側
+# =========================
+class Landmarker:
+    """PoseLandmarker（VIDEO モード）。RGB の配列をそのまま受け取る"""
+
+    def __init__(self, model_path, num_poses):
+        import mediapipe
+        from mediapipe.tasks import python as mp_python
+        from mediapipe.tasks.python import vision as mp_vision
+
+        self._mp = mediapipe
+        options = mp_vision.PoseLandmarkerOptions(
+            base_options=mp_python.BaseOptions(model_asset_path=model_path),
+            running_mode=mp_vision.RunningMode.VIDEO,
+            num_poses=num_poses,
+        )
+        self._landmarker = mp_vision.PoseLandmarker.create_from_options(options)
+
+    def detect(self, rgb, timestamp_ms):
+        img = self._mp.Image(image_format=self._mp.ImageFormat.SRGB, data=rgb)
+        return self._landmarker.detect_for_video(img, timestamp_ms)
+
+    def close(self):
+        self._landmarker.close()
+
+
+def _resolve(path):
+    module, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def _pack(poses):
+    """MediaPipe のランドマーク列のリストを (人数, 33, 5) float32 に詰める"""
+    if not poses:
+        return np.zeros((0, 33, 5), np.float32)
+    return np.array([
+        [(lm.x, lm.y, lm.z,
+          getattr(lm, "visibility", None) or 0.0,
+          getattr(lm, "presence", None) or 0.0) for lm in lms]
+        for lms in poses
+    ], dtype=np.float32)
+
+
+def _worker_main(shm_name, slots, slot_bytes, requests, results, create_fn, max_detectors):
+    """
+    推論プロセスの本体。requests から受け取る要求:
+      ("detect", 要求ID, 推論器キー, モデル, 人数, スロット, 形, タイムスタンプ)
+      ("close", 推論器キー) / ("ping", 要求ID)
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl+C は親が受けて止める
+    create = _resolve(create_fn)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = np.ndarray((slots, slot_bytes), np.uint8, buffer=shm.buf)
+    detectors = OrderedDict()   # 推論器キー -> 推論器（末尾が最近使ったもの）
+
+    try:
+        while True:
+            try:
+                msg = requests.recv()
+            except EOFError:
+                break
+            kind = msg[0]
+            if kind == "detect":
+                _, req_id, key, model_path, num_poses, slot, shape, ts = msg
+                try:
+                    detector = detectors.get(key)
+                    if detector is None:
+                        detector = detectors[key] = create(model_path, num_poses)
+                        while len(detectors) > max_detectors:
+                            detectors.popitem(last=False)[1].close()
+                    detectors.move_to_end(key)
+                    rgb = ring[slot, :shape[0] * shape[1] * shape[2]].reshape(shape)
+                    res = detector.detect(rgb, ts)
+                    rgb = None
+                    results.send(("ok", req_id, _pack(res.pose_world_landmarks),
+                                  _pack(res.pose_landmarks)))
+                except Exception as e:
+                    results.send(("error", req_id, f"{type(e).__name__}: {e}"))
+            elif kind == "close":
+                detector = detectors.pop(msg[1], None)
+                if detector is not None:
+                    detector.close()
+            elif kind == "ping":
+                results.send(("pong", msg[1]))
+    finally:
+        for detector in detectors.values():
+            detector.close()
+        del ring
+        shm.close()
+
+
+# =========================
+# web 側
+# =========================
+class RemoteResult:
+    """推論プロセスの結果（detect_for_video の結果と同じ名前で読める）"""
+
+    def __init__(self, world, image, copy_s):
+        self.pose_world_landmarks = list(world)   # (33, 5) の配列のリスト
+        self.pose_landmarks = list(image)
+        self.copy_s = copy_s                      # 共有メモリへの書き込み（色変換込み）の秒数
+
+
+class RemoteDetector:
+    """推論プロセスにある推論器の代理。PosePostureAnalyzer の detector として使う"""
+
+    remote = True
+
+    def __init__(self, service, key, worker, model_path, num_poses):
+        self._service = service
+        self.key = key
+        self.worker = worker
+        self.model_path = model_path
+        self.num_poses = num_poses
+
+    def detect_bgr(self, frame_bgr, timestamp_ms):
+        return self._service.detect(self, frame_bgr, timestamp_ms)
+
+    def close(self):
+        self._service.release(self)
+
+
+class _Pending:
+    def __init__(self, slot):
+        self.slot = slot
+        self.event = threading.Event()
+        self.reply = None
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.requests = None
+        self.results = None
+        self.lock = threading.Lock()     # 送信と作り直しを直列化する
+        self.pending = {}                # 要求ID -> _Pending
+        self.detectors = 0               # 割り当てた推論器の数
+        self.last_progress = time.monotonic()
+        self.ping_sent = None
+
+
+class InferenceService:
+    """
+    workers      : 推論プロセスの数（物理コア数まで増やすと推論のスループットが伸びる）
+    slots        : リングのスロット数（= 同時に推論へ渡せるフレーム数）
+    slot_bytes   : 1スロットの大きさ（推論に渡す最大の画像の 高さ × 幅 × 3）
+    timeout      : 1フレームの結果を待つ最大秒数
+    health_interval / health_timeout: ping の間隔と、仕事があるのに何も返さない時に
+                   作り直すまでの秒数
+    create_fn    : 推論プロセスで推論器を作る "モジュール:名前"（bench の疑似推論器などに差し替える）
+    """
+
+    def __init__(self, workers=None, slots=16, slot_bytes=640 * 640 * 3, timeout=2.0,
+                 health_interval=5.0, health_timeout=10.0, create_fn=DEFAULT_CREATE_FN,
+                 max_detectors=64):
+        self.n_workers = workers or physical_cores()
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.create_fn = create_fn
+        self.max_detectors = max_detectors
+
+        self.restarts = 0
+        self.timeouts = 0
+        self._ctx = mp.get_context("spawn")
+        self._shm = None
+        self._ring = None
+        self._free = queue.LifoQueue()   # 直前に使ったスロットから使う（触るページを増やさない）
+        self._workers = [_Worker(i) for i in range(self.n_workers)]
+        self._ids = itertools.count(1)
+        self._assign_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    # ---- 起動・停止 ----
+    def start(self):
+        if self._shm is not None:
+            return
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+        self._ring = np.ndarray((self.slots, self.slot_bytes), np.uint8, buffer=self._shm.buf)
+        for slot in range(self.slots):
+            self._free.put(slot)
+        for w in self._workers:
+            self._spawn(w)
+        self._monitor = threading.Thread(target=self._watch, name="posture-inference-monitor",
+                                         daemon=True)
+        self._monitor.start()
+        atexit.register(self.close)
+
+    def close(self):
+        if self._shm is None:
+            return
+        self._stop.set()
+        for w in self._workers:
+            with w.lock:
+                self._kill(w, "service closed", graceful=True)
+        self._ring = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def _spawn(self, w):
+        req_r, req_w = self._ctx.Pipe(duplex=False)
+        res_r, res_w = self._ctx.Pipe(duplex=False)
+        w.process = self._ctx.Process(
+            target=_worker_main, name=f"posture-inference-{w.index}", daemon=True,
+            args=(self._shm.name, self.slots, self.slot_bytes, req_r, res_w,
+                  self.create_fn, self.max_detectors),
+        )
+        w.process.start()
+        req_r.close()
+        res_w.close()   # 子が落ちたら reader の recv が EOFError になる
+        w.requests, w.results = req_w, res_r
+        w.last_progress = time.monotonic()
+        w.ping_sent = None
+        threading.Thread(target=self._read, args=(w, w.process, res_r), daemon=True,
+                         name=f"posture-inference-reader-{w.index}").start()
+
+    def _kill(self, w, reason, graceful=False):
+        """w.lock を持って呼ぶ。プロセスを止め、待っている要求を失敗させてスロットを返す"""
+        if w.process is None:
+            return
+        w.requests.close()   # 子は EOFError で抜ける
+        w.process.join(2.0 if graceful else 0.0)
+        if w.process.is_alive():
+            w.process.kill()
+            w.process.join()
+        for pending in w.pending.values():
+            pending.reply = ("unavailable", None, reason)
+            self._free.put(pending.slot)
+            pending.event.set()
+        w.pending = {}
+        w.process = None
+
+    def _restart(self, w, process, reason):
+        """process がまだ w のプロセスなら作り直す（reader と監視スレッドが同時に気づいても1回だけ）"""
+        with w.lock:
+            if w.process is not process:
+                return
+            logger.warning("inference worker %d: %s, restarting", w.index, reason)
+            self._kill(w, reason)
+            if not self._stop.is_set():
+                self._spawn(w)
+                self.restarts += 1
+
+    # ---- 監視 ----
+    def _read(self, w, process, conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            with w.lock:
+                w.last_progress = time.monotonic()
+                if msg[0] == "pong":
+                    w.ping_sent = None
+                    continue
+                pending = w.pending.pop(msg[1], None)
+            if pending is not None:
+                self._free.put(pending.slot)
+                pending.reply = msg
+                pending.event.set()
+
+        # 子が落ちた（待っている要求はすぐに失敗させる）か、_kill で止めた
+        conn.close()
+        if not self._stop.is_set():
+            process.join(1.0)
+            self._restart(w, process, f"exited with {process.exitcode}")
+
+    def _watch(self):
+        while not self._stop.wait(self.health_interval):
+            now = time.monotonic()
+            for w in self._workers:
+                process = w.process
+                if process is None:
+                    continue
+                if not process.is_alive():
+                    self._restart(w, process, f"exited with {process.exitcode}")
+                elif (w.pending or w.ping_sent) and now - w.last_progress > self.health_timeout:
+                    self._restart(w, process, "not responding")
+                elif w.ping_sent is None:
+                    with w.lock:
+                        self._send(w, ("ping", next(self._ids)))
+                        if not w.pending:
+                            w.last_progress = now
+                        w.ping_sent = now
+
+    def _send(self, w, msg):
+        """w.lock を持って呼ぶ。送れなければ False（プロセスは監視スレッドが作り直す）"""
+        if w.process is None:
+            return False
+        try:
+            w.requests.send(msg)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    # ---- 推論 ----
+    def detector(self, model_path, num_poses=1):
+        """推論器を1つ割り当てる（推論器の少ないプロセスに置く）"""
+        with self._assign_lock:
+            w = min(self._workers, key=lambda w: w.detectors)
+            w.detectors += 1
+        return RemoteDetector(self, next(self._ids), w.index, model_path, num_poses)
+
+    def release(self, detector):
+        w = self._workers[detector.worker]
+        with self._assign_lock:
+            w.detectors -= 1
+        with w.lock:
+            self._send(w, ("close", detector.key))
+
+    def detect(self, detector, frame_bgr, timestamp_ms):
+        """フレームを推論プロセスに渡して結果（RemoteResult）を待つ"""
+        h, w_px = frame_bgr.shape[:2]
+        size = h * w_px * 3
+        if size > self.slot_bytes:
+            raise ValueError(f"frame {w_px}x{h} does not fit in a ring slot ({self.slot_bytes} bytes)")
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            slot = self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            self.timeouts += 1
+            raise InferenceUnavailable("no free ring slot") from None
+
+        t0 = time.perf_counter()
+        cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB, dst=self._ring[slot, :size].reshape(h, w_px, 3))
+        copy_s = time.perf_counter() - t0
+
+        w = self._workers[detector.worker]
+        req_id = next(self._ids)
+        pending = _Pending(slot)
+        with w.lock:
+            if not w.pending:
+                w.last_progress = time.monotonic()
+            w.pending[req_id] = pending
+            sent = self._send(w, ("detect", req_id, detector.key, detector.model_path,
+                                  detector.num_poses, slot, (h, w_px, 3), int(timestamp_ms)))
+            if not sent:
+                del w.pending[req_id]
+        if not sent:
+            self._free.put(slot)
+            raise InferenceUnavailable(f"inference worker {w.index} is down")
+
+        # 間に合わなくてもスロットは結果が返った時（または作り直した時）に返る
+        if not pending.event.wait(max(0.0, deadline - time.monotonic())):
+            self.timeouts += 1
+            raise InferenceUnavailable("inference timed out")
+
+        kind, _, *payload = pending.reply
+        if kind == "ok":
+            world, image = payload
+            return RemoteResult(world, image, copy_s)
+        if kind == "unavailable":
+            raise InferenceUnavailable(payload[0])
+        raise RuntimeError(f"inference worker {w.index}: {payload[0]}")
+
+    # ---- 状態 ----
+    def stats(self):
+        return {
+            "workers": [{
+                "pid": w.process.pid if w.process is not None else None,
+                "alive": w.process is not None and w.process.is_alive(),
+                "pending": len(w.pending),
+                "detectors": w.detectors,
+            } for w in self._workers],
+            "free_slots": self._free.qsize(),
+            "slots": self.slots,
+            "restarts": self.restarts,
+            "timeouts": self.timeouts,
+        }
@@ -0,0 +1,157 @@
+# ========================
+# ingest_format.py
+# ========================
+#
+# /ingest（端末側で推論した結果の受け付け）のリクエスト形式を読む。
+#
+#   中身（1件でも、まとめて T 件でもよい）
+#     world_landmarks : (T, 33, 3〜5) ワールド座標 [x, y, z, visibility, presence]
+#                       1件なら (33, 3〜5) でもよい
+#     metrics         : (T, 3) [torso_angle, neck_angle, shoulder_tilt]
+#                       または {"torso_angle": .., "neck_angle": .., "shoulder_tilt": ..} / そのリスト
+#     t               : 各件の計測時刻（UNIX 時間のミリ秒）。省略すると受け付けた時刻
+#     calibrate       : true なら最後の1件を正しい姿勢として記録する
+#   world_landmarks と metrics はどちらか一方。
+#
+#   形式（Content-Type）
+#     application/json         : 上のキーを持つ JSON
+#     application/octet-stream : /analyze の packed 応答と同じ並び
+#                                [uint32 LE ヘッダ長][ヘッダ JSON][空白埋め][float32 配列...]
+#                                ヘッダ長は埋めた分を含む。NUL で埋めてもよい
+#                                ヘッダの "arrays" に {名前: 形} が並び順どおり入る
+#     application/msgpack      : JSON と同じキー。配列は {"shape": [...], "data": float32 LE}
+
+import json
+import struct
+
+import numpy as np
+
+from response_format import MIME_MSGPACK, MIME_PACKED, msgpack
+
+METRIC_NAMES = ("torso_angle", "neck_angle", "shoulder_tilt")
+
+
+class IngestError(ValueError):
+    pass
+
+
+def parse_ingest(mimetype, data, max_samples):
+    """
+    data: 本文（bytes または uint8 配列）
+    戻り値: {"world": (T, 33, C) または None, "metrics": (T, 3) または None,
+             "t": (T,) ミリ秒 または None, "calibrate": bool}
+    """
+    if mimetype == MIME_PACKED:
+        body = _unpack(data)
+    elif mimetype == MIME_MSGPACK:
+        if msgpack is None:
+            raise IngestError("msgpack is not available")
+        try:
+            body = msgpack.unpackb(bytes(data))
+        except (ValueError, TypeError, msgpack.UnpackException):
+            raise IngestError("invalid msgpack") from None
+        if not isinstance(body, dict):
+            raise IngestError("body must be a map")
+        for name in ("world_landmarks", "metrics"):
+            if isinstance(body.get(name), dict) and "data" in body[name]:
+                body[name] = _from_buffer(body[name]["data"], body[name].get("shape"))
+    else:
+        try:
+            body = json.loads(bytes(data))
+        except ValueError:
+            raise IngestError("invalid JSON") from None
+    if not isinstance(body, dict):
+        raise IngestError("body must be an object")
+
+    world = body.get("world_landmarks")
+    metrics = body.get("metrics")
+    if (world is None) == (metrics is None):
+        raise IngestError("send either world_landmarks or metrics")
+
+    if world is not None:
+        world = _as_float(world)
+        if world.ndim == 2:
+            world = world[None]
+        if world.ndim != 3 or world.shape[1] != 33 or not 3 <= world.shape[2] <= 5:
+            raise IngestError("world_landmarks must be (T, 33, 3..5)")
+        n = len(world)
+    else:
+        metrics = _metrics_array(metrics)
+        n = len(metrics)
+
+    if n == 0:
+        raise IngestError("no samples")
+    if n > max_samples:
+        raise IngestError(f"too many samples (max {max_samples})")
+
+    t = body.get("t")
+    if t is not None:
+        # UNIX 時間のミリ秒は float32 では 2 分刻みほどに丸まるので float64 で読む
+        t = np.atleast_1d(_as_float(t, np.float64))
+        if t.shape != (n,):
+            raise IngestError("t must have one timestamp per sample")
+        if not np.isfinite(t).all():
+            raise IngestError("t must be finite")
+
+    return {"world": world, "metrics": metrics, "t": t, "calibrate": bool(body.get("calibrate"))}
+
+
+def _as_float(value, dtype=np.float32):
+    try:
+        return np.asarray(value, dtype=dtype)
+    except (TypeError, ValueError):
+        raise IngestError("arrays must be numeric") from None
+
+
+def _metrics_array(metrics):
+    if isinstance(metrics, dict):
+        metrics = [metrics]
+    if isinstance(metrics, list) and metrics and isinstance(metrics[0], dict):
+        try:
+            metrics = [[m[k] for k in METRIC_NAMES] for m in metrics]
+        except (KeyError, TypeError):
+            raise IngestError(f"metrics need {', '.join(METRIC_NAMES)}") from None
+    arr = _as_float(metrics)
+    if arr.ndim == 1:
+        arr = arr[None]
+    if arr.ndim != 2 or arr.shape[1] != 3:
+        raise IngestError("metrics must be (T, 3)")
+    return arr
+
+
+def _from_buffer(buf, shape):
+    if not isinstance(buf, (bytes, bytearray, memoryview)):
+        raise IngestError("array data must be bytes")
+    try:
+        shape = tuple(int(s) for s in shape)
+    except (TypeError, ValueError):
+        raise IngestError("invalid array shape") from None
+    if any(s < 0 for s in shape):
+        raise IngestError("invalid array shape")
+    count = int(np.prod(shape))
+    if len(buf) < count * 4:
+        raise IngestError("array data is shorter than its shape")
+    return np.frombuffer(buf, "<f4", count=count).reshape(shape)
+
+
+def _unpack(data):
+    """packed 形式を {ヘッダの値..., 配列名: 配列} にする（配列は data のビュー）"""
+    view = memoryview(data).cast("B")
+    if len(view) < 4:
+        raise IngestError("packed body is too short")
+    head_len = struct.unpack_from("<I", view)[0]
+    if 4 + head_len > len(view):
+        raise IngestError("packed header is truncated")
+    try:
+        # 4バイト境界までの埋め草は空白（JSON として読める）か NUL
+        header = json.loads(bytes(view[4:4 + head_len]).rstrip(b"\x00 "))
+        arrays = dict(header.pop("arrays"))
+    except (ValueError, KeyError, AttributeError, TypeError):
+        raise IngestError("invalid packed header") from None
+
+    offset = 4 + head_len
+    for name, shape in arrays.items():
+        arr = _from_buffer(view[offset:], shape)
+        header[name] = arr
+        offset += arr.nbytes
+    return header
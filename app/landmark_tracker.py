@@ -0,0 +1,137 @@
+# ========================
+# landmark_tracker.py
+# ========================
+#
+# キーフレーム間のランドマーク追跡
+#   キーフレームでは通常どおり MediaPipe で推論し、その間のフレームは
+#   姿勢判定に使う上半身の点（鼻・両肩・両腰）だけを縮小グレー画像上の
+#   疎なオプティカルフロー（Lucas-Kanade）で追う。
+#
+#   3D（ワールド座標）は、キーフレームの肩幅から求めた「1px あたりのメートル」で
+#   2D の移動量を換算して x / y に足す。z はキーフレームの値のまま。
+#   ワールド座標は腰の中点が原点なので、腰の中点の移動分は差し引く。
+#
+#   次の場合は追跡をやめて（None を返して）キーフレームに戻す
+#     - 前後方向のフロー誤差が大きい / 点を見失った（lost）
+#     - キーフレームからの移動量が大きい（motion）
+#     - フレームの大きさが変わった（resize）
+
+import cv2
+import numpy as np
+
+# 追跡する点: 鼻, 左肩, 右肩, 左腰, 右腰
+TRACK_POINTS = np.array([0, 11, 12, 23, 24])
+_SH_L, _SH_R, _HIP_L, _HIP_R = 1, 2, 3, 4   # TRACK_POINTS 内の位置
+
+LK_PARAMS = dict(
+    winSize=(21, 21),
+    maxLevel=2,
+    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+)
+
+
+class LandmarkTracker:
+    def __init__(self, max_side=320, fb_thr=1.0, max_motion=0.05, min_visibility=0.5):
+        self.max_side = max_side
+        self.fb_thr = fb_thr                  # 前後フロー誤差の上限（px, 縮小画像上）
+        self.max_motion = max_motion          # キーフレームからの移動量の上限（長辺比）
+        self.min_visibility = min_visibility  # キーフレームでこれ未満の点があれば追跡しない
+        self.last_reason = None
+        self.reset()
+
+    def reset(self):
+        self._prev = None
+        self._pts = None
+        self._key_pts = None
+        self._key_image = None
+        self._key_world = None
+        self._scale = None
+
+    @property
+    def active(self):
+        return self._prev is not None
+
+    def _gray(self, frame_bgr):
+        h, w = frame_bgr.shape[:2]
+        long_side = max(h, w)
+        if self.max_side and long_side > self.max_side:
+            scale = self.max_side / long_side
+            frame_bgr = cv2.resize(frame_bgr, (max(1, int(w * scale)), max(1, int(h * scale))),
+                                   interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2GRAY)
+
+    def start(self, frame_bgr, lm_image, lm_world):
+        """
+        キーフレームの結果から追跡を始める。
+        lm_image はフレーム全体基準の (N, 5) 配列、lm_world は (N, 5) のワールド座標。
+        追跡に向かない（点が見えていない等）場合は False。
+        """
+        self.reset()
+        if lm_image is None or lm_image.shape[1] > 3 and \
+                lm_image[TRACK_POINTS, 3].min() < self.min_visibility:
+            return False
+
+        gray = self._gray(frame_bgr)
+        h, w = gray.shape
+        pts = (lm_image[TRACK_POINTS, :2] * (w, h)).astype(np.float32)
+
+        # 肩幅で px → メートルの換算係数を決める
+        sh_px = np.linalg.norm(pts[_SH_L] - pts[_SH_R])
+        sh_m = np.linalg.norm(lm_world[TRACK_POINTS[_SH_L], :2] - lm_world[TRACK_POINTS[_SH_R], :2])
+        if sh_px < 2.0 or sh_m < 1e-4:
+            return False
+
+        self._prev = gray
+        self._pts = pts
+        self._key_pts = pts.copy()
+        self._key_image = lm_image.copy()
+        self._key_world = lm_world.copy()
+        self._scale = sh_m / sh_px
+        return True
+
+    def step(self, frame_bgr):
+        """
+        次のフレームへ点を追う。
+        戻り値: (lm_image, lm_world) の推定値。追えなかった場合は None（理由は last_reason）
+        """
+        gray = self._gray(frame_bgr)
+        if gray.shape != self._prev.shape:
+            return self._lose("resize")
+
+        p1, st, _ = cv2.calcOpticalFlowPyrLK(self._prev, gray, self._pts, None, **LK_PARAMS)
+        if p1 is None or not st.all():
+            return self._lose("lost")
+        # 逆向きにも追って、元の位置に戻らない点があれば信用しない
+        p0r, st_back, _ = cv2.calcOpticalFlowPyrLK(gray, self._prev, p1, None, **LK_PARAMS)
+        if p0r is None or not st_back.all():
+            return self._lose("lost")
+        fb = np.linalg.norm(self._pts - p0r, axis=1)
+        if fb.max() > self.fb_thr:
+            return self._lose("lost")
+
+        h, w = gray.shape
+        d = p1 - self._key_pts                       # キーフレームからの移動量（px）
+        if np.linalg.norm(d, axis=1).max() > self.max_motion * max(h, w):
+            return self._lose("motion")
+
+        self._prev = gray
+        self._pts = p1
+
+        # 追っていない点は全体の平均移動量だけずらす
+        mean_d = d.mean(axis=0)
+        lm_image = self._key_image.copy()
+        lm_image[:, :2] += mean_d / (w, h)
+        lm_image[TRACK_POINTS, :2] = p1 / (w, h)
+
+        hip_d = (d[_HIP_L] + d[_HIP_R]) * 0.5
+        lm_world = self._key_world.copy()
+        lm_world[:, :2] += (mean_d - hip_d) * self._scale
+        lm_world[TRACK_POINTS, :2] = self._key_world[TRACK_POINTS, :2] + (d - hip_d) * self._scale
+
+        self.last_reason = None
+        return lm_image, lm_world
+
+    def _lose(self, reason):
+        self.last_reason = reason
+        self.reset()
+        return None
@@ -0,0 +1,567 @@
+# ========================
+# loadtest.py
+# ========================
+#
+# ブラウザ N 台分の同時利用をまねる負荷試験（1台の Linux 上で、ローカルのサーバーに対して）
+#
+#   python app/loadtest.py --frames session.mp4                          # serve.py を起動し、同時接続数を増やして限界を探す
+#   python app/loadtest.py --frames frames/ --clients 1,2,4,8 --step 30  # 決めた同時接続数だけ測る
+#   python app/loadtest.py --frames session.mp4 --inference-workers 2 --out cap.json
+#   python app/loadtest.py --frames session.mp4 --url http://127.0.0.1:5000 --server-pid 1234   # 起動済みのサーバー
+#
+#   1クライアント = app.js の HTTP ループ
+#     /register → /login でセッション Cookie を得て、/capture_config の長辺・画質で撮り直した
+#     録画フレームを /analyze?fields=&format=packed に --fps で送り続ける（応答の next_poll_ms が
+#     長ければそれに従う）。ときどき /calibrate と /logs も呼ぶ。
+#     前の応答が返るまで次は送らない。間に合わずに送れなかった分は late として数える
+#   同時接続数ごとに --warmup 秒流してから --step 秒測り、スループット・遅延（p50/p95/p99）・
+#   429 / 503 / その他のエラー率と、サーバー（親と子孫プロセス全部）の CPU・RSS・PSS を記録する。
+#
+#   飽和の判定（どれか1つでも当てはまれば飽和）
+#     - /analyze の成功数が、送るはずだった数の --min-goodput 未満
+#     - /analyze の p95 が --slo-ms を超える
+#     - エラー率（429 / 503 / 5xx / 接続エラー）が --max-error-rate を超える
+#   --clients を省略すると 1, 2, 4, ... と倍にしていき、飽和したら直前との間を二分探索する。
+#   負荷をかける側も同じマシンの CPU を使うので、その分（client_cpu）も一緒に出す。
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.cookies import SimpleCookie
+
+import numpy as np
+
+from bench import _smaps_rollup, git_commit, load_jpegs, percentiles
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+ERROR_STATUSES = (429, 503)
+
+
+# =========================
+# 録画フレーム
+# =========================
+def prepare_frames(jpegs, max_side, quality):
+    """ブラウザと同じく、長辺 max_side・画質 quality（0..1）の JPEG に撮り直す"""
+    import cv2
+
+    out = []
+    for data in jpegs:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        h, w = img.shape[:2]
+        scale = min(1.0, max_side / max(h, w))
+        if scale < 1.0:
+            img = cv2.resize(img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+        out.append(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, int(quality * 100)])[1].tobytes())
+    return out
+
+
+def next_poll_ms(content_type, data):
+    """/analyze の応答（packed / JSON）から next_poll_ms を読む"""
+    try:
+        if content_type.startswith("application/octet-stream"):
+            (head_len,) = struct.unpack_from("<I", data, 0)
+            head = json.loads(data[4:4 + head_len])
+        else:
+            head = json.loads(data)
+    except ValueError:
+        return None
+    return head.get("next_poll_ms")
+
+
+# =========================
+# 集計（1段分）
+# =========================
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.recording = False
+        self.latency = {}        # 種類 -> 成功した応答の秒数
+        self.status = Counter()  # (種類, 状態) -> 回数。状態は HTTP ステータス or "conn"
+        self.late = 0            # 前の応答待ちで送れなかったフレーム数
+
+    def add(self, kind, status, seconds):
+        if not self.recording:
+            return
+        with self._lock:
+            self.status[(kind, status)] += 1
+            if status == 200:
+                self.latency.setdefault(kind, []).append(seconds)
+
+    def add_late(self, n):
+        if self.recording:
+            with self._lock:
+                self.late += n
+
+
+# =========================
+# クライアント（app.js の HTTP ループ）
+# =========================
+class Client:
+    def __init__(self, host, port, name, frames, args):
+        self.host, self.port = host, port
+        self.name = name
+        self.frames = frames
+        self.index = random.randrange(len(frames))   # 全員が同じフレームを送らないようにずらす
+        self.args = args
+        self.cookies = {}
+        self.conn = None
+        self.thread = None
+        self.stop = threading.Event()
+
+    def _request(self, method, path, body=None, headers=None):
+        """(ステータス, Content-Type, 本文, ヘッダ)。接続エラーはステータス "conn" """
+        headers = dict(headers or {})
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.args.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                res = self.conn.getresponse()
+                data = res.read()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                # 置いてあった keep-alive 接続が切られていた時だけ、つなぎ直して1回だけ送り直す
+                if attempt == 0 and body is None:
+                    continue
+                return "conn", "", b"", None
+            for value in res.headers.get_all("Set-Cookie") or []:
+                for key, morsel in SimpleCookie(value).items():
+                    self.cookies[key] = morsel.value
+            if res.getheader("Connection", "").lower() == "close":
+                self.conn.close()
+                self.conn = None
+            return res.status, res.getheader("Content-Type", ""), data, res.headers
+        return "conn", "", b"", None
+
+    def login(self):
+        form = urllib.parse.urlencode({"username": self.name, "password": self.args.password})
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        # 既にいるユーザーならフォームが出直すだけ
+        self._request("POST", "/register", form, headers)
+        status, _, _, res_headers = self._request("POST", "/login", form, headers)
+        if status != 302 or "login" in res_headers.get("Location", ""):
+            raise RuntimeError(f"login failed for {self.name}: {status}")
+
+    def _frame(self):
+        self.index = (self.index + 1) % len(self.frames)
+        return self.frames[self.index]
+
+    def _timed(self, rec, kind, method, path, body=None, headers=None):
+        t0 = time.perf_counter()
+        status, content_type, data, _ = self._request(method, path, body, headers)
+        rec.add(kind, status, time.perf_counter() - t0)
+        return status, content_type, data
+
+    def run(self, rec):
+        args = self.args
+        jpeg = {"Content-Type": "image/jpeg"}
+        base = 1.0 / args.fps
+        interval = base
+        now = time.perf_counter()
+        next_frame = now + random.uniform(0, base)
+        next_calibrate = now + random.uniform(0, args.calibrate_every) if args.calibrate_every else None
+        next_logs = now + random.uniform(0, args.logs_every) if args.logs_every else None
+
+        while not self.stop.is_set():
+            now = time.perf_counter()
+            if next_calibrate is not None and now >= next_calibrate:
+                self._timed(rec, "calibrate", "POST", "/calibrate", self._frame(), jpeg)
+                next_calibrate += args.calibrate_every
+                continue
+            if next_logs is not None and now >= next_logs:
+                self._timed(rec, "logs", "GET", "/logs")
+                next_logs += args.logs_every
+                continue
+            if now < next_frame:
+                self.stop.wait(min(next_frame - now, 0.05))
+                continue
+
+            status, content_type, data = self._timed(
+                rec, "analyze", "POST", "/analyze?fields=&format=packed", self._frame(), jpeg)
+            if status == 200:
+                # サーバーが間隔を広げるよう言ってきたら従う（app.js の adaptPollInterval）
+                poll = next_poll_ms(content_type, data)
+                interval = max(base, poll / 1000.0) if poll else base
+            next_frame += interval
+            behind = time.perf_counter() - next_frame
+            if behind > 0:
+                missed = int(behind / interval) + 1
+                rec.add_late(missed)
+                next_frame += missed * interval
+
+    def start(self, rec):
+        self.stop.clear()
+        self.thread = threading.Thread(target=self.run, args=(rec,), daemon=True)
+        self.thread.start()
+
+    def join(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+# =========================
+# サーバー側の CPU・メモリ
+# =========================
+def process_tree(pid):
+    """pid と子孫プロセス（推論プロセスなど孫も含む）"""
+    out, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        out.append(p)
+        try:
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    todo.extend(int(c) for c in f.read().split())
+        except OSError:
+            continue
+    return out
+
+
+def _cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime / stime（コマンド名の後ろから数えて 12, 13 番目）
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+class ServerMonitor:
+    """サーバーのプロセスツリーの CPU 時間と RSS を interval 秒ごとに読む"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self._cpu = {}            # pid -> 最後に読んだ CPU 秒
+        self._stop = threading.Event()
+        self._thread = None
+        self.cpu_s = 0.0
+        self.rss_samples = []
+
+    def _sample(self):
+        total_rss = 0.0
+        for p in process_tree(self.pid):
+            try:
+                cpu = _cpu_seconds(p)
+                with open(f"/proc/{p}/statm") as f:
+                    total_rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+            except OSError:
+                continue   # 読んでいる間に終わった
+            # 途中で生まれたプロセスは、生まれてから使った分を全部数える
+            self.cpu_s += cpu - self._cpu.get(p, 0.0)
+            self._cpu[p] = cpu
+        return total_rss
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.rss_samples.append(self._sample())
+
+    def start(self):
+        self._sample()
+        self.cpu_s = 0.0
+        self.rss_samples = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.rss_samples.append(self._sample())
+        pss = 0.0
+        for p in process_tree(self.pid):
+            try:
+                pss += _smaps_rollup(p)["pss_mb"]
+            except OSError:
+                continue
+        return {"cpu_s": self.cpu_s,
+                "rss_mb_mean": round(float(np.mean(self.rss_samples)), 1),
+                "rss_mb_max": round(max(self.rss_samples), 1),
+                "pss_mb": round(pss, 1)}
+
+
+# =========================
+# サーバーの起動
+# =========================
+def start_server(args):
+    """serve.py を一時 DB で起動し、(プロセス, ポート, DB ファイル) を返す"""
+    import urllib.request
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    tmp.close()
+    cmd = [sys.executable, os.path.join(BASE_DIR, "serve.py"), "--host", "127.0.0.1",
+           "--port", str(port), "--workers", str(args.workers), "--db-url", "sqlite:///" + tmp.name]
+    if args.inference_workers is not None:
+        cmd += ["--inference-workers", str(args.inference_workers)]
+    log = open(args.server_log, "ab") if args.server_log else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, stdout=log, stderr=log)
+
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < 120:
+        if proc.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {proc.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/capture_config", timeout=1).read()
+            break
+        except OSError:
+            time.sleep(0.05)
+    else:
+        proc.terminate()
+        raise RuntimeError("server did not respond within 120s")
+    # 全ワーカーが accept を始めるまで待つ
+    while len(process_tree(proc.pid)) <= args.workers and time.perf_counter() - t0 < 120:
+        time.sleep(0.05)
+    time.sleep(1.0)
+    return proc, port, tmp.name
+
+
+# =========================
+# 1段（同時接続数 n）の計測
+# =========================
+def run_step(n, clients, make_client, monitor, args):
+    while len(clients) < n:
+        c = make_client(len(clients))
+        c.login()
+        clients.append(c)
+
+    rec = Recorder()
+    for c in clients[:n]:
+        c.start(rec)
+    time.sleep(args.warmup)
+
+    if monitor is not None:
+        monitor.start()
+    client_cpu0 = time.process_time()
+    rec.recording = True
+    t0 = time.perf_counter()
+    time.sleep(args.step)
+    rec.recording = False
+    wall = time.perf_counter() - t0
+    client_cpu = time.process_time() - client_cpu0
+    server = monitor.stop() if monitor is not None else None
+
+    for c in clients[:n]:
+        c.join()
+    return summarize(n, rec, wall, client_cpu, server, args)
+
+
+def summarize(n, rec, wall, client_cpu, server, args):
+    by_kind = {}
+    for (kind, status), count in rec.status.items():
+        by_kind.setdefault(kind, Counter())[status] += count
+
+    analyze = by_kind.get("analyze", Counter())
+    sent = sum(analyze.values())
+    ok = analyze.get(200, 0)
+    errors = sum(c for s, c in analyze.items()
+                 if s == "conn" or s in ERROR_STATUSES or (isinstance(s, int) and s >= 500))
+    # 送るはずだった数 = 送った数 + 前の応答待ちで送れなかった数
+    offered = sent + rec.late
+    lat = percentiles(rec.latency.get("analyze", []))
+    cores = os.cpu_count() or 1
+
+    step = {
+        "clients": n,
+        "offered_fps": round(offered / wall, 2),
+        "ok_fps": round(ok / wall, 2),
+        "goodput": round(ok / offered, 3) if offered else 0.0,
+        "latency_ms": lat,
+        "error_rate": round(errors / sent, 4) if sent else 0.0,
+        "rate_429": round(analyze.get(429, 0) / sent, 4) if sent else 0.0,
+        "rate_503": round(analyze.get(503, 0) / sent, 4) if sent else 0.0,
+        "late": rec.late,
+        "status": {kind: {str(s): c for s, c in counts.items()} for kind, counts in by_kind.items()},
+        "other_latency_ms": {kind: percentiles(v) for kind, v in rec.latency.items() if kind != "analyze"},
+        "client_cpu_pct": round(client_cpu / wall / cores * 100, 1),
+    }
+    if server is not None:
+        step["server_cpu_pct"] = round(server["cpu_s"] / wall / cores * 100, 1)
+        step["server_rss_mb"] = server["rss_mb_max"]
+        step["server_pss_mb"] = server["pss_mb"]
+
+    reasons = []
+    if step["goodput"] < args.min_goodput:
+        reasons.append("goodput")
+    if lat["p95"] > args.slo_ms:
+        reasons.append("p95")
+    if step["error_rate"] > args.max_error_rate:
+        reasons.append("errors")
+    step["saturated"] = reasons
+    return step
+
+
+def search(run, args):
+    """同時接続数を倍にしていき、飽和したら直前との間を二分探索する。(各段の結果, 限界)"""
+    steps = {}
+
+    def measure(n):
+        if n not in steps:
+            steps[n] = run(n)
+            print_step(steps[n])
+        return steps[n]
+
+    if args.clients:
+        for n in args.clients:
+            measure(n)
+        good = [n for n, s in steps.items() if not s["saturated"]]
+        return [steps[n] for n in sorted(steps)], max(good) if good else None
+
+    lo, hi, n = None, None, 1
+    while n <= args.max_clients:
+        if measure(n)["saturated"]:
+            hi = n
+            break
+        lo = n
+        n *= 2
+    if hi is not None and lo is not None:
+        while hi - lo > max(1, int(lo * args.resolution)):
+            mid = (lo + hi) // 2
+            if measure(mid)["saturated"]:
+                hi = mid
+            else:
+                lo = mid
+    return [steps[n] for n in sorted(steps)], lo
+
+
+# =========================
+# 表示
+# =========================
+HEADER = (f"{'clients':>7}{'offered/s':>10}{'ok/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'429':>7}{'503':>7}{'err':>7}{'srv_cpu':>8}{'srv_rss':>8}{'cli_cpu':>8}  saturated")
+
+
+def print_step(s):
+    lat = s["latency_ms"]
+    print(f"{s['clients']:>7}{s['offered_fps']:>10.1f}{s['ok_fps']:>8.1f}"
+          f"{lat['p50']:>9.1f}{lat['p95']:>9.1f}{lat['p99']:>9.1f}"
+          f"{s['rate_429']:>7.1%}{s['rate_503']:>7.1%}{s['error_rate']:>7.1%}"
+          f"{s.get('server_cpu_pct', float('nan')):>7.0f}%{s.get('server_rss_mb', float('nan')):>7.0f}M"
+          f"{s['client_cpu_pct']:>7.0f}%  {','.join(s['saturated']) or '-'}", flush=True)
+
+
+def print_capacity(result):
+    cap = result["capacity"]
+    if cap["clients"] is None:
+        print("capacity: saturated at the first step")
+        return
+    s = cap["step"]
+    print(f"capacity: {cap['clients']} clients = {s['ok_fps']} frames/s "
+          f"(p95 {s['latency_ms']['p95']:.0f}ms, errors {s['error_rate']:.1%})")
+    if cap["limit"] is not None:
+        print(f"saturates at {cap['limit']['clients']} clients: {', '.join(cap['limit']['saturated'])}")
+    else:
+        print("did not saturate within the tested range")
+
+
+# =========================
+# main
+# =========================
+def main():
+    parser = argparse.ArgumentParser(description="同時接続数ごとのスループット・遅延と限界を測る負荷試験")
+    parser.add_argument("--frames", required=True, help="JPEG のディレクトリまたは動画ファイル（録画フレーム）")
+    parser.add_argument("--limit", type=int, default=300, help="読み込むフレーム数の上限")
+    parser.add_argument("--url", help="起動済みのサーバー（省略すると serve.py を一時 DB で起動する）")
+    parser.add_argument("--server-pid", type=int, help="--url のサーバーの親プロセス（CPU・メモリを読む）")
+    parser.add_argument("--workers", type=int, default=1, help="起動する serve.py のワーカー数（serve.py の上限まで）")
+    parser.add_argument("--inference-workers", type=int, help="起動する serve.py の推論プロセス数")
+    parser.add_argument("--server-log", help="起動した serve.py の出力先")
+    parser.add_argument("--clients", type=lambda v: [int(x) for x in v.split(",")],
+                        help="測る同時接続数（例 1,2,4,8。省略すると自動で限界を探す）")
+    parser.add_argument("--max-clients", type=int, default=256, help="自動探索の上限")
+    parser.add_argument("--resolution", type=float, default=0.1, help="二分探索をやめる幅（限界値に対する割合）")
+    parser.add_argument("--fps", type=float, default=1.0, help="1クライアントの送信頻度（app.js は 1 / 骨格表示中は 5）")
+    parser.add_argument("--calibrate-every", type=float, default=300.0, help="/calibrate の間隔（秒, 0 で呼ばない）")
+    parser.add_argument("--logs-every", type=float, default=60.0, help="/logs の間隔（秒, 0 で呼ばない）")
+    parser.add_argument("--warmup", type=float, default=5.0, help="各段で計測を始めるまでの秒数")
+    parser.add_argument("--step", type=float, default=20.0, help="各段の計測秒数")
+    parser.add_argument("--timeout", type=float, default=10.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--slo-ms", type=float, default=500.0, help="/analyze の p95 の上限")
+    parser.add_argument("--min-goodput", type=float, default=0.9, help="送るはずだった数に対する成功数の下限")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="429 / 503 / 5xx / 接続エラーの割合の上限")
+    parser.add_argument("--user-prefix", default="load", help="作るユーザー名の接頭辞")
+    parser.add_argument("--password", default="load-test")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果を JSON で保存")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    jpegs = load_jpegs(args.frames, args.limit)
+    if not jpegs:
+        parser.error(f"フレームを読めません: {args.frames}")
+
+    proc = db_file = None
+    if args.url:
+        u = urllib.parse.urlsplit(args.url)
+        host, port, server_pid = u.hostname, u.port or 80, args.server_pid
+    else:
+        proc, port, db_file = start_server(args)
+        host, server_pid = "127.0.0.1", proc.pid
+
+    try:
+        probe = Client(host, port, "-", [b""], args)
+        status, _, data, _ = probe._request("GET", "/capture_config")
+        if status != 200:
+            raise RuntimeError(f"/capture_config returned {status}")
+        cfg = json.loads(data)
+        frames = prepare_frames(jpegs, cfg["max_side"], cfg["jpeg_quality"])
+        print(f"{len(frames)} frames at max_side={cfg['max_side']} "
+              f"({np.mean([len(f) for f in frames]) / 1024:.0f}KB), {args.fps} fps per client")
+
+        clients = []
+        monitor = ServerMonitor(server_pid) if server_pid else None
+
+        def make_client(i):
+            return Client(host, port, f"{args.user_prefix}{i}", frames, args)
+
+        print(HEADER)
+        steps, capacity = search(lambda n: run_step(n, clients, make_client, monitor, args), args)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(30)
+            os.unlink(db_file)
+
+    limit = next((s for s in steps if s["saturated"] and (capacity is None or s["clients"] > capacity)), None)
+    result = {
+        "meta": {"mode": "load", "url": args.url, "workers": None if args.url else args.workers,
+                 "inference_workers": args.inference_workers, "fps_per_client": args.fps,
+                 "slo_ms": args.slo_ms, "min_goodput": args.min_goodput,
+                 "max_error_rate": args.max_error_rate, "frames": len(frames),
+                 "commit": git_commit(), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "steps": steps,
+        "capacity": {
+            "clients": capacity,
+            "step": next((s for s in steps if s["clients"] == capacity), None),
+            "limit": limit,
+        },
+    }
+    print_capacity(result)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# ========================
+# log_pages.py
+# ========================
+
+from datetime import timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db, storage
+from models.posture import PostureLog, PostureLogPage
+from metrics import span
+
+# =========================
+# ページ分けのルール
+# =========================
+PAGE_SPAN = timedelta(minutes=5)    # ページ開始から5分以上経ったら次のページ
+SAMPLE_GAP = timedelta(seconds=2.5) # ページ内は2.5秒以上間隔があるログだけ表示
+
+
+def invalidate_pages(conn, rows):
+    """
+    PostureLog に書いた行より後ろのページを索引から消す（同じトランザクション内で呼ぶ）。
+    /ingest の t や /batch の started_at で過去の時刻の行が入ると、索引済みのページの
+    内側や手前に入るので、その行を含むページ以降を次の表示で作り直させる。
+    いつもの「最新より新しい行」なら消すものは無い。
+    """
+    earliest = {}
+    for r in rows:
+        u, t = r["user_id"], r["created_at"]
+        if u not in earliest or t < earliest[u]:
+            earliest[u] = t
+
+    table = PostureLogPage.__table__
+    for user_id, since in earliest.items():
+        # since を含むページは since - PAGE_SPAN より後に始まる（索引の範囲で探せる）
+        conn.execute(
+            table.delete().where(
+                table.c.user_id == user_id,
+                table.c.page_start > since - PAGE_SPAN,
+                table.c.page_end >= since,
+            )
+        )
+
+
+def refresh_page_index(user_id, attempts=3):
+    """
+    ページ索引を最新のログまで進める。
+    読むのは「最後のページの開始時刻以降」のログの時刻だけ。
+    過去の時刻の行が入ったときは invalidate_pages でそれ以降のページが消えているので、
+    残っている最後のページから作り直しになる。
+    """
+    for _ in range(attempts):
+        if _extend_pages(user_id):
+            return
+
+
+def _extend_pages(user_id):
+    """refresh_page_index の1回分。最後のページが途中で消されていたら False（作り直す）"""
+    last = (
+        PostureLogPage.query
+        .filter_by(user_id=user_id)
+        .order_by(PostureLogPage.page_start.desc())
+        .first()
+    )
+
+    q = db.session.query(PostureLog.created_at).filter(PostureLog.user_id == user_id)
+    if last is not None:
+        # 新しいログが無ければ何もしない（インデックスで1件見るだけ）
+        newer = q.filter(PostureLog.created_at > last.page_end).limit(1).first()
+        if newer is None:
+            return True
+        q = q.filter(PostureLog.created_at >= last.page_start)
+
+    page_start = last.page_start if last is not None else None
+    page_end = None
+    pages = []
+    for (created_at,) in q.order_by(PostureLog.created_at.asc()).yield_per(1000):
+        if page_start is None:
+            page_start = created_at
+        elif created_at - page_start >= PAGE_SPAN:
+            pages.append((page_start, page_end))
+            page_start = created_at
+        page_end = created_at
+    if page_start is not None:
+        pages.append((page_start, page_end))
+
+    if not pages:
+        return True
+
+    if last is not None:
+        # 読んだ後に過去の時刻の行の書き込み（invalidate_pages）が最後のページを消していたら、
+        # 更新は0行になる（page_end が同じでも必ず書いて確かめる）。残りのページから作り直す
+        updated = db.session.execute(
+            sa.update(PostureLogPage)
+            .where(PostureLogPage.id == last.id)
+            .values(page_end=pages[0][1])
+        ).rowcount
+        if not updated:
+            db.session.rollback()
+            return False
+        pages = pages[1:]
+    for start, end in pages:
+        db.session.add(PostureLogPage(user_id=user_id, page_start=start, page_end=end))
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 別リクエストが同時に同じページを追加した場合（次回の表示で追いつく）
+        db.session.rollback()
+    return True
+
+
+def get_log_page(user_id, page):
+    """
+    page 番目（1 = 最新）のページのログを新しい順で返す。
+    戻り値: (logs, has_next)
+    """
+    if page < 1:
+        return [], False
+
+    with span("logs_index"):
+        refresh_page_index(user_id)
+
+    with span("logs_query"):
+        logs, has_next = _fetch_page(user_id, page)
+    return logs, has_next
+
+
+def _fetch_page(user_id, page):
+    # 表示だけなので読み取り用の接続で読む（索引の更新は書き込み側）
+    session = storage.read_session
+    pages = (
+        session.query(PostureLogPage)
+        .filter_by(user_id=user_id)
+        .order_by(PostureLogPage.page_start.desc())
+        .offset(page - 1)
+        .limit(2)
+        .all()
+    )
+    if not pages:
+        return [], False
+    target = pages[0]
+    has_next = len(pages) > 1
+
+    rows = (
+        session.query(PostureLog)
+        .filter(
+            PostureLog.user_id == user_id,
+            PostureLog.created_at >= target.page_start,
+            PostureLog.created_at <= target.page_end,
+        )
+        .order_by(PostureLog.created_at.asc())
+        .all()
+    )
+
+    # 2.5秒以上間隔があるログだけ残す
+    logs = []
+    last_time = None
+    for log in rows:
+        if last_time is None or log.created_at - last_time >= SAMPLE_GAP:
+            logs.append(log)
+            last_time = log.created_at
+
+    logs.reverse()
+    return logs, has_next
@@ -0,0 +1,183 @@
+# ========================
+# log_writer.py
+# ========================
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+# =========================
+# 姿勢ログのバックグラウンド書き込み
+# =========================
+class PostureLogWriter:
+    """
+    解析結果をメモリ上のキューに積み、別スレッドでまとめて INSERT する。
+
+    - batch_size 行たまるか flush_interval 秒経ったら executemany で書き込む
+    - キューが満杯の時は full_policy に従う
+        "drop"  : その行を捨てる（リクエストを待たせない）
+        "block" : block_timeout 秒まで空きを待ち、それでもダメなら捨てる
+    - プロセス終了時に残りを書き出す
+    - add_listener で登録した関数を、同じトランザクション内で書いた行と一緒に呼ぶ
+      （集計テーブルの更新など）
+    """
+
+    def __init__(self, db, app=None):
+        self._db = db
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._flush_ms_total = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.batch_size = app.config.get("LOG_WRITER_BATCH_SIZE", 200)
+        self.flush_interval = app.config.get("LOG_WRITER_FLUSH_MS", 500) / 1000.0
+        self.full_policy = app.config.get("LOG_WRITER_FULL_POLICY", "drop")
+        self.block_timeout = app.config.get("LOG_WRITER_BLOCK_TIMEOUT", 1.0)
+        self._queue = queue.Queue(maxsize=app.config.get("LOG_WRITER_QUEUE_SIZE", 10000))
+
+    def add_listener(self, table, fn):
+        """table に書いた行を fn(session, rows) にも渡す（commit 前に呼ぶ）。同じ fn は1回だけ"""
+        fns = self._listeners.setdefault(table, [])
+        if fn not in fns:
+            fns.append(fn)
+
+    # ---- 起動 / 停止 ----
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="posture-log-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=10.0):
+        """残りを書き出してからスレッドを止める"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    # ---- 投入 ----
+    def submit(self, table, row):
+        """1行分をキューに積む。書き込まれない場合は False"""
+        if self._thread is None:
+            # ライターが起動していない（CLI 等）場合はその場で書く
+            self._write({table: [row]})
+            return True
+
+        try:
+            if self.full_policy == "block":
+                self._queue.put((table, row), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((table, row))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    # ---- 状態 ----
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "avg_flush_ms": round(self._flush_ms_total / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+    # ---- スレッド本体 ----
+    def _run(self):
+        with self._app.app_context():
+            stopping = False
+            while not stopping:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                if item is _STOP:
+                    break
+
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                self._flush(batch)
+
+            # 停止時：キューに残っている分を全部書く
+            rest = []
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    rest.append(item)
+            if rest:
+                self._flush(rest)
+
+    def _flush(self, batch):
+        grouped = {}
+        for table, row in batch:
+            grouped.setdefault(table, []).append(row)
+
+        t0 = time.perf_counter()
+        self._write(grouped)
+        ms = (time.perf_counter() - t0) * 1000
+
+        self.flushes += 1
+        self.last_flush_ms = ms
+        self.max_flush_ms = max(self.max_flush_ms, ms)
+        self._flush_ms_total += ms
+
+    def _write(self, grouped):
+        session = self._db.session
+        try:
+            for table, rows in grouped.items():
+                session.execute(table.insert(), rows)
+                for fn in self._listeners.get(table, ()):
+                    fn(session, rows)
+            session.commit()
+            self.written += sum(len(r) for r in grouped.values())
+        except Exception:
+            session.rollback()
+            self.errors += 1
+            logger.exception("posture log flush failed")
@@ -0,0 +1,205 @@
+# ========================
+# metrics.py
+# ========================
+#
+# 処理時間のヒストグラムとカウンタ。/metrics で Prometheus 形式のテキストを返す。
+# 常時有効にしておけるよう、記録は「ロック1回 + 配列の加算」だけにしている。
+
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+trace_logger = logging.getLogger("posture.trace")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in pairs)
+    return "{" + inner + "}"
+
+
+# =========================
+# カウンタ
+# =========================
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for lv, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return lines
+
+
+# =========================
+# ヒストグラム
+# =========================
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}   # label_values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_values)
+            if s is None:
+                s = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for lv, s in sorted(series.items()):
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, ('le', le))} {acc}")
+            acc += s[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, ('le', '+Inf'))} {acc}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {s[-1]:.6f}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {acc}")
+        return lines
+
+
+# =========================
+# 外部の状態（キュー長など）をその場で読むゲージ
+# =========================
+class GaugeCollector:
+    """label を指定すると、fn() が返す {ラベル値: 値} をラベル付きで出す"""
+
+    def __init__(self, name, help_text, fn, kind="gauge", label=None):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.kind = kind
+        self.label = label
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.label is None:
+            lines.append(f"{self.name} {self.fn()}")
+        else:
+            for lv, v in sorted(self.fn().items()):
+                lines.append(f"{self.name}{_fmt_labels((self.label,), (lv,))} {v}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render_all():
+    lines = []
+    for m in REGISTRY:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# =========================
+# アプリで使う指標
+# =========================
+REQUEST_SECONDS = Histogram(
+    "posture_request_seconds", "HTTP リクエスト全体の処理時間", ("endpoint",))
+STAGE_SECONDS = Histogram(
+    "posture_stage_seconds", "処理段階ごとの所要時間", ("stage",))
+FRAMES = Counter(
+    "posture_frames_total", "解析したフレーム数（result: ok / no_pose / lock_rejected / degenerate / static / invalid）",
+    ("result",))
+INGEST_SAMPLES = Counter(
+    "posture_ingest_samples_total", "端末側推論で受け付けた件数（result: ok / lock_rejected / degenerate / invalid）",
+    ("result",))
+INFERENCE_SECONDS = Histogram(
+    "posture_inference_seconds", "モデル別の推論時間", ("tier",))
+MODEL_TIER_FRAMES = Counter(
+    "posture_model_tier_frames_total", "推論したフレーム数（モデル別）", ("tier",))
+EXPORT_ROWS = Counter(
+    "posture_export_rows_total", "エクスポートで書き出した行数（形式別）", ("format",))
+MODEL_TIER_SWITCHES = Counter(
+    "posture_model_tier_switches_total", "負荷によるモデルの切り替え回数", ("from", "to"))
+
+
+def span_record(stage, seconds):
+    """段階の所要時間を記録する（リクエスト中ならトレース用にも残す）"""
+    STAGE_SECONDS.observe(seconds, stage)
+    if has_request_context():
+        trace = g.get("stage_timings")
+        if trace is None:
+            trace = g.stage_timings = {}
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+
+def record_stages(timings):
+    for stage, seconds in timings.items():
+        span_record(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_record(stage, time.perf_counter() - t0)
+
+
+# =========================
+# Flask への組み込み
+# =========================
+def init_app(app):
+    sample = app.config.get("METRICS_TRACE_SAMPLE", 0.0)
+
+    @app.before_request
+    def _start_timer():
+        g.request_t0 = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        t0 = g.get("request_t0")
+        if t0 is None:
+            return response
+        elapsed = time.perf_counter() - t0
+        endpoint = request.endpoint or "other"
+        REQUEST_SECONDS.observe(elapsed, endpoint)
+
+        # 一部のリクエストだけ段階ごとの内訳をログに出す
+        if sample and random.random() < sample:
+            trace_logger.info(json.dumps({
+                "endpoint": endpoint,
+                "status": response.status_code,
+                "total_ms": round(elapsed * 1000, 3),
+                "stages_ms": {k: round(v * 1000, 3)
+                              for k, v in (g.get("stage_timings") or {}).items()},
+            }))
+        return response
@@ -0,0 +1,137 @@
+# ========================
+# migrate_logs.py
+# ========================
+#
+# 旧形式（ユーザーごとの posture_log_<username> テーブル）のログを
+# 共通の posture_log テーブルへ移行する。
+#
+#   python app/migrate_logs.py             # 移行（途中で止めても再実行で続きから）
+#   python app/migrate_logs.py --drop      # 移行が終わった旧テーブルを削除
+#   python app/migrate_logs.py --dry-run   # 対象テーブルと件数だけ表示
+
+import argparse
+
+import sqlalchemy as sa
+from flask import Flask
+
+from config import Config
+from extensions import db, storage
+from models.user import User  # noqa: F401  (posture_log の外部キー解決用)
+from models.posture import PostureLog
+from rollups import apply_rollups
+
+LEGACY_PREFIX = "posture_log_"
+COLUMNS = ("user_id", "posture", "posture_type",
+           "torso_angle", "neck_angle", "shoulder_tilt", "created_at")
+
+# =========================
+# 移行の進み具合（テーブルごとに最後に移した id）
+# =========================
+progress_meta = sa.MetaData()
+progress = sa.Table(
+    "log_migration_progress", progress_meta,
+    sa.Column("table_name", sa.String(128), primary_key=True),
+    sa.Column("last_id", sa.Integer, nullable=False, default=0),
+    sa.Column("done", sa.Boolean, nullable=False, default=False),
+)
+
+
+def legacy_tables(engine):
+    insp = sa.inspect(engine)
+    out = []
+    for name in sorted(insp.get_table_names()):
+        if not name.startswith(LEGACY_PREFIX):
+            continue
+        # 名前が似ているだけの別テーブルは除外（ログの列が揃っているものだけ）
+        cols = {c["name"] for c in insp.get_columns(name)}
+        if {"id", *COLUMNS} <= cols:
+            out.append(name)
+    return out
+
+
+def migrate_table(engine, name, chunk_size):
+    """1テーブル分を chunk_size 行ずつ移す。1チャンク = 1トランザクション"""
+    src = sa.Table(name, sa.MetaData(), autoload_with=engine)
+    dst = PostureLog.__table__
+
+    with engine.begin() as conn:
+        row = conn.execute(
+            sa.select(progress.c.last_id, progress.c.done).where(progress.c.table_name == name)
+        ).first()
+        if row is None:
+            conn.execute(progress.insert().values(table_name=name, last_id=0, done=False))
+            last_id, done = 0, False
+        else:
+            last_id, done = row
+    if done:
+        return 0
+
+    moved = 0
+    cols = [src.c[c] for c in COLUMNS]
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                sa.select(src.c.id, *cols)
+                .where(src.c.id > last_id)
+                .order_by(src.c.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                conn.execute(
+                    progress.update().where(progress.c.table_name == name).values(done=True)
+                )
+                break
+
+            moved_rows = [dict(zip(COLUMNS, r[1:])) for r in rows]
+            conn.execute(dst.insert(), moved_rows)
+            apply_rollups(conn, moved_rows)
+            last_id = rows[-1][0]
+            conn.execute(
+                progress.update().where(progress.c.table_name == name).values(last_id=last_id)
+            )
+        moved += len(rows)
+        print(f"  {name}: {moved} rows", end="\r", flush=True)
+    print()
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ユーザー別ログテーブルを posture_log に統合する")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--drop", action="store_true", help="移行済みの旧テーブルを削除する")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    storage.init_app(app)
+
+    with app.app_context():
+        engine = db.engine
+        PostureLog.__table__.create(engine, checkfirst=True)
+        progress_meta.create_all(engine)
+
+        names = legacy_tables(engine)
+        if not names:
+            print("移行対象のテーブルはありません")
+            return
+
+        for name in names:
+            if args.dry_run:
+                with engine.connect() as conn:
+                    count = conn.execute(sa.text(f'SELECT COUNT(*) FROM "{name}"')).scalar()
+                print(f"{name}: {count} rows")
+                continue
+
+            print(f"移行中: {name}")
+            migrate_table(engine, name, args.chunk_size)
+
+            if args.drop:
+                sa.Table(name, sa.MetaData()).drop(engine, checkfirst=True)
+                print(f"  削除: {name}")
+
+        print("移行完了")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# ========================
+# model_tiers.py
+# ========================
+#
+# 負荷に応じたモデルの切り替え（lite / full / heavy）
+#   推論時間の移動平均（EWMA）とプールの待ち行列の長さを見て、セッションごとに決める。
+#     - 推論時間が SLO を超える / 待ちが queue_high 以上 が down_after 回続いたら1段軽く
+#     - 1段重くした時の推定時間が SLO × headroom 未満で、待ちが無い状態が
+#       up_after 回続いたら1段重く
+#   下げるのは速く・上げるのはゆっくり、かつ上げる条件に余裕を持たせて行ったり来たりを防ぐ。
+#   重くした時の推論時間は、まだ測っていなければ COST_RATIO の比で見積もる。
+
+TIER_ORDER = ("lite", "full", "heavy")
+
+# full を 1 とした時の、おおよその推論コスト
+COST_RATIO = {"lite": 0.6, "full": 1.0, "heavy": 3.0}
+
+
+class TierController:
+    def __init__(self, tiers, start=None, slo_ms=80.0, queue_high=4,
+                 down_after=3, up_after=50, headroom=0.6, alpha=0.2):
+        """tiers: 使えるモデルの名前（TIER_ORDER の順に並べ直す）"""
+        self.tiers = [t for t in TIER_ORDER if t in tiers] + [t for t in tiers if t not in TIER_ORDER]
+        self.index = self.tiers.index(start) if start in self.tiers else 0
+        self.slo_ms = slo_ms
+        self.queue_high = queue_high
+        self.down_after = down_after
+        self.up_after = up_after
+        self.headroom = headroom
+        self.alpha = alpha
+
+        self.latency_ms = None   # 今のモデルの推論時間（EWMA）
+        self._over = 0
+        self._under = 0
+        self.switches = 0
+
+    @property
+    def current(self):
+        return self.tiers[self.index]
+
+    def reset(self):
+        """計測をやり直す（使うモデルはそのまま）"""
+        self.latency_ms = None
+        self._over = 0
+        self._under = 0
+
+    def observe(self, inference_s, queue_depth=0):
+        """推論1回分を記録する。切り替えるべき時は新しいモデル名、そうでなければ None"""
+        ms = inference_s * 1000.0
+        if self.latency_ms is None:
+            self.latency_ms = ms
+        else:
+            self.latency_ms += self.alpha * (ms - self.latency_ms)
+
+        if self.latency_ms > self.slo_ms or queue_depth >= self.queue_high:
+            self._under = 0
+            self._over += 1
+            if self._over >= self.down_after and self.index > 0:
+                return self._switch(-1)
+            return None
+        self._over = 0
+
+        if self.index + 1 >= len(self.tiers) or queue_depth > 0:
+            self._under = 0
+            return None
+        cur, nxt = self.current, self.tiers[self.index + 1]
+        estimate = self.latency_ms * COST_RATIO.get(nxt, 2.0) / COST_RATIO.get(cur, 1.0)
+        self._under = self._under + 1 if estimate < self.slo_ms * self.headroom else 0
+        if self._under >= self.up_after:
+            return self._switch(+1)
+        return None
+
+    def _switch(self, step):
+        self.index += step
+        self.reset()
+        self.switches += 1
+        return self.current
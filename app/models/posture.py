@@ -6,32 +6,90 @@ from extensions import db
 from datetime import datetime
 
 # =========================
-# グローバルキャッシュ
+# 姿勢ログモデル（全ユーザー共通の1テーブル）
 # =========================
-POSTURE_LOG_MODELS = {}
+class PostureLog(db.Model):
+    """
+    以前はユーザーごとに posture_log_<username> テーブルを作っていたが、
+    user_id で区別する1テーブルにまとめた（旧テーブルは migrate_logs.py で移行）。
+    (user_id, created_at) が先頭のインデックスなので、
+    サーバーDBでは user_id でのパーティション分割もそのまま可能。
+    """
+    __tablename__ = "posture_log"
+    __table_args__ = (
+        # /logs のページ取得・エクスポート用（ユーザー × 時刻の範囲検索）
+        db.Index("ix_posture_log_user_created", "user_id", "created_at"),
+    )
 
-def get_posture_log_model(username):
-    """ユーザー名から PostureLog モデルを返す"""
-    if username not in POSTURE_LOG_MODELS:
-        tablename = f"posture_log_{username}"
+    id = db.Column(db.Integer, primary_key=True)
+    posture = db.Column(db.String(16))       # good / bad
+    posture_type = db.Column(db.String(32))  # slouch / normal
+    torso_angle = db.Column(db.Float)
+    neck_angle = db.Column(db.Float)
+    shoulder_tilt = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
-        class PostureLog(db.Model):
-            __tablename__ = tablename
+    user = db.relationship("User", backref=db.backref("posture_logs", lazy="dynamic"))
 
-            id = db.Column(db.Integer, primary_key=True)  # primary key 必須
-            posture = db.Column(db.String(16))       # good / bad
-            posture_type = db.Column(db.String(32))  # slouch / normal
-            torso_angle = db.Column(db.Float)
-            neck_angle = db.Column(db.Float)
-            shoulder_tilt = db.Column(db.Float)
-            created_at = db.Column(db.DateTime, default=datetime.utcnow)
-            user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
-            user = db.relationship("User", backref=f"{username}_logs")
+# =========================
+# ログ表示用のページ索引
+# =========================
+class PostureLogPage(db.Model):
+    """
+    /logs の1ページ（5分区切り）の開始・終了時刻。
+    新しいログが来た分だけ追記・更新するので、全履歴を読み直す必要がない。
+    """
+    __tablename__ = "log_page_index"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "page_start", name="uq_log_page_index_user_start"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    page_start = db.Column(db.DateTime, nullable=False)
+    page_end = db.Column(db.DateTime, nullable=False)
+
+
+# =========================
+# 集計（分・時・日ごと）
+# =========================
+class PostureRollup(db.Model):
+    """
+    ユーザー × 粒度（minute / hour / day）× 区間開始時刻（UTC）ごとの集計。
+    件数と合計・最小・最大だけを持つので、行を足すのも区間をまとめるのも加算で済む
+    （平均は sum / n）。更新・再集計は rollups.py。
+    """
+    __tablename__ = "posture_rollup"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "tier", "bucket_start", name="uq_posture_rollup_bucket"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    tier = db.Column(db.String(8), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
 
-        POSTURE_LOG_MODELS[username] = PostureLog
-    return POSTURE_LOG_MODELS[username]
+    n = db.Column(db.Integer, nullable=False, default=0)
+    n_good = db.Column(db.Integer, nullable=False, default=0)
+    n_bad = db.Column(db.Integer, nullable=False, default=0)
 
+    # posture_type ごとの件数
+    n_normal = db.Column(db.Integer, nullable=False, default=0)
+    n_slouch = db.Column(db.Integer, nullable=False, default=0)
+    n_bad_slouch = db.Column(db.Integer, nullable=False, default=0)
+    n_severe_slouch = db.Column(db.Integer, nullable=False, default=0)
+    n_forward_head = db.Column(db.Integer, nullable=False, default=0)
+    n_shoulder_tilt = db.Column(db.Integer, nullable=False, default=0)
+    n_other = db.Column(db.Integer, nullable=False, default=0)
 
-# ここで PostureLog として「ユーザーごとにモデルを取得する関数」を公開
-PostureLog = get_posture_log_model  # ← from models.posture import PostureLog で使える
+    torso_sum = db.Column(db.Float, nullable=False, default=0.0)
+    torso_min = db.Column(db.Float)
+    torso_max = db.Column(db.Float)
+    neck_sum = db.Column(db.Float, nullable=False, default=0.0)
+    neck_min = db.Column(db.Float)
+    neck_max = db.Column(db.Float)
+    tilt_sum = db.Column(db.Float, nullable=False, default=0.0)
+    tilt_min = db.Column(db.Float)
+    tilt_max = db.Column(db.Float)
@@ -0,0 +1,31 @@
+# =========================
+# models/seat.py
+# =========================
+
+from extensions import db
+
+# =========================
+# 共有カメラの席（ゾーン）
+# =========================
+class SeatZone(db.Model):
+    """
+    共有カメラの画面上の矩形（0..1 座標）と、そこに座るユーザー。
+    複数人モードでは、腰の中点が入っている席のユーザーに姿勢ログを記録する。
+    """
+    __tablename__ = "seat_zone"
+    __table_args__ = (
+        db.Index("ix_seat_zone_camera", "camera_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    camera_id = db.Column(db.String(64), nullable=False)
+    name = db.Column(db.String(64))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    x0 = db.Column(db.Float, nullable=False)
+    y0 = db.Column(db.Float, nullable=False)
+    x1 = db.Column(db.Float, nullable=False)
+    y1 = db.Column(db.Float, nullable=False)
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "user_id": self.user_id,
+                "rect": [self.x0, self.y0, self.x1, self.y1]}
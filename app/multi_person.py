@@ -0,0 +1,197 @@
+# ========================
+# multi_person.py
+# ========================
+#
+# 共有カメラ（1台で複数の席を映す）用の複数人モード
+#   - 1回の推論で最大 max_poses 人を検出する
+#   - 前フレームの人物（トラック）と、画面上の腰の位置が近い順に貪欲に対応付ける
+#     （人数が少ないので総当たりの距離表で十分）
+#   - トラックごとに解析器（推論器なし）を持ち、EMA / 人ロックはトラックごとに効く
+#   - 腰の中点が入っている席（SeatZone）のユーザーに結果を記録する。
+#     キャリブレーション（baseline）はユーザーごとに持ち、席に入ったトラックに渡す
+
+import time
+from dataclasses import replace
+
+import numpy as np
+
+from posture_check import L_HIP, L_SH, R_HIP, R_SH, PosePostureAnalyzer, PostureBaseline
+
+
+class _Track:
+    def __init__(self, track_id, analyzer, center):
+        self.id = track_id
+        self.analyzer = analyzer
+        self.center = center
+        self.missed = 0
+        self.user_id = None
+        self.zone = None
+
+
+class MultiPersonAnalyzer(PosePostureAnalyzer):
+    def __init__(self, model_path, cfg, max_poses=6, max_match_dist=0.15, max_missed=15, load_fn=None,
+                 detector_factory=None):
+        """
+        max_match_dist: 前フレームと同じ人とみなす腰の移動量の上限（画面の 0..1 座標）
+        max_missed    : この回数続けて見つからなかったトラックは捨てる
+        """
+        # 席ごとの追跡・静止判定・ROI は1人用なので使わない
+        self._track_cfg = replace(cfg, tracking=False, static_skip=False, roi_crop=False, num_poses=1)
+        super().__init__(model_path, replace(self._track_cfg, num_poses=max_poses), load_fn,
+                         detector_factory)
+        self.max_match_dist = max_match_dist
+        self.max_missed = max_missed
+
+        self.tracks = {}
+        self._next_id = 1
+        self.zones = []          # [(席名, user_id, x0, y0, x1, y1), ...]
+        self.baselines = {}      # user_id -> PostureBaseline
+
+    # ---- AnalyzerPool が退避・復元する baseline はユーザーごとの辞書 ----
+    @property
+    def baseline(self):
+        return dict(self.baselines) or None
+
+    @baseline.setter
+    def baseline(self, value):
+        if isinstance(value, PostureBaseline):
+            raise TypeError("MultiPersonAnalyzer の baseline は {user_id: PostureBaseline}。calibrate_user を使う")
+        self.baselines = dict(value or {})
+
+    def set_zones(self, zones):
+        """zones: SeatZone のリスト（セッションを閉じた後も使えるよう値だけ写す）"""
+        self.zones = [(z.name, z.user_id, z.x0, z.y0, z.x1, z.y1) for z in zones]
+
+    def reset_ema(self):
+        self.tracks = {}
+
+    # =========================
+    # 解析
+    # =========================
+    def analyze(self, frame_bgr, timestamp_ms=None):
+        """
+        フレーム内の全員を解析する。
+        戻り値: 人ごとの結果のリスト
+          {"track_id", "user_id", "zone", "metrics", "judge", "posture_type", "landmarks", ...}
+        """
+        if self.detector is None:
+            raise RuntimeError("Analyzer was created without a model.")
+        if timestamp_ms is None:
+            self._tick()
+        else:
+            self._ts = int(timestamp_ms)
+        timings = self.last_timings = {}
+
+        res, color_s, inference_s = self._detect(frame_bgr)
+        t2 = time.perf_counter()
+        timings["color"] = color_s
+        timings["inference"] = inference_s
+        self.last_switch = None
+        self._observe_tier(inference_s)
+
+        poses = list(zip(res.pose_world_landmarks or [], res.pose_landmarks or []))
+        people = self.analyze_poses(poses)
+        timings["tracking"] = time.perf_counter() - t2
+        return people
+
+    def analyze_poses(self, poses):
+        """推論済みの [(ワールド座標, 画像座標), ...] を対応付けて人ごとに解析する"""
+        packed = [(self._lm_list_to_array(w), self._lm_list_to_array(i)) for w, i in poses]
+        centers = [self._center(image) for _, image in packed]
+        matches = self._assign(centers)
+
+        people = []
+        for det, track in matches.items():
+            world, image = packed[det]
+            self._attribute(track)
+            out = track.analyzer.analyze_landmarks(world, image)
+            if out is None:
+                continue
+            out = track.analyzer.classify_result(out)
+            out.update(track_id=track.id, user_id=track.user_id, zone=track.zone)
+            people.append(out)
+
+        self.last_status = "ok" if people else "no_pose"
+        return people
+
+    def analyze_and_save(self, frame_bgr):
+        """全員を解析し、席に座っているユーザーの分だけ保存する"""
+        people = self.analyze(frame_bgr)
+        t0 = time.perf_counter()
+        for out in people:
+            if out["user_id"] is not None:
+                self.recorder.save(metrics=out["metrics"], judge=out["judge"],
+                                   posture_type=out["posture_type"], user_id=out["user_id"])
+        self.last_timings["save"] = time.perf_counter() - t0
+        return people
+
+    def calibrate(self, metrics_avg):
+        """1人分の姿勢では誰のものか決まらないので、席にいる全員の baseline にする"""
+        for user_id in {t.user_id for t in self.tracks.values() if t.user_id is not None}:
+            self.calibrate_user(user_id, metrics_avg)
+
+    def calibrate_user(self, user_id, metrics):
+        """そのユーザーの正しい姿勢を記録し、席にいるトラックにも反映する"""
+        self.baselines[user_id] = PostureBaseline(**metrics)
+        for track in self.tracks.values():
+            if track.user_id == user_id:
+                track.analyzer.calibrate(metrics)
+
+    # =========================
+    # トラックの対応付け
+    # =========================
+    @staticmethod
+    def _center(image):
+        """腰の中点（腰が見えていなければ肩の中点）の画面座標"""
+        if image[[L_HIP, R_HIP], 3].min() > 0.3:
+            return (image[L_HIP, :2] + image[R_HIP, :2]) * 0.5
+        return (image[L_SH, :2] + image[R_SH, :2]) * 0.5
+
+    def _assign(self, centers):
+        """検出 → トラックの対応。近い組から順に確定させる（貪欲法）"""
+        tracks = list(self.tracks.values())
+        pairs = []
+        for ti, track in enumerate(tracks):
+            for di, c in enumerate(centers):
+                d = float(np.hypot(*(c - track.center)))
+                if d <= self.max_match_dist:
+                    pairs.append((d, ti, di))
+        pairs.sort()
+
+        matches = {}
+        used = set()
+        for _, ti, di in pairs:
+            if ti in used or di in matches:
+                continue
+            used.add(ti)
+            matches[di] = tracks[ti]
+            tracks[ti].center = centers[di]
+            tracks[ti].missed = 0
+
+        for ti, track in enumerate(tracks):
+            if ti not in used:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    del self.tracks[track.id]
+
+        for di, c in enumerate(centers):
+            if di not in matches:
+                track = _Track(self._next_id, PosePostureAnalyzer(None, self._track_cfg), c)
+                self._next_id += 1
+                self.tracks[track.id] = track
+                matches[di] = track
+        return matches
+
+    def _attribute(self, track):
+        """トラックの位置から席とユーザーを決める。席が変わったら baseline も入れ替える"""
+        x, y = float(track.center[0]), float(track.center[1])
+        zone, user_id = None, None
+        for name, uid, x0, y0, x1, y1 in self.zones:
+            if x0 <= x < x1 and y0 <= y < y1:
+                zone, user_id = name, uid
+                break
+        track.zone = zone
+        if user_id != track.user_id:
+            track.user_id = user_id
+            track.analyzer.reset_ema()
+            track.analyzer.baseline = self.baselines.get(user_id)
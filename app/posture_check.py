@@ -3,17 +3,41 @@
 # ========================
 
 from dataclasses import dataclass
+from datetime import datetime
+from operator import attrgetter
 import math
 import time
 import numpy as np
 import cv2
-import mediapipe as mp
 from flask_login import current_user
-from mediapipe.tasks import python as mp_python
-from mediapipe.tasks.python import vision as mp_vision
 
-from models.posture import PostureLog  # ← これは「関数（モデル取得）」として使う
-from extensions import db
+from models.posture import PostureLog
+from frame_preprocess import crop_to_roi, thread_buffers, uncrop_landmarks, update_roi
+from landmark_tracker import LandmarkTracker
+from scene_gate import StaticSceneGate
+from model_tiers import TierController
+from extensions import log_writer
+
+# =========================
+# モデルの読み込み
+# =========================
+# mediapipe は重いので推論器を作る時に初めて import する（landmark だけ扱うプロセスは読まない）
+_model_buffers = {}   # モデルのパス -> 中身（preload_models で先に読んだもの）
+
+
+def preload_models(paths):
+    """
+    mediapipe の import とモデルファイルの読み込みを先に済ませる。
+    fork 前に呼ぶと、子プロセスはこれらをコピーオンライトで共有する
+    """
+    import mediapipe  # noqa: F401
+    from mediapipe.tasks.python import vision  # noqa: F401
+
+    for path in paths:
+        if path not in _model_buffers:
+            with open(path, "rb") as f:
+                _model_buffers[path] = f.read()
+
 
 # =========================
 # Config / Baseline
@@ -37,6 +61,29 @@ class PostureConfig:
     neck_angle_thr: float = 2.0
     shoulder_tilt_thr: float = 3.0
     ema_alpha: float = 0.23
+    roi_crop: bool = True       # 前フレームの人物まわりだけを推論する
+    roi_margin: float = 0.25    # ROI の余白（人物の大きさに対する割合）
+    roi_move_thr: float = 0.15  # ROI の辺がこれ以上（ROI の大きさに対する割合）動いたら切り出し直す
+    # キーフレームだけ推論し、間はオプティカルフローで上半身の点を追う
+    # （追跡したフレームは表示用。角度・判定はキーフレームのものを返し、保存しない）
+    tracking: bool = False
+    keyframe_interval: int = 8      # キーフレームの間に追跡で済ませる最大フレーム数
+    track_max_side: int = 320       # 追跡に使うグレー画像の長辺
+    track_fb_thr: float = 1.0       # 前後フロー誤差の上限（px）
+    track_max_motion: float = 0.05  # キーフレームからの移動量の上限（長辺比）
+    # 画面が変わっていなければ前回の結果を使い回す（推論も保存もしない）
+    static_skip: bool = False
+    static_change_ratio: float = 0.01   # 変化した画素の割合がこれ以下なら静止
+    static_max_reuse_s: float = 30.0    # これ以上経ったら静止していても解析し直す
+    poll_min_ms: int = 200              # 提案するポーリング間隔の範囲
+    poll_max_ms: int = 5000
+    num_poses: int = 1                  # 1回の推論で検出する最大人数（複数人モード用）
+    # モデルを複数渡した時の切り替え（model_tiers.py）
+    start_tier: str = "full"
+    tier_slo_ms: float = 80.0           # 推論時間の目標
+    tier_queue_high: int = 4            # プールの待ちがこれ以上なら軽くする
+    tier_down_after: int = 3
+    tier_up_after: int = 50
 
 @dataclass
 class PostureBaseline:
@@ -62,43 +109,134 @@ class EMA:
             self.v = self.a * x + (1 - self.a) * self.v
         return self.v
 
-# =========================
-# Utils: 動的モデル取得
-# =========================
-def get_log_model_for_current_user():
-    
+
+class EMABank:
     """
-    current_user.username から動的な PostureLog モデルクラスを取得する。
-    ※ current_user が使えるのはリクエスト中のみ
+    複数の値（torso / neck / tilt）をまとめて平滑化する EMA。
+    update は1サンプルずつ、filter は (T, n) の系列を一度に処理する（結果は同じ）。
     """
-    if not current_user.is_authenticated:
-        raise RuntimeError("User is not authenticated.")
+    def __init__(self, a: float, n: int):
+        self.a = a
+        self.n = n
+        self.v = None
+        # b^-k が float64 で溢れない長さでブロックに分けて閉形式で計算する
+        b = 1.0 - a
+        self._block = 256 if b >= 0.5 else max(1, min(256, int(600 / -math.log(b)))) if b > 0 else 1
 
-    LogModel = PostureLog(current_user.username)  # ← 動的生成（クラスが返る）
+    def reset(self):
+        self.v = None
 
-    # 動的テーブル運用の場合、初回だけ create_all が必要になることがある
-    # ただし毎フレーム呼ぶのは重いので、必要なら「初回だけ」等の仕組みにすること推奨
-    db.create_all()
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.v is None:
+            self.v = x.copy()
+        else:
+            self.v = self.a * x + (1 - self.a) * self.v
+        return self.v
+
+    def filter(self, xs):
+        xs = np.asarray(xs, dtype=np.float64)
+        out = np.empty_like(xs)
+        if len(xs) == 0:
+            return out
+
+        start = 0
+        if self.v is None:
+            self.v = xs[0].copy()
+            out[0] = self.v
+            start = 1
+
+        a, b = self.a, 1.0 - self.a
+        if b == 0.0:
+            out[start:] = xs[start:]
+            self.v = xs[-1].copy()
+            return out
+
+        for s in range(start, len(xs), self._block):
+            blk = xs[s:s + self._block]
+            decay = b ** np.arange(1, len(blk) + 1)[:, None]
+            # y_k = b^k * (v + a * Σ_{j<=k} x_j * b^-j)
+            y = decay * (self.v + a * np.cumsum(blk / decay, axis=0))
+            out[s:s + len(blk)] = y
+            self.v = y[-1].copy()
+        return out
+
+# =========================
+# 角度計算カーネル（1フレーム / 複数フレーム共通）
+# =========================
+NOSE = 0
+L_SH, R_SH = 11, 12
+L_HIP, R_HIP = 23, 24
 
-    return LogModel
+
+def posture_kernel(world):
+    """
+    world: (33, 3以上) または (T, 33, 3以上) のワールド座標
+    戻り値:
+      angles (..., 3)  [torso_angle, neck_angle, shoulder_tilt]（度）
+      center (..., 3)  肩の中点（人ロック用）
+      ok     (...)     胴・首のベクトルが潰れていない
+    """
+    if np.ndim(world) == 2:
+        return _posture_kernel_single(world)
+
+    w = np.asarray(world, dtype=np.float64)[..., :3]
+    shoulder = (w[..., L_SH, :] + w[..., R_SH, :]) * 0.5
+    hip = (w[..., L_HIP, :] + w[..., R_HIP, :]) * 0.5
+
+    torso = shoulder - hip
+    neck = w[..., NOSE, :] - shoulder
+    sh = w[..., L_SH, :] - w[..., R_SH, :]
+
+    angles = np.empty(w.shape[:-2] + (3,))
+    angles[..., 0] = np.arctan2(torso[..., 2], -torso[..., 1])  # Z vs -Y
+    angles[..., 1] = np.arctan2(neck[..., 2], -neck[..., 1])
+    angles[..., 2] = np.arctan2(sh[..., 1], sh[..., 0])         # Y vs X
+    np.degrees(angles, out=angles)
+
+    ok = ((torso * torso).sum(-1) >= 1e-8) & ((neck * neck).sum(-1) >= 1e-8)
+    return angles, shoulder, ok
+
+
+def _posture_kernel_single(world):
+    """1フレーム用（小さい配列に numpy 演算を重ねるより float の計算の方が速い）"""
+    (nx, ny, nz), (lx, ly, lz), (rx, ry, rz), (hlx, hly, hlz), (hrx, hry, hrz) = (
+        world[[NOSE, L_SH, R_SH, L_HIP, R_HIP], :3].tolist()
+    )
+    sx, sy, sz = (lx + rx) * 0.5, (ly + ry) * 0.5, (lz + rz) * 0.5
+    tx, ty, tz = sx - (hlx + hrx) * 0.5, sy - (hly + hry) * 0.5, sz - (hlz + hrz) * 0.5
+    kx, ky, kz = nx - sx, ny - sy, nz - sz
+
+    angles = np.array([
+        math.degrees(math.atan2(tz, -ty)),
+        math.degrees(math.atan2(kz, -ky)),
+        math.degrees(math.atan2(ly - ry, lx - rx)),
+    ])
+    ok = (tx * tx + ty * ty + tz * tz >= 1e-8) and (kx * kx + ky * ky + kz * kz >= 1e-8)
+    return angles, np.array([sx, sy, sz]), ok
 
 # =========================
 # Recorder
 # =========================
 class PostureRecorder:
-    def save(self, metrics, judge, posture_type):
-        LogModel = get_log_model_for_current_user()
-
-        log = LogModel(
-            user_id=current_user.id,
-            posture=judge,  # ← judge ではなく posture カラム
-            posture_type=posture_type,
-            torso_angle=metrics["torso_angle"],
-            neck_angle=metrics["neck_angle"],
-            shoulder_tilt=metrics["shoulder_tilt"]
-        )
-        db.session.add(log)
-        db.session.commit()
+    def save(self, metrics, judge, posture_type, user_id=None, created_at=None):
+        """user_id を省略するとログイン中のユーザーに記録する。created_at の既定は今（UTC）"""
+        if user_id is None:
+            # ※ current_user が使えるのはリクエスト中のみ
+            if not current_user.is_authenticated:
+                raise RuntimeError("User is not authenticated.")
+            user_id = current_user.id
+
+        # 書き込みはバックグラウンドでまとめて行う（リクエストはディスクI/Oを待たない）
+        log_writer.submit(PostureLog.__table__, {
+            "user_id": user_id,
+            "posture": judge,  # ← judge ではなく posture カラム
+            "posture_type": posture_type,
+            "torso_angle": metrics["torso_angle"],
+            "neck_angle": metrics["neck_angle"],
+            "shoulder_tilt": metrics["shoulder_tilt"],
+            "created_at": created_at or datetime.utcnow(),
+        })
 
 def classify_posture(m, cfg: PostureConfig):
     if abs(m["torso_angle"]) > cfg.torso_angle_thr * 2:
@@ -131,34 +269,185 @@ class PostureCalibrator:
 # Analyzer
 # =========================
 class PosePostureAnalyzer:
-    def __init__(self, model_path: str, cfg: PostureConfig):
+    def __init__(self, model_path: str | dict | None, cfg: PostureConfig, load_fn=None,
+                 detector_factory=None):
+        """
+        model_path が None の場合は推論器を作らない（ランドマーク入力専用）。
+        {"lite": パス, "full": パス, ...} を渡すと、推論時間と load_fn()（プールの待ち数）を
+        見てモデルを切り替える。
+        detector_factory(model_path, num_poses) を渡すと推論器をそれで作る
+        （推論プロセスで推論する場合は InferenceService.detector）
+        """
         self.cfg = cfg
         self.baseline: PostureBaseline | None = None
         self.recorder = PostureRecorder()
 
         self._locked_center = None
         self._lock_dist_thr = 0.6
+        self._roi = None
+
+        self.ema = EMABank(cfg.ema_alpha, 3)   # torso / neck / tilt
 
-        self.ema_torso = EMA(cfg.ema_alpha)
-        self.ema_neck = EMA(cfg.ema_alpha)
-        self.ema_tilt = EMA(cfg.ema_alpha)
+        self.tracker = None
+        if cfg.tracking:
+            self.tracker = LandmarkTracker(cfg.track_max_side, cfg.track_fb_thr, cfg.track_max_motion)
+        self._since_key = 0
+        self._key_metrics = None   # 直近のキーフレームの角度（追跡したフレームはこれを返す）
+
+        self.scene_gate = None
+        if cfg.static_skip:
+            self.scene_gate = StaticSceneGate(
+                change_ratio=cfg.static_change_ratio, max_reuse_s=cfg.static_max_reuse_s,
+                poll_min_ms=cfg.poll_min_ms, poll_max_ms=cfg.poll_max_ms,
+            )
 
         self._ts = 0
         self._last = time.perf_counter()
 
-        base = mp_python.BaseOptions(model_asset_path=model_path)
+        # 直近フレームの処理段階ごとの所要時間（秒）と結果
+        # last_status: ok / no_pose / lock_rejected / degenerate / static
+        # last_keyframe: 直近フレームを推論したか（False なら追跡で推定した）
+        self.last_timings = {}
+        self.last_status = None
+        self.last_keyframe = True
+
+        # last_switch: 直近フレームでモデルを切り替えた時の (前, 後)
+        self.last_switch = None
+
+        self.detector = None
+        self.model_tier = None
+        self.tiers = None
+        self._load_fn = load_fn
+        self._detector_factory = detector_factory
+        if model_path is None:
+            return
+
+        if isinstance(model_path, dict):
+            self._model_paths = dict(model_path)
+            if len(self._model_paths) > 1:
+                self.tiers = TierController(
+                    self._model_paths, cfg.start_tier, cfg.tier_slo_ms, cfg.tier_queue_high,
+                    cfg.tier_down_after, cfg.tier_up_after,
+                )
+                self._use_tier(self.tiers.current)
+            else:
+                self._use_tier(next(iter(self._model_paths)))
+        else:
+            self.detector = self._create_detector(model_path)
+
+    def _create_detector(self, model_path):
+        if self._detector_factory is not None:
+            return self._detector_factory(model_path, self.cfg.num_poses)
+
+        from mediapipe.tasks import python as mp_python
+        from mediapipe.tasks.python import vision as mp_vision
+
+        buf = _model_buffers.get(model_path)
+        if buf is not None:
+            base = mp_python.BaseOptions(model_asset_buffer=buf)
+        else:
+            base = mp_python.BaseOptions(model_asset_path=model_path)
         options = mp_vision.PoseLandmarkerOptions(
             base_options=base,
             running_mode=mp_vision.RunningMode.VIDEO,
-            num_poses=1
+            num_poses=self.cfg.num_poses
         )
-        self.detector = mp_vision.PoseLandmarker.create_from_options(options)
+        return mp_vision.PoseLandmarker.create_from_options(options)
+
+    def _detect(self, frame_bgr):
+        """
+        推論する。戻り値: (結果, 色変換の秒数, 推論の秒数)
+        推論プロセスの推論器には BGR のまま渡す（RGB への変換は共有メモリへの書き込みと一緒に行う）
+        """
+        if getattr(self.detector, "remote", False):
+            t0 = time.perf_counter()
+            res = self.detector.detect_bgr(frame_bgr, self._ts)
+            return res, res.copy_s, time.perf_counter() - t0 - res.copy_s
+
+        import mediapipe as mp
+
+        # RGB はスレッドのバッファに変換する（フレームごとに確保しない）
+        t0 = time.perf_counter()
+        mp_img = mp.Image(image_format=mp.ImageFormat.SRGB, data=thread_buffers().to_rgb(frame_bgr))
+        t1 = time.perf_counter()
+        res = self.detector.detect_for_video(mp_img, self._ts)
+        mp_img = None   # 中にフレームのコピーを持っているので推論後すぐ手放す
+        return res, t1 - t0, time.perf_counter() - t1
+
+    def _use_tier(self, tier):
+        """
+        モデルを切り替える。前のモデルの推論器は閉じ、解析器ごとに推論器は常に1つにする
+        （ANALYZER_POOL_MAX_SESSIONS がそのままメモリに載る推論グラフの上限になる）。
+        （preload_models で読んであれば、作り直しでディスクは読まない）
+        """
+        detector = self._create_detector(self._model_paths[tier])
+        if self.detector is not None:
+            self.detector.close()
+        self.detector = detector
+        self.model_tier = tier
+
+    def _observe_tier(self, inference_s):
+        if self.tiers is None:
+            return
+        depth = self._load_fn() if self._load_fn is not None else 0
+        new = self.tiers.observe(inference_s, depth)
+        if new is not None:
+            self.last_switch = (self.model_tier, new)
+            self._use_tier(new)
+
+    def close(self):
+        if self.detector is not None:
+            self.detector.close()
+            self.detector = None
+
+    def warm_up(self, frame_bgr):
+        """ダミー画像で1回推論して推論器の初期化を済ませる（結果・負荷の記録は残さない）"""
+        if self.detector is None:
+            return
+        self.analyze(frame_bgr)
+        if self.tiers is not None:
+            self.tiers.reset()
+        self.reset_ema()
+        self.last_timings = {}
+        self.last_status = None
+        self.last_switch = None
 
     def reset_ema(self):
-        self.ema_torso.reset()
-        self.ema_neck.reset()
-        self.ema_tilt.reset()
+        self.ema.reset()
         self._locked_center = None
+        self._roi = None
+        if self.tracker is not None:
+            self.tracker.reset()
+        if self.scene_gate is not None:
+            self.scene_gate.reset()
+
+    # =========================
+    # 静止シーンの使い回し
+    # =========================
+    def reuse_if_static(self, thumb):
+        """
+        前回解析した時から画面が変わっていなければ (True, 前回の結果) を返す。
+        thumb は frame_preprocess.decode_thumbnail の結果。解析が必要なら (False, None)
+        """
+        if self.scene_gate is None:
+            return False, None
+        hit, out = self.scene_gate.lookup(thumb)
+        if hit:
+            self.last_timings = {}
+            self.last_status = "static"
+            self.last_switch = None
+        return hit, out
+
+    def remember_scene(self, thumb, out):
+        """解析したフレームのサムネイルと結果を、次の静止判定の基準にする"""
+        if self.scene_gate is not None:
+            self.scene_gate.store(thumb, out)
+
+    def next_poll_ms(self):
+        """クライアントに提案する次のフレームまでの間隔（静止判定が無効なら None）"""
+        if self.scene_gate is None:
+            return None
+        return self.scene_gate.next_poll_ms()
 
     def _tick(self):
         now = time.perf_counter()
@@ -166,101 +455,257 @@ class PosePostureAnalyzer:
         self._last = now
         self._ts += dt
 
-    @staticmethod
-    def _angle_from_vertical(v):
-        n = np.linalg.norm(v)
-        if n < 1e-6:
-            return 0.0
-        v = v / n
-        return math.degrees(math.atan2(v[2], -v[1]))  # Z vs -Y
-
-    @staticmethod
-    def _angle_from_horizontal(v):
-        return math.degrees(math.atan2(v[1], v[0]))  # Y vs X
-
-    @staticmethod
-    def _lm_list_to_dicts(lms):
-        out = []
-        for lm in lms:
-            out.append({
-                "x": float(lm.x),
-                "y": float(lm.y),
-                "z": float(lm.z),
-                "visibility": float(getattr(lm, "visibility", 0.0)),
-                "presence": float(getattr(lm, "presence", 0.0))
-            })
-        return out
-
-    def analyze(self, frame_bgr):
-        self._tick()
-
-        rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-        mp_img = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb)
-        res = self.detector.detect_for_video(mp_img, self._ts)
+    _LM_FIELDS = attrgetter("x", "y", "z", "visibility", "presence")
+
+    @classmethod
+    def _lm_list_to_array(cls, lms):
+        """ランドマーク列を (N, 5) float32 [x, y, z, visibility, presence] に詰める"""
+        if isinstance(lms, np.ndarray):
+            # 詰め済みの配列（後段で書き換えるのでコピーする）
+            arr = np.zeros((len(lms), 5), np.float32)
+            arr[:, :lms.shape[1]] = lms[:, :5]
+            return arr
+        g = cls._LM_FIELDS
+        try:
+            return np.array([g(lm) for lm in lms], dtype=np.float32)
+        except (TypeError, AttributeError):
+            # visibility / presence が無い（None の）ランドマーク
+            return np.array([
+                (lm.x, lm.y, lm.z,
+                 getattr(lm, "visibility", None) or 0.0,
+                 getattr(lm, "presence", None) or 0.0)
+                for lm in lms
+            ], dtype=np.float32)
+
+    def analyze(self, frame_bgr, timestamp_ms=None):
+        """timestamp_ms を渡すとその時刻で推論する（録画ファイルの解析用。単調増加であること）"""
+        if self.detector is None:
+            raise RuntimeError("Analyzer was created without a model.")
+        if timestamp_ms is None:
+            self._tick()
+        else:
+            self._ts = int(timestamp_ms)
+        timings = self.last_timings = {}
+        self.last_switch = None
+
+        # キーフレームの間は追跡で済ませる。追えなければこのフレームを推論する
+        if (self.tracker is not None and self.tracker.active
+                and self._since_key < self.cfg.keyframe_interval):
+            out = self._analyze_tracked(frame_bgr)
+            if out is not None:
+                if self.model_tier is not None:
+                    out["model_tier"] = self.model_tier
+                return out
+
+        # 前フレームで人がいた範囲だけを変換・推論する
+        t0 = time.perf_counter()
+        frame, roi_offset = crop_to_roi(frame_bgr, self._roi if self.cfg.roi_crop else None)
+        t1 = time.perf_counter()
+        res, color_s, inference_s = self._detect(frame)
+        timings["color"] = (t1 - t0) + color_s
+        timings["inference"] = inference_s
+        self.last_keyframe = True
+        self._since_key = 0
+        tier = self.model_tier
+        self._observe_tier(inference_s)   # 次のフレームから使うモデルを決める
 
         if not res.pose_world_landmarks:
             self._locked_center = None
+            self._roi = None
+            if self.tracker is not None:
+                self.tracker.reset()
+            self.last_status = "no_pose"
             return None
 
         lm_world = res.pose_world_landmarks[0]
         lm_image = res.pose_landmarks[0] if res.pose_landmarks else None
 
-        NOSE = 0
-        L_SH, R_SH = 11, 12
-        L_HIP, R_HIP = 23, 24
+        out = self.analyze_landmarks(lm_world, lm_image, roi_offset)
+        if self.tracker is not None:
+            if out is None:
+                self.tracker.reset()
+            else:
+                t3 = time.perf_counter()
+                self.tracker.start(frame_bgr, out["landmarks"], out["world_landmarks"])
+                self._key_metrics = dict(out["metrics"])
+                timings["track"] = time.perf_counter() - t3
+        if out is not None and tier is not None:
+            out["model_tier"] = tier
+        return out
 
-        p = lambda i: np.array([lm_world[i].x, lm_world[i].y, lm_world[i].z])
+    def _analyze_tracked(self, frame_bgr):
+        """
+        前のキーフレームから点を追う。追えなければ None。
+        追跡では z がキーフレームのままで、猫背や首の前傾を小さく見積もってしまうので、
+        角度は EMA にも入れずキーフレームの値を返す（tracked=True。save_result は保存しない）
+        """
+        t0 = time.perf_counter()
+        est = self.tracker.step(frame_bgr)
+        self.last_timings["track"] = time.perf_counter() - t0
+        if est is None:
+            return None
 
-        shoulder = (p(L_SH) + p(R_SH)) * 0.5
-        hip = (p(L_HIP) + p(R_HIP)) * 0.5
-        head = p(NOSE)
+        lm_image, lm_world = est
+        self._since_key += 1
+        self.last_keyframe = False
+        self.last_status = "ok"
+        return {
+            "metrics": dict(self._key_metrics),
+            "landmarks": self._lm_list_to_array(lm_image),
+            "world_landmarks": self._lm_list_to_array(lm_world),
+            "connections": POSE_CONNECTIONS,
+            "tracked": True,
+        }
+
+    def analyze_landmarks(self, lm_world, lm_image=None, roi_offset=(0.0, 0.0, 1.0, 1.0)):
+        """推論済みのランドマークから角度を計算する（人ロック・EMA 込み）"""
+        timings = self.last_timings
+        t0 = time.perf_counter()
+
+        # ランドマークは1回だけ配列に詰め、角度計算と応答の両方で使う
+        landmarks_3d = self._lm_list_to_array(lm_world)
+        landmarks_2d = self._lm_list_to_array(lm_image) if lm_image is not None else None
+        t1 = time.perf_counter()
+
+        angles, center, ok = posture_kernel(landmarks_3d)
 
         # ---- 人ロック判定 ----
-        center = shoulder
         if self._locked_center is None:
             self._locked_center = center
         else:
-            dist = np.linalg.norm(center - self._locked_center)
-            if dist > self._lock_dist_thr:
+            d = center - self._locked_center
+            if math.sqrt(d @ d) > self._lock_dist_thr:
+                self.last_status = "lock_rejected"
                 return None
         self._locked_center = center
 
         # ---- 角度計算 ----
-        torso_vec = shoulder - hip
-        if np.linalg.norm(torso_vec) < 1e-4:
+        if not ok:
+            self.last_status = "degenerate"
             return None
-        torso_angle = self._angle_from_vertical(torso_vec)
-
-        neck_vec = head - shoulder
-        if np.linalg.norm(neck_vec) < 1e-4:
-            return None
-        neck_angle = self._angle_from_vertical(neck_vec)
-
-        shoulder_vec = p(L_SH) - p(R_SH)
-        shoulder_tilt = self._angle_from_horizontal(shoulder_vec)
 
         # ---- EMA ----
-        torso_angle = self.ema_torso.update(torso_angle)
-        neck_angle = self.ema_neck.update(neck_angle)
-        shoulder_tilt = self.ema_tilt.update(shoulder_tilt)
+        torso_angle, neck_angle, shoulder_tilt = self.ema.update(angles).tolist()
 
         metrics = {
-            "torso_angle": float(torso_angle),
-            "neck_angle": float(neck_angle),
-            "shoulder_tilt": float(shoulder_tilt)
+            "torso_angle": torso_angle,
+            "neck_angle": neck_angle,
+            "shoulder_tilt": shoulder_tilt
         }
-
-        landmarks_2d = self._lm_list_to_dicts(lm_image) if lm_image else None
-        landmarks_3d = self._lm_list_to_dicts(lm_world)
+        t2 = time.perf_counter()
+
+        # 2D 座標はフレーム全体基準に戻し、次フレームの ROI を決める
+        if landmarks_2d is not None:
+            uncrop_landmarks(landmarks_2d, roi_offset)
+            if self.cfg.roi_crop:
+                self._roi = update_roi(self._roi, landmarks_2d, self.cfg.roi_margin,
+                                       self.cfg.roi_move_thr)
+        t3 = time.perf_counter()
+        timings["landmarks"] = (t1 - t0) + (t3 - t2)
+        timings["metrics"] = t2 - t1
+        self.last_status = "ok"
 
         return {
             "metrics": metrics,
             "landmarks": landmarks_2d,
             "world_landmarks": landmarks_3d,
             "connections": POSE_CONNECTIONS,
-            "raw_result": res,  # ← 描画したい時用に生のresも返す（任意）
         }
 
+    def analyze_batch(self, world_seq):
+        """
+        (T, 33, 3以上) のワールド座標列をまとめて解析する（保存済みランドマークの再処理用）。
+        人ロックと EMA の結果は analyze_landmarks を T 回呼んだ場合と同じになる。
+        戻り値:
+          metrics (T, 3)  [torso_angle, neck_angle, shoulder_tilt]（採用されなかったフレームは NaN）
+          status  (T,)    ok / lock_rejected / degenerate
+        """
+        angles, centers, ok = posture_kernel(world_seq)
+        T = len(angles)
+        status = np.full(T, "ok", dtype="<U13")
+        if T == 0:
+            return {"metrics": angles, "status": status}
+
+        # ---- 人ロック判定 ----
+        # 隣り合うフレームの移動がすべて閾値以内なら、逐次判定しなくても全フレーム通過
+        steps = np.linalg.norm(np.diff(centers, axis=0), axis=1)
+        first_ok = (self._locked_center is None or
+                    np.linalg.norm(centers[0] - self._locked_center) <= self._lock_dist_thr)
+        if first_ok and not (steps > self._lock_dist_thr).any():
+            self._locked_center = centers[-1].copy()
+        else:
+            thr2 = self._lock_dist_thr ** 2
+            locked = None if self._locked_center is None else self._locked_center.tolist()
+            for t, c in enumerate(centers.tolist()):
+                if locked is not None:
+                    dx, dy, dz = c[0] - locked[0], c[1] - locked[1], c[2] - locked[2]
+                    if dx * dx + dy * dy + dz * dz > thr2:
+                        status[t] = "lock_rejected"
+                        continue
+                locked = c
+            self._locked_center = np.array(locked)
+
+        status[(status == "ok") & ~ok] = "degenerate"
+        accepted = status == "ok"
+
+        # ---- EMA（採用されたフレームだけを順に平滑化） ----
+        metrics = np.full((T, 3), np.nan)
+        metrics[accepted] = self.ema.filter(angles[accepted])
+        self.last_status = status[-1]
+        return {"metrics": metrics, "status": status}
+
+    def classify_batch(self, metrics):
+        """analyze_batch の metrics (T, 3) から judge / posture_type の配列を作る"""
+        m = np.asarray(metrics, dtype=np.float64)
+        thr = np.array([self.cfg.torso_angle_thr, self.cfg.neck_angle_thr, self.cfg.shoulder_tilt_thr])
+        if self.baseline is not None:
+            b = self.baseline
+            m_rel = m - np.array([b.torso_angle, b.neck_angle, b.shoulder_tilt])
+        else:
+            m_rel = m
+        bad = (np.abs(m_rel) > thr).any(axis=1)
+        judge = np.where(bad, "bad", "good")
+
+        neck = m[:, 1]
+        posture_type = np.select([neck > 15, neck > 8], ["bad_slouch", "slouch"], "normal")
+        return judge, posture_type
+
+    def ingest(self, world=None, metrics=None, created_at=None, user_id=None):
+        """
+        端末側で推論した T 件を、analyze_and_save と同じ人ロック・EMA・判定を通して保存する。
+        world  : (T, 33, 3以上) ワールド座標（角度はサーバーで計算）
+        metrics: (T, 3) 端末で計算済みの角度（人ロックは使えないので EMA から）
+        created_at: 各件の記録時刻（datetime のリスト。省略すると今）
+        戻り値: {"metrics": (T, 3), "status": (T,), "judge": (T,), "posture_type": (T,)}
+          status: ok / lock_rejected / degenerate / invalid（座標が NaN 等）
+        """
+        values = world if world is not None else metrics
+        valid = np.isfinite(values[..., :3].reshape(len(values), -1)).all(axis=1)
+        out = np.full((len(values), 3), np.nan)
+        status = np.full(len(values), "invalid", dtype="<U13")
+
+        t0 = time.perf_counter()
+        if world is not None:
+            res = self.analyze_batch(world[valid])
+            out[valid], status[valid] = res["metrics"], res["status"]
+        elif valid.any():
+            out[valid] = self.ema.filter(metrics[valid].astype(np.float64))
+            status[valid] = "ok"
+        judge, posture_type = self.classify_batch(out)
+        t1 = time.perf_counter()
+
+        for i in np.flatnonzero(status == "ok").tolist():
+            torso_angle, neck_angle, shoulder_tilt = out[i].tolist()
+            self.recorder.save(
+                metrics={"torso_angle": torso_angle, "neck_angle": neck_angle,
+                         "shoulder_tilt": shoulder_tilt},
+                judge=str(judge[i]), posture_type=str(posture_type[i]), user_id=user_id,
+                created_at=created_at[i] if created_at is not None else None,
+            )
+        self.last_timings = {"metrics": t1 - t0, "save": time.perf_counter() - t1}
+        self.last_status = str(status[-1])
+        return {"metrics": out, "status": status, "judge": judge, "posture_type": posture_type}
+
     def calibrate(self, metrics_avg):
         self.reset_ema()
         self.baseline = PostureBaseline(**metrics_avg)
@@ -308,7 +753,10 @@ class PosePostureAnalyzer:
         out = self.analyze(frame_bgr)
         if out is None:
             return None
+        return self.save_result(out)
 
+    def classify_result(self, out):
+        """analyze の結果に judge / posture_type を付けて返す（保存はしない）"""
         metrics = out["metrics"]
         judge = self.judge(metrics)
 
@@ -320,11 +768,21 @@ class PosePostureAnalyzer:
         else:
             posture_type = "normal"
 
-        # 保存（動的モデルで）
-        self.recorder.save(metrics=metrics, judge=judge, posture_type=posture_type)
-
         return {
             **out,
             "judge": judge,
             "posture_type": posture_type
         }
+
+    def save_result(self, out, user_id=None):
+        """analyze の結果を判定して保存し、judge / posture_type を付けて返す（追跡したフレームは保存しない）"""
+        out = self.classify_result(out)
+        if out.get("tracked"):
+            return out
+
+        # 保存（バックグラウンド書き込みに渡す）
+        t0 = time.perf_counter()
+        self.recorder.save(metrics=out["metrics"], judge=out["judge"], posture_type=out["posture_type"],
+                           user_id=user_id)
+        self.last_timings["save"] = time.perf_counter() - t0
+        return out
@@ -0,0 +1,111 @@
+# ========================
+# response_format.py
+# ========================
+#
+# /analyze の応答形式を選ぶ。
+#
+#   形式（?format= または Accept ヘッダ）
+#     json    : 従来どおりの JSON（既定）
+#     packed  : application/octet-stream
+#               [uint32 LE ヘッダ長][ヘッダ JSON][空白で4バイト境界まで埋める][float32 配列...]
+#               ヘッダ長は埋めた空白を含む（JSON として読めばそのまま無視される）
+#               ヘッダの "arrays" に {名前: [行, 列]} が並び順どおり入る
+#     msgpack : application/msgpack（msgpack が入っている場合のみ）
+#
+#   フィールド（?fields=metrics,2d,3d）
+#     metrics は常に返す。2d / 3d は指定された時だけ返す（既定は両方）
+#     接続情報は /pose/connections から1回だけ取得する
+
+import json
+import struct
+
+import numpy as np
+from flask import Response
+
+try:
+    import msgpack
+except ImportError:  # 任意依存
+    msgpack = None
+
+LANDMARK_FIELDS = ("x", "y", "z", "visibility", "presence")
+
+MIME_PACKED = "application/octet-stream"
+MIME_MSGPACK = "application/msgpack"
+
+ARRAY_FIELDS = {
+    "2d": "landmarks",
+    "3d": "world_landmarks",
+}
+
+
+def negotiate(req):
+    """リクエストから (形式, 返すランドマークの集合) を決める"""
+    fmt = req.args.get("format")
+    if fmt is None:
+        best = req.accept_mimetypes.best_match(
+            ["application/json", MIME_PACKED, MIME_MSGPACK], default="application/json"
+        )
+        fmt = {MIME_PACKED: "packed", MIME_MSGPACK: "msgpack"}.get(best, "json")
+    if fmt == "msgpack" and msgpack is None:
+        fmt = "json"
+    if fmt not in ("json", "packed", "msgpack"):
+        fmt = "json"
+
+    raw = req.args.get("fields")
+    if raw is None:
+        fields = set(ARRAY_FIELDS)
+    else:
+        fields = {f.strip() for f in raw.split(",")} & set(ARRAY_FIELDS)
+    return fmt, fields
+
+
+def landmarks_to_dicts(arr):
+    """(N, 5) の配列を [{x, y, z, visibility, presence}, ...] にする"""
+    return [dict(zip(LANDMARK_FIELDS, row)) for row in arr.tolist()]
+
+
+def encode_analyze_body(out, fmt, fields):
+    """解析結果を指定形式にする。戻り値: (bytes または str, MIME タイプ)"""
+    body = {
+        "posture": out["judge"],               # good / bad
+        "posture_type": out["posture_type"],   # slouch 等
+        "metrics": out["metrics"],
+    }
+    if "next_poll_ms" in out:
+        body["next_poll_ms"] = out["next_poll_ms"]   # 次のフレームまでの推奨間隔
+    if "model_tier" in out:
+        body["model_tier"] = out["model_tier"]       # 推論に使ったモデル（lite / full / heavy）
+    arrays = {}
+    for key in sorted(fields):
+        name = ARRAY_FIELDS[key]
+        arr = out.get(name)
+        arrays[name] = arr if arr is not None else np.zeros((0, 5), np.float32)
+
+    if fmt == "packed":
+        return _pack(body, arrays), MIME_PACKED
+
+    if fmt == "msgpack":
+        for name, arr in arrays.items():
+            body[name] = {"shape": list(arr.shape), "data": arr.astype("<f4").tobytes()}
+        return msgpack.packb(body), MIME_MSGPACK
+
+    for name, arr in arrays.items():
+        body[name] = landmarks_to_dicts(arr)
+    return json.dumps(body, separators=(",", ":")), "application/json"
+
+
+def encode_analyze(out, fmt, fields):
+    """解析結果を指定形式の Response にする"""
+    data, mimetype = encode_analyze_body(out, fmt, fields)
+    return Response(data, mimetype=mimetype)
+
+
+def _pack(body, arrays):
+    header = dict(body, arrays={name: list(arr.shape) for name, arr in arrays.items()})
+    head = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    pad = (-(4 + len(head))) % 4
+
+    parts = [struct.pack("<I", len(head) + pad), head, b" " * pad]   # JSON の空白として読み飛ばせる
+    for arr in arrays.values():
+        parts.append(np.ascontiguousarray(arr, dtype="<f4").tobytes())
+    return b"".join(parts)
@@ -0,0 +1,467 @@
+# ========================
+# retention.py
+# ========================
+#
+# 古い姿勢ログの整理（保持期間と圧縮アーカイブ）
+#   raw_days 日より古い posture_log の行は、ユーザー × 月ごとに
+#     1. 行がある日ごとに、分・時・日の集計（posture_rollup）に入っていることを確かめ
+#        （足りない日だけ作り直す。前回までに消した行の分は集計にしか無いので触らない）
+#     2. chunk_size 行ずつ (created_at, id) の順に読み、part_rows 行たまるごとに
+#        圧縮アーカイブの1ファイル（列ごとの npz）に書き出し
+#     3. そのファイルに書いた id だけを chunk_size 行ずつ別トランザクションで削除する
+#   メモリに持つのは part_rows 行分の列だけ（月の全行や既存のアーカイブは読み込まない）。
+#   minute_rollup_days 日より古い分集計も削除する（時・日の集計は残す）。
+#
+#   python app/retention.py              # 実行
+#   python app/retention.py --dry-run    # 対象の件数だけ表示
+#   python app/retention.py --report     # DB / アーカイブのサイズと回収できる容量
+#
+# アプリ内では、RETENTION_ENABLED を有効にした時だけ（既定は無効。環境変数 RETENTION_ENABLED=1）
+# RetentionWorker が interval ごとにバックグラウンドで実行する。手動の実行は上のコマンドで。
+# 削除は短いトランザクションに分け、間で一息つくので、/analyze の書き込みを長く待たせない。
+#
+# アーカイブ: <archive_dir>/<user_id>/<YYYY-MM>/<先頭行の時刻>-<先頭行の id>.npz
+#   id, created_at（UTC の datetime64[us]）, posture, posture_type, torso_angle, neck_angle,
+#   shoulder_tilt の各列。1ファイルは read_archive()、月の全体は read_month() で読める
+#   （以前の1か月1ファイルの <YYYY-MM>.npz も一緒に読む）。
+#   書き出した後・消す前に止まると次の実行で同じ行をもう一度書くが、read_month が id で
+#   重複を除くので、途中で止まっても再実行してよい。
+
+import argparse
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import sqlalchemy as sa
+
+from extensions import db, storage
+from models.posture import PostureLog, PostureLogPage, PostureRollup
+from rollups import counted_by_day, floor_time, rebuild_range
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("id", "user_id", "posture", "posture_type",
+           "torso_angle", "neck_angle", "shoulder_tilt", "created_at")
+TEXT_COLUMNS = ("posture", "posture_type")
+FLOAT_COLUMNS = ("torso_angle", "neck_angle", "shoulder_tilt")
+
+
+def month_start(ts):
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(ts):
+    return (ts.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+# =========================
+# アーカイブの読み書き
+# =========================
+def month_dir(archive_dir, user_id, month):
+    return os.path.join(archive_dir, str(user_id), f"{month:%Y-%m}")
+
+
+def part_path(archive_dir, user_id, month, first_created_at, first_id):
+    """先頭行で名前を決めるので、同じ所から書き直すと同じファイルを置き換える"""
+    return os.path.join(month_dir(archive_dir, user_id, month),
+                        f"{first_created_at:%Y%m%dT%H%M%S%f}-{first_id}.npz")
+
+
+def archive_files(archive_dir, user_id, month):
+    """その月のアーカイブのファイル（以前の1か月1ファイル → 書き出した順）"""
+    files = []
+    legacy = month_dir(archive_dir, user_id, month) + ".npz"
+    if os.path.exists(legacy):
+        files.append(legacy)
+    d = month_dir(archive_dir, user_id, month)
+    if os.path.isdir(d):
+        files += [os.path.join(d, name) for name in sorted(os.listdir(d)) if name.endswith(".npz")]
+    return files
+
+
+def archived_months(archive_dir, user_id):
+    """アーカイブがある月（月の開始の datetime）を古い順に"""
+    d = os.path.join(archive_dir, str(user_id))
+    if not os.path.isdir(d):
+        return []
+    months = set()
+    for name in os.listdir(d):
+        try:
+            months.add(datetime.strptime(name[:7], "%Y-%m"))
+        except ValueError:
+            continue
+    return sorted(months)
+
+
+def _to_columns(rows):
+    cols = {
+        "id": np.array([r["id"] for r in rows], np.int64),
+        "created_at": np.array([r["created_at"] for r in rows], "datetime64[us]"),
+    }
+    for c in FLOAT_COLUMNS:
+        cols[c] = np.array([np.nan if r[c] is None else r[c] for r in rows], np.float64)
+    for c in TEXT_COLUMNS:
+        cols[c] = np.array([r[c] or "" for r in rows], dtype=str)
+    return cols
+
+
+def _encode(cols):
+    """文字列の列は種類が少ないので、文字列表（<列>_vocab）+ 番号で持つ"""
+    out = dict(cols)
+    for c in TEXT_COLUMNS:
+        vocab, codes = np.unique(cols[c], return_inverse=True)
+        out[c] = codes.astype(np.uint8 if len(vocab) < 256 else np.int32)
+        out[c + "_vocab"] = vocab
+    return out
+
+
+def read_archive(path):
+    """アーカイブを {列名: ndarray} として読む（文字列の列は復元済み）"""
+    with np.load(path) as z:
+        cols = {k: z[k] for k in z.files}
+    for c in TEXT_COLUMNS:
+        vocab = cols.pop(c + "_vocab")
+        cols[c] = vocab[cols[c]]
+    return cols
+
+
+def archived_until(archive_dir, user_id):
+    """アーカイブにある一番新しい行の時刻（無ければ None）。created_at の列だけを読む"""
+    months = archived_months(archive_dir, user_id)
+    if not months:
+        return None
+    latest = None
+    for path in archive_files(archive_dir, user_id, months[-1]):
+        with np.load(path) as z:
+            created_at = z["created_at"]
+        if len(created_at):
+            t = created_at.max().astype("datetime64[us]").item()
+            latest = t if latest is None else max(latest, t)
+    return latest
+
+
+def read_month(archive_dir, user_id, month):
+    """
+    その月のアーカイブ全体を (created_at, id) の順に読む（id の重複は後のファイルを残す）。
+    月の全行をメモリに載せるので、調べ物・復元用
+    """
+    parts = [read_archive(path) for path in archive_files(archive_dir, user_id, month)]
+    if not parts:
+        return None
+    cols = {c: np.concatenate([p[c] for p in parts]) for c in parts[0]}
+    _, last = np.unique(cols["id"][::-1], return_index=True)
+    keep = len(cols["id"]) - 1 - last
+    order = keep[np.lexsort((cols["id"][keep], cols["created_at"][keep]))]
+    return {c: v[order] for c, v in cols.items()}
+
+
+def write_part(path, cols):
+    """
+    cols（_to_columns の形）をアーカイブの1ファイルとして書く。
+    一時ファイルに書いてから置き換えるので、途中で止まっても中途半端なファイルは残らない。
+    戻り値: ファイルサイズ
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **_encode(cols))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+# =========================
+# 保持期間の適用
+# =========================
+def _slices(cutoff):
+    """(user_id, 月の開始, 区間の終わり) を古い順に返す"""
+    first = db.session.execute(
+        sa.select(PostureLog.user_id, sa.func.min(PostureLog.created_at))
+        .where(PostureLog.created_at < cutoff)
+        .group_by(PostureLog.user_id)
+    ).all()
+    for user_id, oldest in first:
+        m = month_start(oldest)
+        while m < cutoff:
+            yield user_id, m, min(next_month(m), cutoff)
+            m = next_month(m)
+
+
+def _iter_rows(cond, chunk_size, columns=COLUMNS):
+    """cond に合う posture_log の行を (created_at, id) の順に chunk_size 行ずつ（dict のリスト）返す"""
+    log = PostureLog.__table__
+    key = (log.c.created_at, log.c.id)
+    base = sa.select(*[log.c[c] for c in columns]).where(cond).order_by(*key).limit(chunk_size)
+    after = None
+    while True:
+        q = base if after is None else base.where(sa.tuple_(*key) > sa.tuple_(*after))
+        rows = [dict(r) for r in db.session.execute(q).mappings()]
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+def _iter_parts(cond, chunk_size, part_rows):
+    """cond に合う行を part_rows 行ずつの列の配列（_to_columns の形）にして返す"""
+    pending = []
+    n = 0
+    for rows in _iter_rows(cond, chunk_size):
+        pending.append(_to_columns(rows))
+        n += len(rows)
+        if n >= part_rows:
+            yield {c: np.concatenate([p[c] for p in pending]) for c in pending[0]}
+            pending, n = [], 0
+    if pending:
+        yield {c: np.concatenate([p[c] for p in pending]) for c in pending[0]}
+
+
+def _short_days(user_id, cond, start, end, chunk_size):
+    """cond の行がある日のうち、分集計に数えられている行数が足りない日"""
+    log = PostureLog.__table__
+    angles = log.c.torso_angle.isnot(None) & log.c.neck_angle.isnot(None) & log.c.shoulder_tilt.isnot(None)
+    raw = {}
+    for rows in _iter_rows(cond & angles, chunk_size, ("id", "created_at")):
+        for r in rows:
+            day = floor_time(r["created_at"], "day")
+            raw[day] = raw.get(day, 0) + 1
+    counted = counted_by_day(db.session, user_id, start, end)
+    # 多い分には触らない（アーカイブ済みの日に後から足された行など）
+    return [day for day, n in sorted(raw.items()) if counted.get(day, 0) < n]
+
+
+def _delete_ids(table, ids, chunk_size, pause):
+    """ids の行を chunk_size 行ずつ、それぞれ別のトランザクションで消す"""
+    deleted = 0
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        db.session.execute(sa.delete(table).where(table.c.id.in_(chunk)))
+        db.session.commit()
+        deleted += len(chunk)
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def _delete_in_chunks(table, cond, chunk_size, pause):
+    """cond に合う行を chunk_size 行ずつ、それぞれ別のトランザクションで消す"""
+    deleted = 0
+    while True:
+        ids = db.session.execute(
+            sa.select(table.c.id).where(cond).limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            return deleted
+        db.session.execute(sa.delete(table).where(table.c.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+
+def apply_retention(archive_dir, raw_days, minute_rollup_days=None,
+                    chunk_size=2000, part_rows=100_000, pause=0.05, dry_run=False, now=None):
+    """
+    保持期間を適用する。アプリコンテキスト内で呼ぶこと。
+    戻り値: 処理の要約（dict）
+    """
+    now = now or datetime.utcnow()
+    cutoff = floor_time(now - timedelta(days=raw_days), "day")
+    log = PostureLog.__table__
+    summary = {"cutoff": cutoff.isoformat(), "rows_archived": 0, "rows_deleted": 0,
+               "rollups_rebuilt": 0, "archives_written": 0, "archive_bytes": 0,
+               "minute_rollups_deleted": 0}
+
+    for user_id, start, end in list(_slices(cutoff)):
+        in_range = (log.c.user_id == user_id) & (log.c.created_at >= start) & (log.c.created_at < end)
+        if dry_run:
+            summary["rows_archived"] += db.session.execute(
+                sa.select(sa.func.count()).select_from(log).where(in_range)).scalar()
+            continue
+
+        # 消す前に、行がある日ごとに集計に入っていることを確かめる（足りない日だけ作り直す）
+        for day in _short_days(user_id, in_range, start, end, chunk_size):
+            day_end = day + timedelta(days=1)
+            day_rows = (log.c.user_id == user_id) & (log.c.created_at >= day) & (log.c.created_at < day_end)
+            rebuild_range(db.session, user_id, day, day_end, _iter_rows(day_rows, chunk_size))
+            db.session.commit()
+            summary["rollups_rebuilt"] += 1
+        db.session.commit()
+
+        # part_rows 行ずつ書き出し、書いた id だけ消す（読んだ後に入った行は次回）
+        for cols in _iter_parts(in_range, chunk_size, part_rows):
+            first = cols["created_at"][0].astype("datetime64[us]").item()
+            path = part_path(archive_dir, user_id, start, first, int(cols["id"][0]))
+            summary["archive_bytes"] += write_part(path, cols)
+            summary["archives_written"] += 1
+            summary["rows_archived"] += len(cols["id"])
+            summary["rows_deleted"] += _delete_ids(log, cols["id"].tolist(), chunk_size, pause)
+
+        # 中身が消えたページの索引
+        pages = PostureLogPage.__table__
+        db.session.execute(sa.delete(pages).where(pages.c.user_id == user_id, pages.c.page_end < end))
+        db.session.commit()
+
+    if minute_rollup_days is not None and not dry_run:
+        rcut = floor_time(now - timedelta(days=max(minute_rollup_days, raw_days)), "day")
+        R = PostureRollup.__table__
+        summary["minute_rollups_deleted"] = _delete_in_chunks(
+            R, (R.c.tier == "minute") & (R.c.bucket_start < rcut), chunk_size, pause)
+
+    return summary
+
+
+# =========================
+# 容量の報告
+# =========================
+def _sqlite_pages():
+    """SQLite のページ数などを読む（他の DB では None）"""
+    if db.engine.dialect.name != "sqlite":
+        return None
+    q = lambda name: db.session.execute(sa.text(f"PRAGMA {name}")).scalar()
+    return {"page_size": q("page_size"), "page_count": q("page_count"), "freelist_count": q("freelist_count")}
+
+
+def storage_report(archive_dir, raw_days=None, now=None):
+    """DB とアーカイブのサイズ、保持期間を過ぎた行数、VACUUM で回収できる容量"""
+    report = {}
+    pages = _sqlite_pages()
+    if pages is not None:
+        size = pages["page_size"]
+        report["db_bytes"] = size * pages["page_count"]
+        report["db_free_bytes"] = size * pages["freelist_count"]   # VACUUM で OS に返せる容量
+
+    log = PostureLog.__table__
+    report["raw_rows"] = db.session.execute(sa.select(sa.func.count()).select_from(log)).scalar()
+    report["rollup_rows"] = db.session.execute(
+        sa.select(sa.func.count()).select_from(PostureRollup.__table__)).scalar()
+    if raw_days is not None:
+        cutoff = floor_time((now or datetime.utcnow()) - timedelta(days=raw_days), "day")
+        report["raw_rows_expired"] = db.session.execute(
+            sa.select(sa.func.count()).select_from(log).where(log.c.created_at < cutoff)).scalar()
+
+    files = 0
+    total = 0
+    for root, _, names in os.walk(archive_dir):
+        for name in names:
+            if name.endswith(".npz"):
+                files += 1
+                total += os.path.getsize(os.path.join(root, name))
+    report["archive_files"] = files
+    report["archive_bytes"] = total
+    return report
+
+
+# =========================
+# バックグラウンド実行
+# =========================
+class RetentionWorker:
+    """interval 秒ごとに apply_retention を実行するスレッド"""
+
+    def __init__(self, app=None):
+        self._app = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.last_summary = None
+        self.last_run = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config.get("RETENTION_ENABLED", False)
+        self.archive_dir = app.config.get("RETENTION_ARCHIVE_DIR")
+        self.raw_days = app.config.get("RETENTION_RAW_DAYS", 90)
+        self.minute_rollup_days = app.config.get("RETENTION_MINUTE_ROLLUP_DAYS")
+        self.interval = app.config.get("RETENTION_INTERVAL_S", 6 * 3600)
+        self.chunk_size = app.config.get("RETENTION_CHUNK_SIZE", 2000)
+        self.part_rows = app.config.get("RETENTION_PART_ROWS", 100_000)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="posture-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        with self._app.app_context():
+            summary = apply_retention(self.archive_dir, self.raw_days, self.minute_rollup_days,
+                                      chunk_size=self.chunk_size, part_rows=self.part_rows)
+        self.last_summary = summary
+        self.last_run = datetime.utcnow().isoformat()
+        if summary["rows_deleted"]:
+            logger.info("retention: %s", summary)
+        return summary
+
+    def _run(self):
+        # 起動直後は避け、少し待ってから始める
+        while not self._stop.wait(min(60.0, self.interval)):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("retention run failed")
+                db.session.remove()
+            if self._stop.wait(self.interval):
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description="古い姿勢ログをアーカイブして削除する")
+    parser.add_argument("--raw-days", type=int, help="生ログを残す日数（既定は設定値）")
+    parser.add_argument("--minute-rollup-days", type=int, help="分集計を残す日数（既定は設定値）")
+    parser.add_argument("--archive-dir", help="アーカイブの保存先（既定は設定値）")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="1トランザクションで消す行数")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--report", action="store_true", help="サイズと回収できる容量を表示するだけ")
+    parser.add_argument("--vacuum", action="store_true", help="実行後に VACUUM する（SQLite, 書き込みを止める）")
+    args = parser.parse_args()
+
+    from flask import Flask
+    from config import Config
+    from models.user import User  # noqa: F401  (外部キー解決用)
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    storage.init_app(app)
+
+    raw_days = args.raw_days if args.raw_days is not None else app.config["RETENTION_RAW_DAYS"]
+    minute_days = args.minute_rollup_days if args.minute_rollup_days is not None \
+        else app.config["RETENTION_MINUTE_ROLLUP_DAYS"]
+    archive_dir = args.archive_dir or app.config["RETENTION_ARCHIVE_DIR"]
+
+    with app.app_context():
+        db.create_all()
+        before = storage_report(archive_dir, raw_days)
+        if args.report:
+            for k, v in before.items():
+                print(f"{k}: {v}")
+            return
+
+        summary = apply_retention(archive_dir, raw_days, minute_days, chunk_size=args.chunk_size,
+                                  part_rows=app.config["RETENTION_PART_ROWS"], dry_run=args.dry_run)
+        for k, v in summary.items():
+            print(f"{k}: {v}")
+        if args.dry_run:
+            return
+
+        if args.vacuum and db.engine.dialect.name == "sqlite":
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql("VACUUM")
+        after = storage_report(archive_dir, raw_days)
+        if "db_bytes" in before:
+            print(f"db_bytes: {before['db_bytes']} -> {after['db_bytes']}")
+            print(f"db_free_bytes: {after['db_free_bytes']}  (VACUUM で回収できる)")
+        print(f"archive_bytes: {before['archive_bytes']} -> {after['archive_bytes']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+# ========================
+# rollups.py
+# ========================
+#
+# 姿勢ログの分・時・日ごとの集計（posture_rollup テーブル）
+#   - 書き込みと同じトランザクションで集計も加算する（log_writer のリスナー）
+#   - 既存のログからの作り直し
+#       python app/rollups.py --backfill                # 全ユーザー
+#       python app/rollups.py --backfill --user alice   # 1ユーザー
+#     作り直し中に届いたログは二重に数えることがあるので、アプリを止めて実行する。
+#     作り直すのは posture_log に生ログが残っている日から後だけ。retention.py でアーカイブした
+#     日の集計は生ログが無いので消さずに残す
+#   - 期間の集計は、期間に丸ごと入る一番粗い区間を組み合わせて読む
+#     （1か月分でも 日×30 + 時×数十 + 分×百程度）
+#
+# 区間の境界は UTC（created_at と同じ）。
+
+import argparse
+import math
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db, storage
+from models.posture import PostureLog, PostureRollup
+
+TIERS = ("minute", "hour", "day")
+TIER_SPAN = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+# classify_result（normal / slouch / bad_slouch）と classify_posture の両方の種類
+POSTURE_TYPES = ("normal", "slouch", "bad_slouch", "severe_slouch", "forward_head", "shoulder_tilt")
+ANGLES = (("torso", "torso_angle"), ("neck", "neck_angle"), ("tilt", "shoulder_tilt"))
+
+COUNT_COLUMNS = ("n", "n_good", "n_bad") + tuple(f"n_{t}" for t in POSTURE_TYPES) + ("n_other",)
+SUM_COLUMNS = COUNT_COLUMNS + tuple(f"{a}_sum" for a, _ in ANGLES)
+MIN_COLUMNS = tuple(f"{a}_min" for a, _ in ANGLES)
+MAX_COLUMNS = tuple(f"{a}_max" for a, _ in ANGLES)
+
+MAX_POINTS = 1440   # resolution=auto の時の区間数の上限
+
+
+def floor_time(ts, tier):
+    if tier == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if tier == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_time(ts, tier):
+    t = floor_time(ts, tier)
+    return t if t == ts else t + TIER_SPAN[tier]
+
+
+def parse_utc(text):
+    """
+    ISO 形式の時刻を、DB と同じタイムゾーン無しの UTC にする。
+    +09:00 などの付いたものは UTC に直す。形式が違えば ValueError
+    """
+    ts = datetime.fromisoformat(text)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+# =========================
+# メモリ上での集計
+# =========================
+def _empty():
+    acc = dict.fromkeys(SUM_COLUMNS, 0)
+    acc.update(dict.fromkeys(MIN_COLUMNS, math.inf))
+    acc.update(dict.fromkeys(MAX_COLUMNS, -math.inf))
+    return acc
+
+
+def _merge(dst, src):
+    for c in SUM_COLUMNS:
+        dst[c] += src[c]
+    for c in MIN_COLUMNS:
+        if src[c] is not None and src[c] < dst[c]:
+            dst[c] = src[c]
+    for c in MAX_COLUMNS:
+        if src[c] is not None and src[c] > dst[c]:
+            dst[c] = src[c]
+
+
+def aggregate(rows):
+    """
+    PostureLog の行（dict）を {(user_id, tier, bucket_start): 集計} にする。
+    行は分単位に集計し、時・日はその結果をまとめて作る。角度が欠けた行は数えない。
+    """
+    minutes = {}
+    for r in rows:
+        torso, neck, tilt = r["torso_angle"], r["neck_angle"], r["shoulder_tilt"]
+        if torso is None or neck is None or tilt is None:
+            continue
+        key = (r["user_id"], floor_time(r["created_at"], "minute"))
+        a = minutes.get(key)
+        if a is None:
+            a = minutes[key] = _empty()
+
+        a["n"] += 1
+        if r["posture"] == "good":
+            a["n_good"] += 1
+        elif r["posture"] == "bad":
+            a["n_bad"] += 1
+        ptype = r["posture_type"]
+        a[f"n_{ptype}" if ptype in POSTURE_TYPES else "n_other"] += 1
+        for name, value in (("torso", torso), ("neck", neck), ("tilt", tilt)):
+            a[f"{name}_sum"] += value
+            if value < a[f"{name}_min"]:
+                a[f"{name}_min"] = value
+            if value > a[f"{name}_max"]:
+                a[f"{name}_max"] = value
+
+    out = {(u, "minute", b): a for (u, b), a in minutes.items()}
+    finer = minutes
+    for tier in ("hour", "day"):
+        coarser = {}
+        for (u, b), a in finer.items():
+            key = (u, floor_time(b, tier))
+            c = coarser.get(key)
+            if c is None:
+                c = coarser[key] = _empty()
+            _merge(c, a)
+        out.update({(u, tier, b): a for (u, b), a in coarser.items()})
+        finer = coarser
+    return out
+
+
+# =========================
+# DB への加算
+# =========================
+def _dialect_name(conn):
+    # Session と Connection のどちらでも受け付ける
+    if hasattr(conn, "dialect"):
+        return conn.dialect.name
+    return conn.get_bind().dialect.name
+
+
+def upsert(conn, acc):
+    """集計結果を posture_rollup に足し込む"""
+    if not acc:
+        return
+    table = PostureRollup.__table__
+    values = [dict(a, user_id=u, tier=t, bucket_start=b) for (u, t, b), a in acc.items()]
+
+    dialect = _dialect_name(conn)
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        lo, hi = (sa.func.min, sa.func.max) if dialect == "sqlite" else (sa.func.least, sa.func.greatest)
+        stmt = insert(table)
+        ex = stmt.excluded
+        set_ = {c: table.c[c] + ex[c] for c in SUM_COLUMNS}
+        set_.update({c: lo(table.c[c], ex[c]) for c in MIN_COLUMNS})
+        set_.update({c: hi(table.c[c], ex[c]) for c in MAX_COLUMNS})
+        conn.execute(
+            stmt.on_conflict_do_update(index_elements=["user_id", "tier", "bucket_start"], set_=set_),
+            values,
+        )
+        return
+
+    # その他の DB：読んでから更新 / 追加
+    for v in values:
+        key = (table.c.user_id == v["user_id"]) & (table.c.tier == v["tier"]) \
+            & (table.c.bucket_start == v["bucket_start"])
+        row = conn.execute(sa.select(table).where(key)).mappings().first()
+        if row is None:
+            conn.execute(table.insert(), v)
+        else:
+            merged = dict(row)
+            _merge(merged, v)
+            conn.execute(table.update().where(key),
+                         {c: merged[c] for c in SUM_COLUMNS + MIN_COLUMNS + MAX_COLUMNS})
+
+
+def apply_rollups(conn, rows):
+    """PostureLog に書いた行の分だけ集計を進める（同じトランザクション内で呼ぶ）"""
+    upsert(conn, aggregate(rows))
+
+
+# =========================
+# 期間の集計
+# =========================
+def cover(start, end, tiers=TIERS[::-1]):
+    """
+    [start, end) を、丸ごと入る一番粗い区間で埋める。
+    戻り値: [(tier, from, to), ...]  start / end は分単位に丸めてあること
+    """
+    if start >= end:
+        return []
+    tier, finer = tiers[0], tiers[1:]
+    if not finer:
+        return [(tier, start, end)]
+    a, b = ceil_time(start, tier), floor_time(end, tier)
+    if a >= b:
+        return cover(start, end, finer)
+    return cover(start, a, finer) + [(tier, a, b)] + cover(b, end, finer)
+
+
+def _to_summary(acc):
+    n = acc["n"]
+    out = {
+        "n": n,
+        "good": acc["n_good"],
+        "bad": acc["n_bad"],
+        "types": {t: acc[f"n_{t}"] for t in POSTURE_TYPES},
+    }
+    if acc["n_other"]:
+        out["types"]["other"] = acc["n_other"]
+    for name, column in ANGLES:
+        out[column] = {
+            "mean": acc[f"{name}_sum"] / n if n else None,
+            "min": acc[f"{name}_min"] if n else None,
+            "max": acc[f"{name}_max"] if n else None,
+        }
+    return out
+
+
+def summarize(user_id, start, end):
+    """期間全体の集計（粗い区間を組み合わせて読む）"""
+    start, end = floor_time(start, "minute"), ceil_time(end, "minute")
+    pieces = cover(start, end)
+    if not pieces:
+        return _to_summary(_empty())
+
+    R = PostureRollup
+    cond = sa.or_(*[
+        (R.tier == tier) & (R.bucket_start >= a) & (R.bucket_start < b)
+        for tier, a, b in pieces
+    ])
+    cols = [getattr(R, c) for c in SUM_COLUMNS + MIN_COLUMNS + MAX_COLUMNS]
+    total = _empty()
+    for row in storage.read_session.execute(sa.select(*cols).where(R.user_id == user_id, cond)).mappings():
+        _merge(total, row)
+    return _to_summary(total)
+
+
+def pick_resolution(start, end, max_points=MAX_POINTS):
+    """区間数が max_points 以下になる一番細かい粒度"""
+    for tier in TIERS:
+        if (end - start) / TIER_SPAN[tier] <= max_points:
+            return tier
+    return TIERS[-1]
+
+
+def series(user_id, start, end, resolution):
+    """粒度 resolution の区間ごとの集計（記録のある区間だけ、古い順）"""
+    start, end = floor_time(start, resolution), ceil_time(end, resolution)
+    R = PostureRollup
+    rows = storage.read_session.execute(
+        sa.select(R)
+        .where(R.user_id == user_id, R.tier == resolution,
+               R.bucket_start >= start, R.bucket_start < end)
+        .order_by(R.bucket_start)
+    ).scalars()
+    out = []
+    for r in rows:
+        item = _to_summary({c: getattr(r, c) for c in SUM_COLUMNS + MIN_COLUMNS + MAX_COLUMNS})
+        item["t"] = r.bucket_start.isoformat()
+        out.append(item)
+    return out
+
+
+# =========================
+# 既存ログからの作り直し
+# =========================
+def backfill(user_id=None, chunk_size=50000, archive_dir=None):
+    """
+    posture_log から集計を作り直す。戻り値: 読んだ行数
+    ユーザーごとに、生ログが残っている最初の日（archive_dir のアーカイブにある日は除く）から後だけを
+    消して作り直す。それより前の集計はアーカイブ済みの行の分なので触らない
+    """
+    from retention import archived_until
+
+    log = PostureLog.__table__
+    q = sa.select(log.c.user_id, sa.func.min(log.c.created_at)).group_by(log.c.user_id)
+    if user_id is not None:
+        q = q.where(log.c.user_id == user_id)
+    oldest = db.session.execute(q).all()
+
+    R = PostureRollup.__table__
+    cols = [log.c[c] for c in
+            ("user_id", "posture", "posture_type", "torso_angle", "neck_angle",
+             "shoulder_tilt", "created_at")]
+    total = 0
+    for uid, first in oldest:
+        since = floor_time(first, "day")
+        archived = archived_until(archive_dir, uid) if archive_dir else None
+        if archived is not None:
+            # アーカイブした日に後から入った行の分は、リスナーで集計に足してあるのでそのまま
+            since = max(since, floor_time(archived, "day") + TIER_SPAN["day"])
+        db.session.execute(sa.delete(R).where(R.c.user_id == uid, R.c.bucket_start >= since))
+
+        sel = (sa.select(*cols).where(log.c.user_id == uid, log.c.created_at >= since)
+               .order_by(log.c.created_at))
+        # 読み取りは別の接続で流し、書き込みは chunk_size 行ごとに足し込む
+        chunk = []
+        with db.engine.connect() as reader:
+            for row in reader.execution_options(yield_per=chunk_size).execute(sel).mappings():
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    apply_rollups(db.session, chunk)
+                    total += len(chunk)
+                    chunk = []
+        apply_rollups(db.session, chunk)
+        total += len(chunk)
+    db.session.commit()
+    return total
+
+
+def rebuild_range(conn, user_id, start, end, chunks):
+    """
+    [start, end)（日の境界にそろえること）の集計を作り直す。
+    chunks はその期間の PostureLog の行すべてを、行（dict）のリストに分けて順に返すもの。
+    """
+    R = PostureRollup.__table__
+    conn.execute(sa.delete(R).where(R.c.user_id == user_id,
+                                    R.c.bucket_start >= start, R.c.bucket_start < end))
+    for rows in chunks:
+        apply_rollups(conn, rows)
+
+
+def counted_by_day(conn, user_id, start, end):
+    """[start, end) の分集計に数えられている行数を {日の開始: 行数} で返す"""
+    R = PostureRollup.__table__
+    counts = {}
+    for bucket_start, n in conn.execute(
+        sa.select(R.c.bucket_start, R.c.n)
+        .where(R.c.user_id == user_id, R.c.tier == "minute",
+               R.c.bucket_start >= start, R.c.bucket_start < end)
+    ):
+        day = floor_time(bucket_start, "day")
+        counts[day] = counts.get(day, 0) + n
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="姿勢ログの分・時・日集計を作り直す")
+    parser.add_argument("--backfill", action="store_true", required=True)
+    parser.add_argument("--user", help="このユーザーだけ作り直す")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    from flask import Flask
+    from config import Config
+    from models.user import User
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    storage.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        user_id = None
+        if args.user:
+            user = User.query.filter_by(username=args.user).first()
+            if user is None:
+                parser.error(f"unknown user: {args.user}")
+            user_id = user.id
+        n = backfill(user_id, args.chunk_size, app.config["RETENTION_ARCHIVE_DIR"])
+        print(f"{n} rows aggregated")
+
+
+if __name__ == "__main__":
+    main()
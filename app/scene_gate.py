@@ -0,0 +1,77 @@
+# ========================
+# scene_gate.py
+# ========================
+#
+# 静止シーンの検出と、次に送ってほしい間隔（ポーリング周期）の提案
+#   フレームを小さなグレー画像（frame_preprocess.decode_thumbnail）にして、最後に解析した時の
+#   サムネイルと比べる。変化した画素がほとんど無ければ前回の結果を使い回し、
+#   推論も DB 書き込みもしない。
+#
+#   比較の基準は「直前のフレーム」ではなく「最後に解析したフレーム」なので、
+#   ゆっくりした変化も積み重なればいずれ検出される。
+#   念のため max_reuse_s ごとには必ず解析し直す（この時はログも書く）。
+#
+#   姿勢が安定している（静止 / 角度がほぼ同じ）ほど提案する間隔を倍々に延ばし、
+#   変化したら最短に戻す。
+
+import time
+
+import cv2
+import numpy as np
+
+class StaticSceneGate:
+    def __init__(self, pixel_thr=12, change_ratio=0.01, max_reuse_s=30.0,
+                 metric_thr=1.0, poll_min_ms=200, poll_max_ms=5000):
+        self.pixel_thr = pixel_thr          # これより明るさが変わった画素を「変化」とみなす
+        self.change_ratio = change_ratio    # 変化した画素の割合がこれ以下なら静止
+        self.max_reuse_s = max_reuse_s      # 使い回しを続けてよい最長時間
+        self.metric_thr = metric_thr        # 角度の変化がこれ未満（度）なら姿勢は安定
+        self.poll_min_ms = poll_min_ms
+        self.poll_max_ms = poll_max_ms
+        self.reset()
+
+    def reset(self):
+        self._ref = None
+        self._ref_at = 0.0
+        self._out = None
+        self._stable = 0
+
+    def lookup(self, thumb):
+        """
+        前回解析したフレームから変化が無ければ (True, 前回の結果) を返す。
+        解析が必要なら (False, None)。前回の結果は None（人がいない）のこともある。
+        """
+        ref = self._ref
+        if ref is None or thumb is None or thumb.shape != ref.shape:
+            return False, None
+        if time.monotonic() - self._ref_at > self.max_reuse_s:
+            return False, None
+
+        changed = np.count_nonzero(cv2.absdiff(thumb, ref) > self.pixel_thr)
+        if changed > self.change_ratio * thumb.size:
+            self._stable = 0
+            return False, None
+
+        self._stable += 1
+        return True, self._out
+
+    def store(self, thumb, out):
+        """解析した結果を次の比較の基準にする"""
+        if self._metrics_close(self._out, out):
+            self._stable += 1
+        else:
+            self._stable = 0
+        self._ref = thumb
+        self._ref_at = time.monotonic()
+        self._out = out
+
+    def _metrics_close(self, a, b):
+        if a is None or b is None:
+            return a is None and b is None
+        ma, mb = a["metrics"], b["metrics"]
+        return (a.get("judge") == b.get("judge")
+                and all(abs(ma[k] - mb[k]) < self.metric_thr for k in ma))
+
+    def next_poll_ms(self):
+        """安定が続くほど長く（最短の 2 倍ずつ、上限まで）"""
+        return min(self.poll_max_ms, self.poll_min_ms << min(self._stable, 16))
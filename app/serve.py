@@ -0,0 +1,161 @@
+# ========================
+# serve.py
+# ========================
+#
+# 本番用の起動（プリフォーク）
+#   python app/serve.py --port 5000
+#   python app/serve.py --no-preload                 # 比較用: ワーカーが自分で読み込む
+#   python app/serve.py --inference-workers 4        # 推論は専用プロセスで（inference_service.py）
+#
+#   web のワーカーは今は 1 つだけ（--workers 2 以上は受け付けない）。
+#   ワーカーは1本の listen ソケットを共有していて、ユーザーごとに同じワーカーへ振り分ける仕組みが無い。
+#   一方で次の状態はプロセスの中にしか無いので、ワーカーが複数だとリクエストごとに食い違う
+#     - AnalyzerPool（/calibrate の baseline・EMA・人ロック・静止判定）
+#       → 別のワーカーの /analyze には baseline が無い
+#     - batch_jobs / batch_slots → 受け付けたワーカー以外では GET /batch/<id> が 404
+#     - stream_stats → /stats が1ワーカー分しか数えない
+#   CPU を使い切るには --inference-workers で推論プロセスを増やす（推論以外は軽い）。
+#   ワーカーを増やすなら、上の状態を DB に置くか、ユーザーごとに同じワーカーへ送る前段が要る。
+#
+#   1. 親プロセスでアプリを作り（DB 作成もここで1回だけ）、mediapipe の import と
+#      モデルファイルの読み込みを済ませる
+#   2. gc.freeze() してから fork する。import 済みのモジュールやモデルの中身は
+#      コピーオンライトで共有され、ワーカーごとには増えない
+#      （推論器そのものはスレッドを持つので fork 前には作らない）
+#   3. 各ワーカーは start_worker（書き込みスレッド・ダミー推論）が終わってから accept を始める。
+#      古いログの整理は 0 番のワーカーだけで動かす
+#   落ちたワーカーは親が作り直す。SIGTERM / SIGINT で全ワーカーを止める。
+#
+#   gunicorn 等を使う場合も同じ順序にする（preload で create_app + preload_models、
+#   fork 後のフックで start_worker）。
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+logger = logging.getLogger("posture.serve")
+
+# ユーザーの状態（baseline・バッチのジョブなど）をワーカー間で共有していないので 1 まで
+MAX_WORKERS = 1
+
+
+def _worker(app, listener, index, args):
+    """fork した子プロセスの本体（戻らない）"""
+    from werkzeug.serving import make_server
+
+    from app import start_worker, stop_worker
+
+    t0 = time.perf_counter()
+    start_worker(app, retention=index == 0, warmup=not args.no_warmup)
+    server = make_server(args.host, args.port, app, threaded=True, fd=listener.fileno())
+
+    def stop(signum, frame):
+        # serve_forever と同じスレッドからは shutdown できない
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("worker %d (pid %d) ready in %.2fs", index, os.getpid(), time.perf_counter() - t0)
+
+    code = 0
+    try:
+        server.serve_forever()
+    except Exception:
+        logger.exception("worker %d crashed", index)
+        code = 1
+    finally:
+        stop_worker()
+    os._exit(code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="姿勢チェックアプリをプリフォークで起動する")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help=f"web のワーカー数（今は {MAX_WORKERS} まで。理由は先頭のコメント）")
+    parser.add_argument("--no-preload", action="store_true", help="fork 前に mediapipe・モデルを読まない")
+    parser.add_argument("--no-warmup", action="store_true", help="ワーカー起動時のダミー推論をしない")
+    parser.add_argument("--db-url", help="SQLALCHEMY_DATABASE_URI を上書きする")
+    parser.add_argument("--inference-workers", type=int,
+                        help="INFERENCE_WORKERS を上書きする（web のワーカーごとの推論プロセス数）")
+    args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS:
+        parser.error(f"--workers must be 1..{MAX_WORKERS}: baselines, batch jobs and stream stats are "
+                     "per process and requests are not routed to a fixed worker "
+                     "(use --inference-workers to scale inference)")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    t0 = time.perf_counter()
+    import app as app_module
+    from config import Config
+    from posture_check import preload_models
+
+    overrides = {}
+    if args.db_url:
+        overrides["SQLALCHEMY_DATABASE_URI"] = args.db_url
+    if args.inference_workers is not None:
+        overrides["INFERENCE_WORKERS"] = args.inference_workers
+    config = type("ServeConfig", (Config,), overrides) if overrides else Config
+    app = app_module.create_app(config)
+    if not args.no_preload:
+        preload_models([p for p in app_module.MODEL_TIERS.values() if os.path.exists(p)])
+    listener = socket.create_server((args.host, args.port), backlog=128)
+    # 1つの接続で全ワーカーが起こされ、取り損ねたワーカーが accept で止まらないように
+    # （止まっていると SIGTERM の shutdown も終わらない）。取り損ねは socketserver が無視する
+    listener.setblocking(False)
+    logger.info("master (pid %d) loaded in %.2fs, %d workers on %s:%d",
+                os.getpid(), time.perf_counter() - t0, args.workers, args.host, args.port)
+
+    # 親が作ったオブジェクトを GC が触らないようにする（触るとそのページがコピーされる）
+    gc.freeze()
+
+    workers = {}   # pid -> index
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _worker(app, listener, index, args)
+        workers[pid] = index
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for i in range(args.workers):
+        spawn(i)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logger.warning("worker %d (pid %d) exited with %d, restarting",
+                       index, pid, os.waitstatus_to_exitcode(status))
+        time.sleep(1.0)
+        spawn(index)
+    listener.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -33,12 +33,26 @@ let overlay       = null;   // JSで自動生成
 let ctx           = null;
 let skeletonOn    = false;
 
+// 送信サイズ（/capture_config でサーバーと合わせる）
+let captureMaxSide  = 640;
+let captureQuality  = 0.8;
+
+// ---- WebSocket ストリーミング（使えない時は HTTP ポーリング） ----
+let ws            = null;
+let wsFields      = null;   // サーバーに伝えた応答フィールド
+let wsSentAt      = 0;      // 結果待ちのフレームを送った時刻（0 = 待ちなし）
+const WS_TIMEOUT_MS = 2000;
+
 // ポーリング周期（骨格ONで高速化）
 let POLL_INTERVAL_MS = 1000;
 const POLL_SLOW_MS   = 1000;
 const POLL_FAST_MS   = 200;
+// サーバーが提案する間隔（静止している間は長くなる）。上の周期より短くはしない
+let serverPollMs     = 0;
+let activePollMs     = 0;
 
-// 代表的な接続（サーバー応答の connections を優先利用。無い場合のフォールバック）
+// 代表的な接続（/pose/connections を優先利用。取得できない場合のフォールバック）
+let poseEdges = null;
 const DEFAULT_POSE_EDGES = [
   [11,13],[13,15], [12,14],[14,16],     // 腕
   [11,12], [11,23],[12,24], [23,24],    // 肩帯〜体幹
@@ -119,31 +133,94 @@ function updatePrivacyUI(isOn) {
 function restartStreamingLoop() {
   if (!streaming) return;
   clearInterval(intervalId);
+  openStream();
+  activePollMs = Math.max(POLL_INTERVAL_MS, serverPollMs);
   intervalId = setInterval(async () => {
     if (!cameraOn) return;
-    const data = await sendFrame("/analyze");
-    updateUI(data);
-
-    // 骨格描画（プライバシーOFF かつ 骨格ON）
-    const canDraw = !privacyOn && skeletonOn && data && Array.isArray(data.landmarks);
-    if (canDraw) {
-      ensureOverlay();
-      // canvas サイズ未確定（videoWidth=0）時のリトライ
-      if (!fitCanvasToVideo()) {
-        setTimeout(() => {
-          fitCanvasToVideo();
-          drawSkeletonFromServer(data.landmarks, data.connections, data.posture);
-        }, 50);
-      } else {
-        drawSkeletonFromServer(data.landmarks, data.connections, data.posture);
+    // 骨格を描く時だけ 2D ランドマークを（バイナリで）受け取る
+    const wantSkeleton = !privacyOn && skeletonOn;
+    const fields = wantSkeleton ? "2d" : "";
+
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      // 前の結果が返るまでは次を送らない（サーバー側でも古いフレームは捨てる）
+      if (wsSentAt && Date.now() - wsSentAt < WS_TIMEOUT_MS) return;
+      if (fields !== wsFields) {
+        ws.send(JSON.stringify({ type: "config", fields, format: "packed" }));
+        wsFields = fields;
       }
+      const blob = await captureFrame();
+      if (!blob || !ws) return;
+      wsSentAt = Date.now();
+      ws.send(blob);
+      return;
+    }
+
+    const data = await sendFrame(`/analyze?fields=${fields}&format=packed`);
+    handleResult(data);
+  }, activePollMs);
+}
+
+function adaptPollInterval(ms) {
+  serverPollMs = ms;
+  if (streaming && Math.max(POLL_INTERVAL_MS, serverPollMs) !== activePollMs) {
+    restartStreamingLoop();
+  }
+}
+
+/*=========================
+  WebSocket 接続
+========================= */
+function openStream() {
+  if (ws || !("WebSocket" in window)) return;
+  const proto = location.protocol === "https:" ? "wss" : "ws";
+  ws = new WebSocket(`${proto}://${location.host}/ws/analyze?format=packed&fields=`);
+  ws.binaryType = "arraybuffer";
+  wsFields = "";
+
+  ws.onmessage = (ev) => {
+    wsSentAt = 0;
+    const data = typeof ev.data === "string" ? JSON.parse(ev.data) : decodePacked(ev.data);
+    handleResult(data);
+  };
+  ws.onclose = () => {
+    log("stream closed → HTTP fallback");
+    ws = null;
+    wsSentAt = 0;
+  };
+}
+
+function closeStream() {
+  if (ws) ws.close();
+  ws = null;
+  wsSentAt = 0;
+}
+
+/*=========================
+  解析結果の反映
+========================= */
+function handleResult(data) {
+  updateUI(data);
+  if (data && data.next_poll_ms) adaptPollInterval(data.next_poll_ms);
+
+  // 骨格描画（プライバシーOFF かつ 骨格ON）
+  const canDraw = !privacyOn && skeletonOn && data && Array.isArray(data.landmarks);
+  if (canDraw) {
+    ensureOverlay();
+    // canvas サイズ未確定（videoWidth=0）時のリトライ
+    if (!fitCanvasToVideo()) {
+      setTimeout(() => {
+        fitCanvasToVideo();
+        drawSkeletonFromServer(data.landmarks, poseEdges, data.posture);
+      }, 50);
     } else {
-      clearOverlay();
-      if (DEBUG) {
-        log("skip draw:", { privacyOn, skeletonOn, hasLm: !!(data && data.landmarks) });
-      }
+      drawSkeletonFromServer(data.landmarks, poseEdges, data.posture);
     }
-  }, POLL_INTERVAL_MS);
+  } else {
+    clearOverlay();
+    if (DEBUG) {
+      log("skip draw:", { privacyOn, skeletonOn, hasLm: !!(data && data.landmarks) });
+    }
+  }
 }
 
 /*=========================
@@ -203,6 +280,7 @@ toggleBtn.addEventListener("click", async () => {
     cameraOn = false;
 
     // 計測ループも停止
+    closeStream();
     if (streaming) {
       clearInterval(intervalId);
       streaming = false;
@@ -290,28 +368,39 @@ startBtn.onclick = async () => {
 /*=========================
   フレーム送信
 ========================= */
-async function sendFrame(url) {
-  if (!cameraOn || !video.srcObject) {
-    return { posture: "unknown" };
-  }
+async function captureFrame() {
+  if (!cameraOn || !video.srcObject || !video.videoWidth) return null;
+
+  // サーバーの推論解像度まで縮小して送る（ランドマークは 0..1 座標なので描画に影響なし）
+  const vw = video.videoWidth, vh = video.videoHeight;
+  const scale = Math.min(1, captureMaxSide / Math.max(vw, vh));
 
   const canvas = document.createElement("canvas");
-  canvas.width = video.videoWidth;
-  canvas.height = video.videoHeight;
+  canvas.width = Math.round(vw * scale);
+  canvas.height = Math.round(vh * scale);
 
   const c = canvas.getContext("2d");
-  c.drawImage(video, 0, 0);
+  c.drawImage(video, 0, 0, canvas.width, canvas.height);
 
-  const blob = await new Promise(resolve =>
-    canvas.toBlob(resolve, "image/jpeg", 0.8)
+  return await new Promise(resolve =>
+    canvas.toBlob(resolve, "image/jpeg", captureQuality)
   );
+}
 
-  const formData = new FormData();
-  formData.append("image", blob, "frame.jpg");
+async function sendFrame(url) {
+  const blob = await captureFrame();
+  if (!blob) {
+    return { posture: "unknown" };
+  }
 
+  // multipart にせず JPEG をそのまま送る（Content-Type: image/jpeg）
   try {
-    const res = await fetch(url, { method: "POST", body: formData });
+    const res = await fetch(url, { method: "POST", body: blob });
     if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    const type = res.headers.get("Content-Type") || "";
+    if (type.startsWith("application/octet-stream")) {
+      return decodePacked(await res.arrayBuffer());
+    }
     return await res.json();
   } catch (e) {
     log("sendFrame error:", e);
@@ -319,6 +408,56 @@ async function sendFrame(url) {
   }
 }
 
+/*=========================
+  packed 形式の応答を展開
+  [uint32 ヘッダ長][ヘッダ JSON][float32 配列...]
+ ========================= */
+function decodePacked(buf) {
+  const headLen = new DataView(buf).getUint32(0, true);
+  const header  = JSON.parse(new TextDecoder().decode(new Uint8Array(buf, 4, headLen)));
+  let offset = 4 + headLen;
+
+  for (const [name, [rows, cols]] of Object.entries(header.arrays || {})) {
+    const f = new Float32Array(buf, offset, rows * cols);
+    offset += rows * cols * 4;
+    const pts = [];
+    for (let i = 0; i < rows; i++) {
+      const j = i * cols;
+      pts.push({ x: f[j], y: f[j + 1], z: f[j + 2], visibility: f[j + 3], presence: f[j + 4] });
+    }
+    header[name] = pts;
+  }
+  delete header.arrays;
+  return header;
+}
+
+/*=========================
+  送信サイズをサーバーから取得
+ ========================= */
+async function loadCaptureConfig() {
+  try {
+    const res = await fetch("/capture_config");
+    if (!res.ok) return;
+    const cfg = await res.json();
+    captureMaxSide = cfg.max_side || captureMaxSide;
+    captureQuality = cfg.jpeg_quality || captureQuality;
+  } catch (e) {
+    log("capture_config fetch error:", e);
+  }
+}
+
+/*=========================
+  骨格の接続情報を取得（ブラウザキャッシュされる）
+ ========================= */
+async function loadPoseEdges() {
+  try {
+    const res = await fetch("/pose/connections");
+    if (res.ok) poseEdges = await res.json();
+  } catch (e) {
+    log("connections fetch error:", e);
+  }
+}
+
 /* =========================
   UI更新（姿勢結果）
 ========================= */
@@ -435,6 +574,8 @@ window.addEventListener("resize", () => {
   起動時の初期表示
 ========================= */
 window.addEventListener("DOMContentLoaded", () => {
+  loadPoseEdges();
+  loadCaptureConfig();
   updatePrivacyUI(false);
   postureEl.textContent = "OFF";
   messageEl.textContent = "カメラはオフです";
@@ -0,0 +1,147 @@
+# ========================
+# storage.py
+# ========================
+#
+# DB への接続（書き込み用と読み取り用のエンジンを分ける）
+#
+#   書き込み : db.engine / db.session（姿勢ログの書き込みスレッド・ログイン・設定の保存など）
+#   読み取り : storage.read_engine / storage.read_session（/logs の表示・/api/rollups・/export）
+#
+#   接続先は SQLALCHEMY_DATABASE_URI（環境変数 DATABASE_URL で差し替えられる）。
+#   DATABASE_READ_URL を指定すると読み取りだけそちらへ（サーバー DB のレプリカなど）。
+#   指定しなければ同じ DB への別の接続プールで読む（長い読み取りが書き込みの接続を奪わない）。
+#
+#   SQLite のファイルの場合は接続ごとに PRAGMA を設定する
+#     journal_mode=WAL   : 書き込み中も読み取りが待たない（読み取り中も書き込みが待たない）
+#     synchronous=NORMAL : コミットごとの fsync をしない。WAL なら電源断でも DB は壊れない
+#                          （直前のコミットが消えることはある）
+#     cache_size / mmap_size / busy_timeout
+#   読み取り用の接続は query_only にして、誤って書き込まないようにする。
+
+import sqlalchemy as sa
+from flask.globals import app_ctx
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+
+def is_sqlite_file(url):
+    url = sa.engine.make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def _app_ctx_id():
+    # Flask-SQLAlchemy の db.session と同じく、アプリコンテキストごとにセッションを分ける
+    return id(app_ctx._get_current_object())
+
+
+class Storage:
+    """
+    Flask-SQLAlchemy の db に接続の設定を足し、読み取り用のエンジンとセッションを持つ。
+    アプリでは db.init_app の代わりに storage.init_app を呼ぶ
+    """
+
+    def __init__(self, db, app=None):
+        self._db = db
+        self.write_engine = None
+        self.read_engine = None
+        self.read_session = scoped_session(sessionmaker(), scopefunc=_app_ctx_id)
+        self.separate_reads = False
+
+        if app is not None:
+            self.init_app(app)
+
+    # ---- 初期化 ----
+    def init_app(self, app):
+        config = app.config
+        url = config["SQLALCHEMY_DATABASE_URI"]
+        read_url = config.get("DATABASE_READ_URL") or url
+
+        # 明示的に書かれた SQLALCHEMY_ENGINE_OPTIONS の方を優先する
+        options = self.engine_options(url, config, config.get("DB_POOL_SIZE", 5))
+        options.update(config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+        self._db.init_app(app)
+
+        with app.app_context():
+            writer = self.write_engine = self._db.engine
+        if is_sqlite_file(url):
+            sa.event.listen(writer, "connect", self._sqlite_pragmas(config, read_only=False))
+
+        # メモリ上の SQLite は接続ごとに別の DB になるので分けない
+        in_memory = writer.dialect.name == "sqlite" and not is_sqlite_file(url)
+        self.separate_reads = config.get("DB_READ_SEPARATE", True) and (read_url != url or not in_memory)
+        if self.separate_reads:
+            options = self.engine_options(read_url, config, config.get("DB_READ_POOL_SIZE", 10))
+            # 相対パスの SQLite は Flask-SQLAlchemy が instance フォルダ基準に直したものを使う
+            self.read_engine = sa.create_engine(writer.url if read_url == url else read_url, **options)
+            if is_sqlite_file(read_url):
+                sa.event.listen(self.read_engine, "connect", self._sqlite_pragmas(config, read_only=True))
+        else:
+            self.read_engine = writer
+        self.read_session.session_factory.configure(bind=self.read_engine)
+        app.teardown_appcontext(self._teardown)
+
+    @staticmethod
+    def engine_options(url, config, pool_size):
+        """接続プールの設定（インメモリの SQLite は Flask-SQLAlchemy の既定のまま）"""
+        if is_sqlite_file(url):
+            return {
+                "pool_size": pool_size,
+                "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+                "connect_args": {"timeout": config.get("SQLITE_BUSY_TIMEOUT_MS", 5000) / 1000,
+                                 "check_same_thread": False},
+            }
+        if sa.engine.make_url(url).get_backend_name() == "sqlite":
+            return {}
+        return {
+            "pool_size": pool_size,
+            "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+            "pool_pre_ping": True,   # サーバー側で切られた接続を使わない
+            "pool_recycle": config.get("DB_POOL_RECYCLE_S", 1800),
+        }
+
+    @staticmethod
+    def _sqlite_pragmas(config, read_only):
+        pragmas = {
+            "busy_timeout": config.get("SQLITE_BUSY_TIMEOUT_MS", 5000),
+            "cache_size": -config.get("SQLITE_CACHE_SIZE_KB", 16384),   # 負の値は KiB
+            "mmap_size": config.get("SQLITE_MMAP_SIZE_MB", 64) * 2**20,
+        }
+        if read_only:
+            pragmas["query_only"] = "ON"
+        else:
+            # journal_mode は DB ファイルに残るので、書き込み側で設定すれば読み取り側も WAL になる
+            pragmas["journal_mode"] = config.get("SQLITE_JOURNAL_MODE", "wal")
+            pragmas["synchronous"] = config.get("SQLITE_SYNCHRONOUS", "normal")
+
+        def on_connect(dbapi_conn, record):
+            cursor = dbapi_conn.cursor()
+            try:
+                for name, value in pragmas.items():
+                    if value is not None:
+                        cursor.execute(f"PRAGMA {name}={value}")
+            finally:
+                cursor.close()
+
+        return on_connect
+
+    def _teardown(self, exc):
+        self.read_session.remove()
+
+    # ---- fork 後 ----
+    def dispose(self):
+        """fork した子プロセスで呼ぶ。親が作った接続は閉じずに手放し、子で作り直す"""
+        self.write_engine.dispose(close=False)
+        if self.separate_reads:
+            self.read_engine.dispose(close=False)
+
+    # ---- 状態 ----
+    def stats(self):
+        def pool(engine):
+            p = engine.pool
+            out = {"pool": type(p).__name__}
+            if isinstance(p, sa.pool.QueuePool):
+                out.update(size=p.size(), checked_out=p.checkedout(), overflow=p.overflow())
+            return out
+
+        return {"backend": self.write_engine.dialect.name, "separate_reads": self.separate_reads,
+                "write": pool(self.write_engine), "read": pool(self.read_engine)}